@@ -0,0 +1,415 @@
+"""
+Нагрузочный тест бота без Telegram и без воркеров.
+
+Поднимает локальную заглушку Telegram Bot API (sendMessage, editMessageText,
+getFile, скачивание файлов) и HTTP сервер с файлами для ссылок, подменяет
+ими API бота и подает синтетические апдейты (аудио, документы, ZIP архивы,
+ссылки; голосовые - только через --kinds) прямо в диспетчер. Задачи из очереди разбирает
+заглушка воркера: пишет промежуточные статусы и результат в Redis так же,
+как настоящий воркер, но без расшифровки.
+
+На каждой ступени нагрузки замеряются задержка обработчиков, время от
+апдейта до итогового сообщения, задержка event loop и память процесса.
+
+Запуск из папки bot (Redis из REDIS_HOST или --fake-redis; для fakeredis
+нужна поддержка Lua - pip install 'fakeredis[lua]', иначе снятие
+закрепления файлов скриптом не выполняется и тест не запускается):
+    python benchmarks/loadtest.py --fake-redis --levels 1 10 50 100
+    python benchmarks/loadtest.py --levels 10 50 --api-latency 0.1 --output run.jsonl
+
+Результат - JSON Lines: строка с параметрами и по строке на ступень.
+Исключение в обработчике (в том числе перехваченное им и показанное
+пользователю как "Произошла ошибка") - ошибка бота, а не отказ задачи:
+тест печатает их и завершается с ненулевым кодом.
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import tempfile
+import zipfile
+import platform
+import itertools
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+TOKEN = '123456:LOADTEST'
+KINDS = ['audio', 'voice', 'document', 'zip', 'url']
+# Голосовые бот в обработку не берет (ответ эхом): по умолчанию не подаются
+DEFAULT_KINDS = ['audio', 'document', 'zip', 'url']
+
+# Итоговое сообщение обработчика о перехваченном исключении
+HANDLER_ERROR_PREFIX = '❌ Произошла ошибка'
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return round(values[idx], 4)
+
+
+def _summary(values):
+    return {
+        'count': len(values),
+        'p50': _percentile(values, 50),
+        'p95': _percentile(values, 95),
+        'p99': _percentile(values, 99),
+        'max': round(max(values), 4) if values else None,
+    }
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except Exception:
+        return None
+
+
+def _make_zip(payload):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('record.mp3', payload)
+    return buffer.getvalue()
+
+
+class FakeTelegram:
+    """
+    Заглушка Bot API: отвечает на методы, которые использует бот, с заданной
+    задержкой и долей ответов 429, и запоминает итоговые сообщения чатов.
+    """
+
+    def __init__(self, latency=0.03, retry_after_ratio=0.0, file_size=256 * 1024):
+        self.latency = latency
+        self.retry_after_ratio = retry_after_ratio
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+        self.rate_limited = 0
+        self.finished = {}  # chat_id -> (время, текст) первого итогового сообщения
+        self.payload = os.urandom(file_size)
+        self.zip_payload = _make_zip(self.payload)
+
+    def _message(self, chat_id, text):
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text,
+        }
+
+    async def api(self, request):
+        from aiohttp import web
+
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = dict(await request.post())
+        await asyncio.sleep(self.latency)
+
+        if method in ('editMessageText', 'sendMessage') and random.random() < self.retry_after_ratio:
+            self.rate_limited += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1},
+            })
+
+        chat_id = int(data.get('chat_id', 0) or 0)
+        text = data.get('text', '')
+        if method == 'editMessageText' and text[:1] in ('✅', '❌', '🚫') and chat_id not in self.finished:
+            self.finished[chat_id] = (time.perf_counter(), text)
+
+        if method in ('sendMessage', 'editMessageText'):
+            return web.json_response({'ok': True, 'result': self._message(chat_id, text)})
+        if method == 'getFile':
+            file_id = data.get('file_id', '')
+            return web.json_response({'ok': True, 'result': {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self.payload),
+                'file_path': f"files/{file_id}",
+            }})
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {
+                'id': 123456, 'is_bot': True, 'first_name': 'loadtest', 'username': 'loadtest_bot',
+            }})
+        return web.json_response({'ok': True, 'result': True})
+
+    async def file(self, request):
+        from aiohttp import web
+
+        path = request.match_info['path']
+        await asyncio.sleep(self.latency)
+        body = self.zip_payload if path.endswith('zip') else self.payload
+        return web.Response(body=body, content_type='application/octet-stream')
+
+    async def media(self, request):
+        """Файлы, которые пользователи присылают ссылками"""
+        from aiohttp import web
+
+        name = request.match_info['name']
+        body = self.zip_payload if name.endswith('.zip') else self.payload
+        headers = {
+            'Content-Length': str(len(body)),
+            'Content-Disposition': f'attachment; filename="{name}"',
+        }
+        if request.method == 'HEAD':
+            return web.Response(headers=headers)
+        return web.Response(body=body, headers=headers)
+
+    def app(self):
+        from aiohttp import web
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.api)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.file)
+        app.router.add_route('*', '/media/{name}', self.media)
+        return app
+
+
+async def stub_worker(main, job_seconds, steps=5):
+    """
+    Разбирает очередь вместо настоящего воркера: несколько промежуточных
+    статусов и результат с записью расшифровки, как у worker.py.
+    """
+    from rq import Queue
+
+    async def run(task_data):
+        task_key = f"task:{task_data['task_id']}"
+        for step in range(steps):
+            main.redis_conn.hset(task_key, mapping={
+                'status': 'processing',
+                'message': f"Обрабатываю часть {step + 1} из {steps}...",
+                'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            })
+            await asyncio.sleep(job_seconds / steps)
+
+        record_file = os.path.splitext(task_data['file_path'])[0] + "_segments.jsonl"
+        with open(record_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'version': 1, 'summary': 'Тест', 'language': 'ru'}, ensure_ascii=False) + "\n")
+            f.write(json.dumps({'start': 0.0, 'end': 5.0, 'text': 'Тестовая расшифровка.'}, ensure_ascii=False) + "\n")
+        result = {
+            'summary': '[00:00:00] Тестовая расшифровка.',
+            'transcript': 'Тестовая расшифровка.',
+            'segments_count': 1,
+            'duration': 5.0,
+            'language': 'ru',
+            'record_file': record_file,
+        }
+        main.redis_conn.hset(task_key, mapping={
+            'status': 'completed',
+            'result': json.dumps(result, ensure_ascii=False),
+            'completed_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        main.redis_conn.expire(task_key, 3600)
+        # Как release_inflight воркера: ключ снимается, только если он еще
+        # принадлежит задаче
+        if task_data.get('inflight_key'):
+            main.redis_conn.eval(main._DELETE_IF_EQUAL, 1, task_data['inflight_key'], task_data['task_id'])
+
+    queues = [Queue('video_processing', connection=main.redis_conn_rq)]
+    while True:
+        dequeued = Queue.dequeue_any(queues, None, connection=main.redis_conn_rq)
+        if dequeued is None:
+            await asyncio.sleep(0.05)
+            continue
+        job, _ = dequeued
+        asyncio.create_task(run(job.args[0]))
+
+
+async def loop_lag_probe(samples, interval=0.05):
+    """Задержка event loop: насколько позже заданного просыпается sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(loop.time() - started - interval, 0.0))
+
+
+def make_update(kind, user_id, update_id, media_base):
+    """Синтетический апдейт от отдельного пользователя"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+    }
+    # У каждого апдейта свой файл, чтобы не срабатывала склейка одинаковых
+    file_id = f"{kind}-{uuid.uuid4().hex}"
+    if kind == 'audio':
+        message['audio'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 60, 'file_size': 256 * 1024}
+    elif kind == 'voice':
+        message['voice'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 10, 'file_size': 32 * 1024}
+    elif kind == 'document':
+        message['document'] = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'lecture.mp3', 'file_size': 256 * 1024}
+    elif kind == 'zip':
+        file_id += '.zip'
+        message['document'] = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'archive.zip', 'file_size': 256 * 1024}
+    elif kind == 'url':
+        message['text'] = f"{media_base}/media/{file_id}.mp3"
+    return {'update_id': update_id, 'message': message}
+
+
+async def run_level(main, telegram, concurrency, kinds, media_base, settle_timeout):
+    """Одна ступень: concurrency пользователей одновременно присылают по файлу"""
+    from aiogram.types import Update
+
+    lag_samples = []
+    lag_task = asyncio.create_task(loop_lag_probe(lag_samples))
+    handler_latency = []
+    sent_at = {}
+    expected = set()
+    errors = []
+    update_ids = itertools.count(int(time.time() * 1000))
+
+    async def one(user_id, kind):
+        update = Update.model_validate(make_update(kind, user_id, next(update_ids), media_base), context={'bot': main.bot})
+        started = time.perf_counter()
+        sent_at[user_id] = started
+        # Голосовые бот не берет в обработку: итогового сообщения не будет
+        if kind != 'voice':
+            expected.add(user_id)
+        try:
+            await main.dp.feed_update(main.bot, update)
+        except Exception as e:
+            errors.append(f"{kind}: {e!r}")
+        handler_latency.append(time.perf_counter() - started)
+
+    base_user = random.randint(10 ** 6, 10 ** 9)
+    calls_before = sum(telegram.calls.values())
+    level_started = time.perf_counter()
+    await asyncio.gather(*(one(base_user + idx, kinds[idx % len(kinds)]) for idx in range(concurrency)))
+
+    # Ждем итоговых сообщений (результат или ошибка) во всех чатах с задачами
+    deadline = time.perf_counter() + settle_timeout
+    waiting = set(expected)
+    while waiting and time.perf_counter() < deadline:
+        waiting -= set(telegram.finished)
+        await asyncio.sleep(0.1)
+
+    lag_task.cancel()
+    # Закрепления файлов, оставшиеся после завершения всех задач ступени
+    inflight_left = sum(1 for _ in main.redis_conn.scan_iter(main.INFLIGHT_KEY_PREFIX + '*'))
+    end_to_end = [telegram.finished[user_id][0] - sent_at[user_id] for user_id in sent_at if user_id in telegram.finished]
+    failed = sum(1 for user_id in sent_at if user_id in telegram.finished and not telegram.finished[user_id][1].startswith('✅'))
+    errors += [
+        f"{kinds[(user_id - base_user) % len(kinds)]}: {telegram.finished[user_id][1]}"
+        for user_id in sent_at
+        if user_id in telegram.finished and telegram.finished[user_id][1].startswith(HANDLER_ERROR_PREFIX)
+    ]
+    return {
+        'type': 'level',
+        'concurrency': concurrency,
+        'wall_seconds': round(time.perf_counter() - level_started, 3),
+        'handler_latency': _summary(handler_latency),
+        'end_to_end': _summary(end_to_end),
+        'completed': len(end_to_end) - failed,
+        'failed': failed,
+        'no_result': len(expected - set(telegram.finished)),
+        'handler_exceptions': len(errors),
+        'handler_errors': errors[:10],
+        'inflight_left': inflight_left,
+        'loop_lag': _summary(lag_samples),
+        'telegram_calls': sum(telegram.calls.values()) - calls_before,
+        'rss_mb': _rss_mb(),
+    }
+
+
+async def run(args):
+    from aiohttp import web
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bot_loadtest_')
+    os.environ.setdefault('BOT_TOKEN', TOKEN)
+    os.environ['SPOOL_DIR'] = workdir
+    os.environ.setdefault('SPOOL_ADMISSION_WAIT', '0')
+    import main
+    from aiogram.client.telegram import TelegramAPIServer
+    from rq import Queue
+    from spool import SpoolManager
+
+    telegram = FakeTelegram(latency=args.api_latency, retry_after_ratio=args.retry_after_ratio)
+    runner = web.AppRunner(telegram.app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    base = f"http://127.0.0.1:{args.port}"
+    main.bot.session.api = TelegramAPIServer.from_base(base)
+
+    if args.fake_redis:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        main.redis_conn_rq = fakeredis.FakeRedis(server=server)
+        main.redis_conn = fakeredis.FakeRedis(server=server, decode_responses=True)
+        try:
+            main.redis_conn.eval("return 1", 0)
+        except Exception as e:
+            raise SystemExit(
+                f"fakeredis без поддержки Lua ({e}): установите pip install 'fakeredis[lua]', "
+                "иначе снятие закрепления файлов (inflight) не проверяется"
+            )
+        main.video_queue = Queue('video_processing', connection=main.redis_conn_rq)
+        main.spool = SpoolManager(main.redis_conn, root=workdir)
+    elif not await main.init_redis():
+        raise SystemExit("Redis недоступен: задайте REDIS_HOST или используйте --fake-redis")
+
+    main.outbound.start()
+    worker_task = asyncio.create_task(stub_worker(main, args.job_seconds))
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+
+    def emit(row):
+        out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out.flush()
+
+    emit({
+        'type': 'environment',
+        'python': platform.python_version(),
+        'levels': args.levels,
+        'kinds': args.kinds,
+        'api_latency': args.api_latency,
+        'retry_after_ratio': args.retry_after_ratio,
+        'job_seconds': args.job_seconds,
+        'fake_redis': args.fake_redis,
+        'rss_mb': _rss_mb(),
+    })
+    try:
+        for concurrency in args.levels:
+            row = await run_level(main, telegram, concurrency, args.kinds, base, args.settle_timeout)
+            emit(row)
+            if row['handler_exceptions']:
+                raise SystemExit(
+                    f"Исключения в обработчиках на ступени {concurrency}: {row['handler_exceptions']}\n"
+                    + "\n".join(row['handler_errors'])
+                )
+    finally:
+        worker_task.cancel()
+        await runner.cleanup()
+        await main.bot.session.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 10, 25, 50])
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=DEFAULT_KINDS)
+    parser.add_argument('--api-latency', type=float, default=0.03, help="задержка ответа заглушки Telegram (с)")
+    parser.add_argument('--retry-after-ratio', type=float, default=0.0, help="доля ответов 429 на правки сообщений")
+    parser.add_argument('--job-seconds', type=float, default=5.0, help="длительность задачи в заглушке воркера")
+    parser.add_argument('--settle-timeout', type=float, default=120.0, help="сколько ждать итоговых сообщений")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fake-redis', action='store_true', help="fakeredis в памяти вместо Redis")
+    parser.add_argument('--workdir', default=None, help="папка для файлов задач (по умолчанию временная)")
+    parser.add_argument('--output', default=None, help="файл JSON Lines (по умолчанию stdout)")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько живут запись с сегментами и отрендеренные экспорты (секунды)
+EXPORT_TTL = int(os.getenv('EXPORT_TTL', 3600))
+
+
+def _format_timestamp(seconds, ms_separator):
+    ms = int((seconds - int(seconds)) * 1000)
+    s = int(seconds) % 60
+    m = (int(seconds) // 60) % 60
+    h = int(seconds) // 3600
+    return f"{h:02}:{m:02}:{s:02}{ms_separator}{ms:03}"
+
+
+def read_record(record_path):
+    """
+    Читает каноническую запись воркера: заголовок и генератор сегментов.
+    Сегменты читаются построчно, файл целиком в память не загружается.
+    """
+    f = open(record_path, 'r', encoding='utf-8')
+    try:
+        header = json.loads(f.readline())
+    except Exception:
+        f.close()
+        raise
+
+    def _segments():
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    return header, _segments()
+
+
+def write_srt(record_path, out):
+    _, segments = read_record(record_path)
+    for idx, seg in enumerate(segments, start=1):
+        start = _format_timestamp(seg['start'], ',')
+        end = _format_timestamp(seg['end'], ',')
+        out.write(f"{idx}\n{start} --> {end}\n{seg['text'].strip()}\n\n")
+
+
+def write_vtt(record_path, out):
+    _, segments = read_record(record_path)
+    out.write("WEBVTT\n\n")
+    for seg in segments:
+        start = _format_timestamp(seg['start'], '.')
+        end = _format_timestamp(seg['end'], '.')
+        out.write(f"{start} --> {end}\n{seg['text'].strip()}\n\n")
+
+
+def write_json(record_path, out):
+    header, segments = read_record(record_path)
+    out.write('{"summary": ')
+    out.write(json.dumps(header.get('summary', ''), ensure_ascii=False))
+    out.write(', "segments": [')
+    for idx, seg in enumerate(segments):
+        if idx:
+            out.write(', ')
+        out.write(json.dumps(seg, ensure_ascii=False))
+    out.write(']}\n')
+
+
+def write_txt(record_path, out):
+    # Формат совпадает с прежним _summary.txt воркера
+    header, segments = read_record(record_path)
+    out.write("Summary:\n" + header.get('summary', '') + "\n\n")
+    out.write("Transcript:\n")
+    for seg in segments:
+        out.write(seg['text'])
+    out.write("\n\n")
+    out.write("Segments:\n")
+    _, segments = read_record(record_path)
+    for seg in segments:
+        start = _format_timestamp(seg['start'], ':')
+        end = _format_timestamp(seg['end'], ':')
+        out.write(f"[{start} - {end}] {seg['text']}\n")
+
+
+# Формат -> (расширение, функция записи, подпись кнопки)
+EXPORT_FORMATS = {
+    'srt': ('.srt', write_srt, 'SRT'),
+    'vtt': ('.vtt', write_vtt, 'VTT'),
+    'json': ('.json', write_json, 'JSON'),
+    'txt': ('.txt', write_txt, 'TXT'),
+}
+
+
+class ExportCache:
+    """
+    Кэш экспортов расшифровки. Каждый формат рендерится при первом запросе
+    и хранится на диске до истечения TTL, после чего удаляются и экспорты,
+    и каноническая запись задачи.
+    """
+
+    def __init__(self, ttl=EXPORT_TTL):
+        self.ttl = ttl
+        self.records = {}  # task_id -> (record_path, expires_at)
+        self.exports = {}  # (task_id, fmt) -> export_path
+
+    def register_record(self, task_id, record_path):
+        # Повторная регистрация (уточненная расшифровка заменила черновик)
+        # сбрасывает экспорты, отрендеренные из старой записи
+        self._remove(self._pop_exports(task_id))
+        self.records[task_id] = (record_path, time.monotonic() + self.ttl)
+
+    def get_record(self, task_id):
+        entry = self.records.get(task_id)
+        if entry and os.path.exists(entry[0]):
+            return entry[0]
+        return None
+
+    def render(self, task_id, fmt):
+        """
+        Возвращает путь к экспорту, рендеря его при первом обращении.
+        Блокирующая функция - вызывать из executor.
+        """
+        record_path = self.get_record(task_id)
+        if record_path is None:
+            return None
+
+        export_path = self.exports.get((task_id, fmt))
+        if export_path and os.path.exists(export_path):
+            return export_path
+
+        extension, writer, _ = EXPORT_FORMATS[fmt]
+        export_path = os.path.splitext(record_path)[0] + extension
+        tmp_path = export_path + '.part'
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            writer(record_path, out)
+        os.replace(tmp_path, export_path)
+
+        self.exports[(task_id, fmt)] = export_path
+        # Обращение к экспорту продлевает жизнь записи
+        self.records[task_id] = (record_path, time.monotonic() + self.ttl)
+        return export_path
+
+    def evict_expired(self):
+        """Удаляет записи и экспорты с истекшим TTL"""
+        now = time.monotonic()
+        expired = [task_id for task_id, (_, expires_at) in self.records.items() if expires_at <= now]
+        for task_id in expired:
+            self.forget(task_id)
+        return len(expired)
+
+    def forget(self, task_id):
+        record_path, _ = self.records.pop(task_id, (None, None))
+        paths = [record_path] if record_path else []
+        self._remove(paths + self._pop_exports(task_id))
+
+    def _pop_exports(self, task_id):
+        paths = []
+        for fmt in EXPORT_FORMATS:
+            export_path = self.exports.pop((task_id, fmt), None)
+            if export_path:
+                paths.append(export_path)
+        return paths
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                if os.path.exists(path):
+                    os.unlink(path)
+            except Exception as e:
+                logger.error(f"Ошибка удаления экспорта {path}: {e}")
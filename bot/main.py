@@ -1,22 +1,32 @@
 import asyncio
+import html
 import logging
 import os
 import tempfile
 import json
 import uuid
+import hashlib
 import re
 import aiohttp
 import zipfile
 import shutil
 from datetime import datetime
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.client.default import DefaultBotProperties
-from rq import Queue
+from aiohttp import web
+from rq import Queue, Worker
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
 import redis
+from exports import ExportCache, EXPORT_FORMATS, EXPORT_TTL
+from outbound import OutboundScheduler
+from spool import SpoolManager, SPOOL_ADMISSION_WAIT
+from search_index import SearchIndex, MATCH_START, MATCH_END
+import metrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -39,26 +49,86 @@ if ADMIN_USER_ID:
 else:
     logger.warning("ADMIN_USER_ID не найден в переменных окружения!")
 
+# Ключи профилирования задач (см. worker/profiling.py)
+PROFILING_ENABLED_KEY = 'profiling:enabled'
+PROFILE_KEY_PREFIX = 'profile:'
+PROFILE_RECENT_KEY = 'profiles:recent'
+
 # Настройки Redis
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_DB = int(os.getenv('REDIS_DB', 0))
 
+# Режим получения апдейтов: polling (один процесс) или webhook
+# (несколько реплик за балансировщиком)
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+
+# Одинаковые файлы, уже стоящие в очереди или в работе, не обрабатываются
+# повторно: inflight:{ключ файла} -> task_id, к которому подключаются
+# остальные отправители
+INFLIGHT_KEY_PREFIX = 'inflight:'
+INFLIGHT_TTL = int(os.getenv('INFLIGHT_TTL', 2 * 3600))
+
+# Удаление ключа, только если он все еще принадлежит задаче
+_DELETE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Отмена задач: флаг cancel:{task_id} проверяет воркер, а задачи
+# пользователя хранятся в user:{user_id}:tasks для /cancel без аргументов
+CANCEL_KEY_PREFIX = 'cancel:'
+CANCEL_TTL = 2 * 3600
+USER_TASKS_TTL = 24 * 3600
+
+# Пользователи, ждущие результата задачи (отправитель и подключенные
+# к ней повторной отправкой): /cancel отключает пользователя, а задача
+# отменяется, только когда уходит последний
+WAITERS_KEY_PREFIX = 'waiters:'
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Флаг "файл пользователя скачивается" хранится в Redis, чтобы его видели
+# все реплики; TTL страхует от зависшего флага при падении реплики
+USER_STATE_KEY_PREFIX = 'user_state:'
+USER_STATE_TTL = int(os.getenv('USER_STATE_TTL', 30 * 60))
+
+# Сколько секунд мониторинг ждет появления задачи (файл еще скачивается
+# отправителем), прежде чем считать ее потерянной
+TASK_MISSING_TIMEOUT = int(os.getenv('TASK_MISSING_TIMEOUT', USER_STATE_TTL))
+
 # Создаём объекты бота и диспетчера
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot.session.middleware(metrics.TelegramLatencyMiddleware())
 dp = Dispatcher()
 
+# Все правки статусов и отправка результатов идут через общую очередь
+# с учетом лимитов Telegram
+outbound = OutboundScheduler()
+
 # Подключения к Redis
 redis_conn = None
 redis_conn_rq = None
 video_queue = None
 
-# Словарь для хранения состояний пользователей
-user_states = {}
+# Учет файлов задач на общем томе
+spool = None
+
+# Кэш экспортов расшифровок (SRT/VTT/JSON/TXT)
+export_cache = ExportCache()
+
+# Полнотекстовый поиск по прошлым расшифровкам (/find)
+search_index = SearchIndex()
 
 async def init_redis():
     """Инициализация Redis подключений"""
-    global redis_conn, redis_conn_rq, video_queue
+    global redis_conn, redis_conn_rq, video_queue, spool
     
     try:
         # Подключение для RQ (без decode_responses)
@@ -71,13 +141,162 @@ async def init_redis():
         # Очередь для видео обработки
         video_queue = Queue('video_processing', connection=redis_conn_rq)
         
+        spool = SpoolManager(redis_conn)
+        
         logger.info(f"Подключен к Redis: {REDIS_HOST}:{REDIS_PORT}")
         return True
     except Exception as e:
         logger.error(f"Ошибка подключения к Redis: {e}")
         return False
 
-async def add_video_task(user_id, file_path, task_id):
+def acquire_user_slot(user_id):
+    """
+    Отмечает, что файл пользователя обрабатывается ботом.
+    Возвращает False, если предыдущий файл еще не поставлен в очередь.
+    """
+    try:
+        return bool(redis_conn.set(f"{USER_STATE_KEY_PREFIX}{user_id}", 'processing', nx=True, ex=USER_STATE_TTL))
+    except Exception as e:
+        logger.error(f"Ошибка установки состояния пользователя {user_id}: {e}")
+        return True
+
+def release_user_slot(user_id):
+    """Сбрасывает состояние обработки пользователя"""
+    try:
+        redis_conn.delete(f"{USER_STATE_KEY_PREFIX}{user_id}")
+    except Exception as e:
+        logger.error(f"Ошибка сброса состояния пользователя {user_id}: {e}")
+
+def claim_inflight(file_key, task_id, user_id):
+    """
+    Закрепляет файл за задачей. Если такой же файл уже обрабатывается,
+    возвращает task_id той задачи, иначе None.
+    
+    Отправитель сразу отмечается ожидающим: подключившиеся, пока файл
+    еще скачивается, не могут отменить задачу за него.
+    """
+    key = INFLIGHT_KEY_PREFIX + file_key
+    try:
+        existing_task_id = None
+        if not redis_conn.set(key, task_id, nx=True, ex=INFLIGHT_TTL):
+            existing_task_id = redis_conn.get(key)
+            if existing_task_id == task_id:
+                existing_task_id = None
+        
+        # Задача завершилась, не успев снять ключ: файл обрабатывается заново
+        if existing_task_id:
+            task_status = get_task_status(existing_task_id)
+            if task_status and task_status['status'] in TERMINAL_STATUSES:
+                redis_conn.set(key, task_id, ex=INFLIGHT_TTL)
+                existing_task_id = None
+        if existing_task_id:
+            return existing_task_id
+        
+        add_waiter(task_id, user_id)
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка проверки повторной обработки файла {file_key}: {e}")
+        return None
+
+def drop_inflight(file_key, task_id):
+    """
+    Снимает закрепление файла, если задачу не удалось поставить в очередь.
+    Подключившиеся к ней пользователи получают ошибку вместо ожидания.
+    """
+    try:
+        redis_conn.eval(_DELETE_IF_EQUAL, 1, INFLIGHT_KEY_PREFIX + file_key, task_id)
+        # Ожидающие есть только у закрепленной этой задачей отправки
+        if not redis_conn.exists(WAITERS_KEY_PREFIX + task_id):
+            return
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.hset(f"task:{task_id}", mapping={
+            'status': 'failed',
+            'message': 'Не удалось поставить файл в очередь. Отправьте его еще раз',
+            'updated_at': datetime.now().isoformat()
+        })
+        pipe.expire(f"task:{task_id}", 3600)
+        pipe.delete(WAITERS_KEY_PREFIX + task_id)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Ошибка снятия закрепления файла {file_key}: {e}")
+
+def cancel_task(task_id):
+    """
+    Отменяет задачу. Задача из очереди удаляется сразу вместе с файлами;
+    выполняющуюся воркер останавливает на границе ближайшей части.
+    Возвращает True, если задача еще не начала выполняться.
+    """
+    redis_conn.set(CANCEL_KEY_PREFIX + task_id, 1, ex=CANCEL_TTL)
+    try:
+        job = Job.fetch(task_id, connection=redis_conn_rq)
+    except NoSuchJobError:
+        return False
+    
+    if job.get_status() not in (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED):
+        return False
+    
+    job.cancel()
+    task_data = job.args[0] if job.args else {}
+    pipe = redis_conn.pipeline(transaction=True)
+    pipe.hset(f"task:{task_id}", mapping={
+        'status': 'cancelled',
+        'message': 'Задача отменена',
+        'updated_at': datetime.now().isoformat()
+    })
+    pipe.expire(f"task:{task_id}", 3600)
+    pipe.execute()
+    spool.release(task_id)
+    if task_data.get('inflight_key'):
+        redis_conn.eval(_DELETE_IF_EQUAL, 1, task_data['inflight_key'], task_id)
+    return True
+
+def file_sha256(path):
+    """SHA-256 содержимого файла (блокирующая функция)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def add_waiter(task_id, user_id):
+    """Отмечает пользователя ожидающим задачу (и доступной ему для /cancel)"""
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.sadd(WAITERS_KEY_PREFIX + task_id, user_id)
+    pipe.expire(WAITERS_KEY_PREFIX + task_id, USER_TASKS_TTL)
+    pipe.sadd(f"user:{user_id}:tasks", task_id)
+    pipe.expire(f"user:{user_id}:tasks", USER_TASKS_TTL)
+    pipe.execute()
+
+def leave_task(task_id, user_id):
+    """
+    Отключает пользователя от задачи; задача отменяется, если больше
+    ее никто не ждет. Возвращает True, если задача отменена.
+    """
+    pipe = redis_conn.pipeline(transaction=True)
+    pipe.srem(WAITERS_KEY_PREFIX + task_id, user_id)
+    pipe.scard(WAITERS_KEY_PREFIX + task_id)
+    _, remaining = pipe.execute()
+    if remaining:
+        return False
+    cancel_task(task_id)
+    return True
+
+def is_detached(task_id, user_id):
+    """Пользователь отключился от задачи, которую ждут другие"""
+    key = WAITERS_KEY_PREFIX + task_id
+    return bool(redis_conn.exists(key)) and not redis_conn.sismember(key, user_id)
+
+async def attach_to_inflight(existing_task_id, user_id, status_message):
+    """Подключает отправителя к уже идущей задаче с тем же файлом"""
+    try:
+        add_waiter(existing_task_id, user_id)
+    except Exception as e:
+        logger.error(f"Ошибка подключения к задаче {existing_task_id}: {e}")
+    logger.info(f"Пользователь {user_id} подключен к задаче {existing_task_id}")
+    outbound.edit_text(status_message, "⏳ Этот файл уже обрабатывается, подключаюсь к задаче...")
+    asyncio.create_task(monitor_task(existing_task_id, user_id, status_message))
+
+async def add_video_task(user_id, file_path, task_id, inflight_key=None):
     """Добавляет задачу обработки видео в очередь"""
     try:
         if not video_queue:
@@ -91,8 +310,22 @@ async def add_video_task(user_id, file_path, task_id):
             'created_at': datetime.now().isoformat()
         }
         
+        # Воркер снимает закрепление файла по завершении задачи
+        if inflight_key:
+            task_data['inflight_key'] = INFLIGHT_KEY_PREFIX + inflight_key
+        
+        # Администратор может включить профилирование задач командой /profile on
+        if redis_conn and redis_conn.get(PROFILING_ENABLED_KEY):
+            task_data['profile'] = True
+        
         # Добавляем задачу в очередь с увеличенным таймаутом
-        job = video_queue.enqueue('worker.process_video_sync', task_data, timeout=3600)  # 60 минут
+        with metrics.redis_latency_seconds.time(op='enqueue'):
+            job = video_queue.enqueue('worker.process_video_sync', task_data, timeout=3600, job_id=task_id)  # 60 минут
+        metrics.tasks_enqueued.inc()
+        
+        # Задачи пользователя для /cancel (отправка с закреплением файла
+        # отмечена еще при закреплении)
+        add_waiter(task_id, user_id)
         
         logger.info(f"Задача {task_id} добавлена в очередь для пользователя {user_id}")
         return job
@@ -100,6 +333,14 @@ async def add_video_task(user_id, file_path, task_id):
         logger.error(f"Ошибка добавления задачи в очередь: {e}")
         return None
 
+def job_exists(task_id):
+    """Задача есть в очереди RQ (поставлена, но еще не начата воркером)"""
+    try:
+        return Job.exists(task_id, connection=redis_conn_rq)
+    except Exception as e:
+        logger.error(f"Ошибка проверки задачи {task_id} в очереди: {e}")
+        return True
+
 def get_task_status(task_id):
     """Получает статус задачи из Redis"""
     try:
@@ -108,61 +349,111 @@ def get_task_status(task_id):
             return None
             
         task_key = f"task:{task_id}"
-        task_data = redis_conn.hgetall(task_key)
+        with metrics.redis_latency_seconds.time(op='get_status'):
+            task_data = redis_conn.hgetall(task_key)
         
         if task_data:
             return {
                 'status': task_data.get('status', 'unknown'),
                 'message': task_data.get('message', ''),
                 'result': task_data.get('result', ''),
-                'updated_at': task_data.get('updated_at', '')
+                'updated_at': task_data.get('updated_at', ''),
+                'refine_status': task_data.get('refine_status', ''),
+                'refined_result': task_data.get('refined_result', '')
             }
         return None
     except Exception as e:
         logger.error(f"Ошибка получения статуса задачи {task_id}: {e}")
         return None
 
-async def monitor_task(task_id, user_id, status_message):
+async def monitor_task(task_id, user_id, status_message, title=None):
     """Мониторит выполнение задачи и обновляет статус"""
     try:
         last_status = ""
+        loop = asyncio.get_running_loop()
+        missing_since = None
         
         while True:
             task_status = get_task_status(task_id)
             
             if not task_status:
+                # Записи задачи нет, пока она ждет в очереди или файл еще
+                # скачивается; задача, так и не появившаяся, потеряна
+                if missing_since is None or job_exists(task_id):
+                    missing_since = loop.time()
+                elif loop.time() - missing_since > TASK_MISSING_TIMEOUT:
+                    outbound.edit_text(status_message, "❌ Задача не найдена. Отправьте файл еще раз", final=True)
+                    break
                 await asyncio.sleep(5)
                 continue
             
             current_status = task_status['status']
             current_message = task_status['message']
             
-            # Обновляем статус только если он изменился
+            # Пользователь отменил задачу, которую продолжают ждать другие
+            if current_status not in TERMINAL_STATUSES and is_detached(task_id, user_id):
+                outbound.edit_text(status_message, "🚫 Вы отключены от задачи", final=True)
+                break
+            
+            # Обновляем статус только если он изменился; неотправленные
+            # промежуточные правки склеиваются планировщиком
             if current_message != last_status:
-                try:
-                    await status_message.edit_text(f"🔄 {current_message}")
-                    last_status = current_message
-                except Exception as e:
-                    logger.error(f"Ошибка обновления статуса: {e}")
+                outbound.edit_text(status_message, f"🔄 {current_message}")
+                last_status = current_message
             
             # Проверяем завершение задачи
             if current_status == 'completed':
                 # Задача завершена успешно
                 result_data = json.loads(task_status['result'])
-                await handle_task_completion(user_id, result_data, status_message)
+                if result_data.get('refine_pending'):
+                    await handle_task_completion(
+                        task_id, user_id, result_data, status_message,
+                        note="⏳ Это черновик: уточняю расшифровку более точной моделью...",
+                        title=title
+                    )
+                    await wait_for_refinement(task_id, user_id, result_data, status_message, title=title)
+                else:
+                    await handle_task_completion(task_id, user_id, result_data, status_message, title=title)
                 break
             elif current_status == 'failed':
                 # Задача завершена с ошибкой
-                await status_message.edit_text(f"❌ {current_message}")
+                outbound.edit_text(status_message, f"❌ {current_message}", final=True)
+                break
+            elif current_status == 'cancelled':
+                outbound.edit_text(status_message, "🚫 Задача отменена", final=True)
                 break
             
             await asyncio.sleep(3)  # Проверяем каждые 3 секунды
             
     except Exception as e:
         logger.error(f"Ошибка мониторинга задачи {task_id}: {e}")
-        await status_message.edit_text("❌ Произошла ошибка при мониторинге задачи")
+        outbound.edit_text(status_message, "❌ Произошла ошибка при мониторинге задачи", final=True)
+
+async def wait_for_refinement(task_id, user_id, draft_data, status_message, timeout=3 * 3600, title=None):
+    """
+    Ждет уточняющего прохода и заменяет черновик в сообщении и экспортах.
+    Если уточнение отменено (очередь выросла), черновик становится итогом.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        await asyncio.sleep(10)
+        task_status = get_task_status(task_id)
+        if not task_status:
+            break
+        if task_status['refine_status'] == 'completed':
+            refined_data = json.loads(task_status['refined_result'])
+            await handle_task_completion(
+                task_id, user_id, refined_data, status_message,
+                note=f"✨ Расшифровка уточнена моделью {refined_data.get('model')}",
+                title=title
+            )
+            return
+        if task_status['refine_status']:
+            break
+    await handle_task_completion(task_id, user_id, draft_data, status_message, title=title)
 
-async def handle_task_completion(user_id, result_data, status_message):
+async def handle_task_completion(task_id, user_id, result_data, status_message, note=None, title=None):
     """Обрабатывает завершение задачи"""
     try:
         # Отправляем результат
@@ -173,26 +464,84 @@ async def handle_task_completion(user_id, result_data, status_message):
             f"📜 <b>Полная расшифровка:</b>\n"
             f"{result_data['transcript'][:1000]}{'...' if len(result_data['transcript']) > 1000 else ''}"
         )
+        if note:
+            response_text += f"\n\n<i>{note}</i>"
         
-        await status_message.edit_text(response_text)
-        
-        # Отправляем файл с полными результатами
-        if 'output_file' in result_data and os.path.exists(result_data['output_file']):
-            with open(result_data['output_file'], 'rb') as f:
-                await bot.send_document(
-                    chat_id=user_id,
-                    document=types.BufferedInputFile(f.read(), filename=os.path.basename(result_data['output_file'])),
-                    caption="📄 Полная расшифровка с таймкодами"
-                )
-            # Удаляем временный файл результата
-            os.unlink(result_data['output_file'])
+        # Экспорты рендерятся по запросу из канонической записи воркера
+        reply_markup = None
+        record_file = result_data.get('record_file')
+        if record_file and os.path.exists(record_file):
+            export_cache.register_record(task_id, record_file)
+            reply_markup = build_export_keyboard(task_id)
+        
+        await outbound.edit_text(status_message, response_text, final=True, reply_markup=reply_markup)
+        
+        # Индекс для /find переживает запись воркера; уточненная
+        # расшифровка заменяет сегменты черновика
+        if reply_markup:
+            await index_transcript(user_id, task_id, record_file, title)
             
     except Exception as e:
         logger.error(f"Ошибка обработки завершения задачи: {e}")
-        await status_message.edit_text("❌ Ошибка при отправке результатов")
+        outbound.edit_text(status_message, "❌ Ошибка при отправке результатов", final=True)
+
+
+async def index_transcript(user_id, task_id, record_file, title=None):
+    """Добавляет расшифровку в поисковый индекс пользователя"""
+    try:
+        loop = asyncio.get_running_loop()
+        count = await loop.run_in_executor(None, search_index.add_transcript, user_id, task_id, record_file, title)
+        logger.info(f"Задача {task_id} проиндексирована для поиска: {count} сегментов")
+    except Exception as e:
+        logger.error(f"Ошибка индексации задачи {task_id}: {e}")
 
 
-async def download_file_from_url(url, max_size=500*1024*1024):
+def build_export_keyboard(task_id):
+    """Кнопки для выгрузки расшифровки в разных форматах"""
+    buttons = [
+        InlineKeyboardButton(text=f"📄 {label}", callback_data=f"export:{task_id}:{fmt}")
+        for fmt, (_, _, label) in EXPORT_FORMATS.items()
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
+async def export_eviction_loop(interval=300):
+    """Периодически удаляет устаревшие экспорты, записи и файлы без владельца"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            evicted = export_cache.evict_expired()
+            if evicted:
+                logger.info(f"Удалено устаревших записей расшифровок: {evicted}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки кэша экспортов: {e}")
+        try:
+            await loop.run_in_executor(None, spool.collect_garbage)
+        except Exception as e:
+            logger.error(f"Ошибка сборки файлов без владельца: {e}")
+
+
+async def wait_for_spool(status_message, expected_size=0):
+    """
+    Ждет места на общем томе перед скачиванием файла. Возвращает папку
+    для файла или None, если место так и не освободилось.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SPOOL_ADMISSION_WAIT
+    while True:
+        temp_dir = await loop.run_in_executor(None, spool.admit, expected_size)
+        if temp_dir or loop.time() >= deadline:
+            return temp_dir
+        outbound.edit_text(status_message, "⏳ Хранилище заполнено, ожидаю освобождения места...")
+        try:
+            await loop.run_in_executor(None, spool.collect_garbage)
+        except Exception as e:
+            logger.error(f"Ошибка сборки файлов без владельца: {e}")
+        await asyncio.sleep(5)
+
+
+async def download_file_from_url(url, max_size=500*1024*1024, temp_dir=None):
     """Скачивает файл по URL с проверкой размера"""
     try:
         # Увеличиваем лимиты для заголовков (для cloud.mail.ru)
@@ -247,7 +596,7 @@ async def download_file_from_url(url, max_size=500*1024*1024):
                                 file_name = 'yandex_disk_file'
                         
                         # Скачиваем файл
-                        temp_dir = '/tmp/shared' if os.path.exists('/tmp/shared') else '/tmp'
+                        temp_dir = temp_dir or ('/tmp/shared' if os.path.exists('/tmp/shared') else '/tmp')
                         with tempfile.NamedTemporaryFile(delete=False, dir=temp_dir) as tmp_file:
                             tmp_path = tmp_file.name
                             
@@ -296,7 +645,7 @@ async def download_file_from_url(url, max_size=500*1024*1024):
                     file_name = 'downloaded_file'
             
             # Скачиваем файл
-            temp_dir = '/tmp/shared' if os.path.exists('/tmp/shared') else '/tmp'
+            temp_dir = temp_dir or ('/tmp/shared' if os.path.exists('/tmp/shared') else '/tmp')
             with tempfile.NamedTemporaryFile(delete=False, dir=temp_dir) as tmp_file:
                 tmp_path = tmp_file.name
                 
@@ -559,7 +908,9 @@ async def command_start_handler(message: Message) -> None:
         f"• /start - показать это сообщение\n"
         f"• /ping - проверить работу бота\n"
         f"• /help - подробная справка\n"
-        f"• /status - статус системы\n\n"
+        f"• /status - статус системы\n"
+        f"• /cancel - отменить обработку своих файлов\n"
+        f"• /find - найти фразу в прошлых расшифровках\n\n"
         f"<b>Как использовать:</b>\n"
         f"Отправьте мне видео/аудио файл, ZIP архив или ссылку на файл, и я создам расшифровку с кратким содержанием!\n\n"
         f"📎 Файлы до 20 МБ - прикрепите напрямую\n"
@@ -578,6 +929,26 @@ async def ping_handler(message: Message) -> None:
     await message.answer(f"pong _ (Твой ID: {user_id})")
 
 
+def get_workers_stats():
+    """Живые воркеры из реестра RQ и пропускная способность за текущий час"""
+    workers = Worker.all(queue=video_queue)
+    busy = sum(1 for worker in workers if worker.get_state() == 'busy')
+    
+    hour_key = metrics.WORKER_HOURLY_KEY_PREFIX + datetime.utcnow().strftime('%Y%m%d%H')
+    hourly = redis_conn.hgetall(hour_key)
+    processing_seconds = float(hourly.get('processing_seconds', 0))
+    audio_seconds = float(hourly.get('audio_seconds', 0))
+    return {
+        'alive': len(workers),
+        'busy': busy,
+        'jobs_completed': int(float(hourly.get('jobs_completed', 0))),
+        'jobs_failed': int(float(hourly.get('jobs_failed', 0))),
+        'audio_minutes': audio_seconds / 60,
+        # Сколько секунд аудио обрабатывается за секунду работы воркера
+        'speed': audio_seconds / processing_seconds if processing_seconds else 0,
+    }
+
+
 @dp.message(Command('status'))
 async def status_handler(message: Message) -> None:
     """
@@ -594,13 +965,22 @@ async def status_handler(message: Message) -> None:
             # Проверяем подключение к Redis
             redis_conn.ping()
             queue_length = len(video_queue)
+            stats = get_workers_stats()
+            
+            if stats['alive']:
+                workers_line = f"• Воркеры: {stats['alive']} (заняты: {stats['busy']})\n"
+            else:
+                workers_line = "• Воркеры: ❗ нет активных воркеров\n"
             
             status_text = (
-                f"🟢 <b>Статус системы</b>\n\n"
+                f"{'🟢' if stats['alive'] else '🟡'} <b>Статус системы</b>\n\n"
                 f"• Redis: подключен\n"
                 f"• Очередь обработки: {queue_length} задач\n"
-                f"• Воркеры: активны\n"
-                f"• Система: работает нормально"
+                f"{workers_line}"
+                f"• За текущий час: {stats['jobs_completed']} готово, {stats['jobs_failed']} с ошибкой\n"
+                f"• Обработано аудио: {stats['audio_minutes']:.1f} мин "
+                f"(скорость {stats['speed']:.1f}× от реального времени)\n"
+                f"• Система: {'работает нормально' if stats['alive'] else 'задачи не обрабатываются'}"
             )
     except Exception as e:
         status_text = (
@@ -613,6 +993,196 @@ async def status_handler(message: Message) -> None:
     await message.answer(status_text)
 
 
+def format_profile_report(report):
+    """Краткое текстовое представление отчета профилирования"""
+    lines = [
+        f"task {report['task_id']}",
+        f"wall {report['wall_seconds']}s, cpu {report['cpu_seconds']}s, rss peak {report['rss_peak_mb']} MB",
+        "",
+        "stage              calls   wall    cpu  py_peak  rss_peak",
+    ]
+    for name, stage in list(report['stages'].items()) + list(report['ffmpeg'].items()):
+        cpu = stage['cpu_seconds'] + stage.get('children_cpu_seconds', 0)
+        lines.append(
+            f"{name[:18]:<18} {stage['calls']:>5} {stage['wall_seconds']:>6.1f} {cpu:>6.1f}"
+            f" {stage['tracemalloc_peak_mb']:>7.1f}M {stage['rss_peak_mb']:>7.1f}M"
+        )
+    lines += ["", "top functions (tottime / cumtime):"]
+    for row in report['top_functions'][:10]:
+        lines.append(f"{row['tottime']:>7.2f} {row['cumtime']:>7.2f} {row['function'][:60]}")
+    return "\n".join(lines)
+
+
+@dp.message(Command('profile'))
+async def profile_handler(message: Message) -> None:
+    """
+    Обработчик команды /profile (только для администратора)
+    """
+    if not ADMIN_USER_ID or message.from_user.id != ADMIN_USER_ID:
+        await message.answer("⛔ Команда доступна только администратору.")
+        return
+    
+    if not redis_conn:
+        await message.answer("❌ Redis не инициализирован")
+        return
+    
+    args = (message.text or "").split()[1:]
+    
+    if args and args[0] in ('on', 'off'):
+        if args[0] == 'on':
+            redis_conn.set(PROFILING_ENABLED_KEY, 1)
+            await message.answer("🔬 Профилирование новых задач включено.")
+        else:
+            redis_conn.delete(PROFILING_ENABLED_KEY)
+            await message.answer("🔬 Профилирование новых задач выключено.")
+        return
+    
+    if not args:
+        task_ids = redis_conn.lrange(PROFILE_RECENT_KEY, 0, -1)
+        enabled = "включено" if redis_conn.get(PROFILING_ENABLED_KEY) else "выключено"
+        if not task_ids:
+            await message.answer(f"🔬 Профилирование {enabled}. Отчетов пока нет.\n\n/profile on|off - включить или выключить")
+            return
+        lines = [f"🔬 Профилирование {enabled}. Последние отчеты:\n"]
+        for task_id in task_ids:
+            lines.append(f"<code>{task_id}</code>")
+        lines.append("\n/profile &lt;task_id&gt; - показать отчет")
+        await message.answer("\n".join(lines))
+        return
+    
+    raw_report = redis_conn.get(PROFILE_KEY_PREFIX + args[0])
+    if not raw_report:
+        await message.answer("❌ Отчет не найден или устарел")
+        return
+    
+    text = format_profile_report(json.loads(raw_report))
+    await message.answer(f"<pre>{html.escape(text)}</pre>")
+
+
+@dp.message(Command('cancel'))
+async def cancel_handler(message: Message) -> None:
+    """
+    Обработчик команды /cancel [task_id]: без аргумента отменяет все
+    незавершенные задачи пользователя; администратор может отменить любую.
+    Задача, которую ждут и другие пользователи, не отменяется: пользователь
+    только отключается от нее
+    """
+    if not redis_conn:
+        await message.answer("❌ Redis не инициализирован")
+        return
+    
+    user_id = message.from_user.id
+    user_tasks_key = f"user:{user_id}:tasks"
+    is_admin = ADMIN_USER_ID and user_id == ADMIN_USER_ID
+    args = (message.text or "").split()[1:]
+    
+    if args:
+        if not is_admin and not redis_conn.sismember(user_tasks_key, args[0]):
+            await message.answer("❌ Задача не найдена")
+            return
+        task_ids = [args[0]]
+    else:
+        task_ids = list(redis_conn.smembers(user_tasks_key))
+    
+    cancelled = 0
+    detached = 0
+    for task_id in task_ids:
+        task_status = get_task_status(task_id)
+        if task_status and task_status['status'] in TERMINAL_STATUSES:
+            redis_conn.srem(user_tasks_key, task_id)
+            continue
+        try:
+            # Администратор отменяет чужую задачу явно, независимо от ожидающих
+            if is_admin and args and not redis_conn.sismember(user_tasks_key, task_id):
+                cancel_task(task_id)
+                redis_conn.delete(WAITERS_KEY_PREFIX + task_id)
+                cancelled += 1
+                logger.info(f"Задача {task_id} отменена пользователем {user_id}")
+            elif leave_task(task_id, user_id):
+                cancelled += 1
+                logger.info(f"Задача {task_id} отменена пользователем {user_id}")
+            else:
+                detached += 1
+                logger.info(f"Пользователь {user_id} отключен от задачи {task_id}")
+        except Exception as e:
+            logger.error(f"Ошибка отмены задачи {task_id}: {e}")
+        redis_conn.srem(user_tasks_key, task_id)
+    
+    if cancelled or detached:
+        lines = []
+        if cancelled:
+            lines.append(f"🚫 Отменено задач: {cancelled}")
+        if detached:
+            lines.append(f"🔌 Отключено от задач, которые ждут другие пользователи: {detached}")
+        await message.answer("\n".join(lines))
+    else:
+        await message.answer("Нет задач для отмены.")
+
+
+# Лимит длины сообщения Telegram и длина названия файла в выдаче /find
+TELEGRAM_MESSAGE_LIMIT = 4096
+SEARCH_TITLE_CHARS = 80
+
+def format_search_hit(hit):
+    """Фрагмент найденной расшифровки для сообщения (HTML)"""
+    seconds = int(hit['start'])
+    timecode = f"{seconds // 3600:02}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+    title = hit['title'] or hit['task_id']
+    if len(title) > SEARCH_TITLE_CHARS:
+        title = title[:SEARCH_TITLE_CHARS - 1] + '…'
+    title = html.escape(title)
+    snippet = html.escape(hit['snippet']).replace(MATCH_START, '<b>').replace(MATCH_END, '</b>')
+    return f"🎧 <b>{title}</b> · {timecode}\n{snippet}"
+
+def split_message(blocks, limit=TELEGRAM_MESSAGE_LIMIT, separator="\n\n"):
+    """Склеивает блоки в сообщения не длиннее limit, не разрывая блок"""
+    messages = []
+    current = ""
+    for block in blocks:
+        block = block[:limit]
+        if current and len(current) + len(separator) + len(block) > limit:
+            messages.append(current)
+            current = block
+        else:
+            current = current + separator + block if current else block
+    if current:
+        messages.append(current)
+    return messages
+
+
+@dp.message(Command('find'))
+async def find_handler(message: Message) -> None:
+    """
+    Обработчик команды /find <запрос>: поиск по всем прошлым
+    расшифровкам пользователя
+    """
+    user_id = message.from_user.id
+    query = (message.text or "").partition(' ')[2].strip()
+    loop = asyncio.get_running_loop()
+    
+    try:
+        if not query:
+            count, seconds = await loop.run_in_executor(None, search_index.stats, user_id)
+            await message.answer(
+                "🔎 <b>Поиск по расшифровкам</b>\n\n"
+                "Использование: <code>/find слова или фраза</code>\n"
+                f"В индексе: {count} расшифровок, {int(seconds) // 60} мин."
+            )
+            return
+        
+        hits = await loop.run_in_executor(None, search_index.search, user_id, query)
+        if not hits:
+            await message.answer("Ничего не найдено.")
+            return
+        
+        blocks = [f"🔎 Найдено фрагментов: {len(hits)}"] + [format_search_hit(hit) for hit in hits]
+        for text in split_message(blocks):
+            await message.answer(text)
+    except Exception as e:
+        logger.error(f"Ошибка поиска для пользователя {user_id}: {e}")
+        await message.answer("❌ Ошибка поиска")
+
+
 @dp.message(Command('help'))
 async def help_handler(message: Message) -> None:
     """
@@ -637,6 +1207,9 @@ async def help_handler(message: Message) -> None:
         "4. Создает расшифровку с помощью AI\n"
         "5. Делает краткое содержание\n"
         "6. Отправляет результат с таймкодами\n\n"
+        "<b>Поиск по расшифровкам:</b>\n"
+        "<code>/find слова или фраза</code> - найдет фрагменты с таймкодами "
+        "во всех ваших прошлых расшифровках\n\n"
         "<b>Ограничения:</b>\n"
         "• Файлы через Telegram: до 20 МБ\n"
         "• Файлы по ссылке: до 500 МБ\n"
@@ -656,11 +1229,6 @@ async def media_handler(message: Message) -> None:
     """
     user_id = message.from_user.id
     
-    # Проверяем, не обрабатывается ли уже файл от этого пользователя
-    if user_id in user_states and user_states[user_id].get('processing'):
-        await message.answer("⏳ Пожалуйста, подождите. Ваш предыдущий файл еще обрабатывается.")
-        return
-    
     # Определяем тип файла
     file_info = None
     file_name = None
@@ -668,9 +1236,11 @@ async def media_handler(message: Message) -> None:
     if message.content_type == 'video':
         file_info = message.video
         file_name = f"video_{user_id}_{message.message_id}.mp4"
+        clean_file_name = file_name
     elif message.content_type == 'audio':
         file_info = message.audio
         file_name = f"audio_{user_id}_{message.message_id}.mp3"
+        clean_file_name = file_name
     elif message.content_type == 'document':
         file_info = message.document
         file_name = message.document.file_name or f"document_{user_id}_{message.message_id}"
@@ -701,18 +1271,36 @@ async def media_handler(message: Message) -> None:
     
 
     
-    # Устанавливаем состояние обработки
-    user_states[user_id] = {'processing': True}
+    # Проверяем и устанавливаем состояние обработки одной операцией,
+    # чтобы два апдейта на разных репликах не прошли проверку одновременно
+    if not acquire_user_slot(user_id):
+        await message.answer("⏳ Пожалуйста, подождите. Ваш предыдущий файл еще обрабатывается.")
+        return
     
     # Отправляем сообщение о начале обработки
     status_message = await message.answer("📥 Загружаю файл...")
     
+    # Генерируем уникальный ID задачи: под ним учитываются все ее файлы
+    task_id = str(uuid.uuid4())
+    job = None
+    
+    # Один и тот же файл Telegram имеет постоянный file_unique_id
+    inflight_key = f"tg:{file_info.file_unique_id}"
+    
     try:
+        existing_task_id = claim_inflight(inflight_key, task_id, user_id)
+        if existing_task_id:
+            await attach_to_inflight(existing_task_id, user_id, status_message)
+            return
+        
         # Получаем файл
         file = await bot.get_file(file_info.file_id)
         
-        # Создаем временный файл в shared volume
-        temp_dir = '/tmp/shared' if os.path.exists('/tmp/shared') else '/tmp'
+        # Выбираем папку для файла с учетом свободного места
+        temp_dir = await wait_for_spool(status_message, file_info.file_size)
+        if temp_dir is None:
+            outbound.edit_text(status_message, "❌ Хранилище временно заполнено. Попробуйте позже.", final=True)
+            return
         # Для документов используем очищенное имя файла для получения правильного расширения
         if message.content_type == 'document' and file_name:
             clean_file_name = file_name.rstrip('_')
@@ -722,57 +1310,60 @@ async def media_handler(message: Message) -> None:
         
         with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=temp_dir) as tmp_file:
             tmp_path = tmp_file.name
+            spool.register(task_id, tmp_path)
             
             # Скачиваем файл
-            await status_message.edit_text("📥 Скачиваю файл...")
-            await bot.download_file(file.file_path, tmp_path)
+            outbound.edit_text(status_message, "📥 Скачиваю файл...")
+            with metrics.download_seconds.time(source='telegram'):
+                await bot.download_file(file.file_path, tmp_path)
             
             # Проверяем, является ли файл ZIP архивом
             final_file_path = tmp_path
+            title = file_name
             if clean_file_name.lower().endswith('.zip'):
-                await status_message.edit_text("📦 Распаковываю архив...")
+                outbound.edit_text(status_message, "📦 Распаковываю архив...")
                 extract_dir = tmp_path + '_extracted'
+                spool.register(task_id, extract_dir)
                 result = extract_zip_and_find_media(tmp_path, extract_dir)
                 
                 if result[0] is None:
-                    await status_message.edit_text(f"❌ {result[1]}")
+                    outbound.edit_text(status_message, f"❌ {result[1]}", final=True)
                     # Удаляем временные файлы
-                    os.unlink(tmp_path)
-                    if os.path.exists(extract_dir):
-                        shutil.rmtree(extract_dir)
+                    spool.release(task_id)
                     return
                 
                 # Получаем путь к медиа-файлу
                 media_file_path, media_file_name = result[0]
                 final_file_path = media_file_path
+                title = media_file_name
                 
-                await status_message.edit_text(f"📦 {result[1]}")
+                outbound.edit_text(status_message, f"📦 {result[1]}")
                 await asyncio.sleep(1)  # Показываем сообщение пользователю
             
-            # Генерируем уникальный ID задачи
-            task_id = str(uuid.uuid4())
-            
             # Добавляем задачу в очередь
-            await status_message.edit_text("📋 Добавляю в очередь обработки...")
-            job = await add_video_task(user_id, final_file_path, task_id)
+            outbound.edit_text(status_message, "📋 Добавляю в очередь обработки...")
+            job = await add_video_task(user_id, final_file_path, task_id, inflight_key)
             
             if job:
-                await status_message.edit_text("⏳ Задача добавлена в очередь. Ожидание обработки...")
+                outbound.edit_text(status_message, "⏳ Задача добавлена в очередь. Ожидание обработки...")
                 
                 # Запускаем мониторинг задачи
-                asyncio.create_task(monitor_task(task_id, user_id, status_message))
+                asyncio.create_task(monitor_task(task_id, user_id, status_message, title))
             else:
-                await status_message.edit_text("❌ Ошибка добавления задачи в очередь")
-                # Примечание: Временные файлы остаются для возможной отладки
+                outbound.edit_text(status_message, "❌ Ошибка добавления задачи в очередь", final=True)
+                spool.release(task_id)
                 
     except Exception as e:
         logger.error(f"Ошибка обработки файла: {e}")
-        await status_message.edit_text(f"❌ Произошла ошибка: {str(e)}")
+        outbound.edit_text(status_message, f"❌ Произошла ошибка: {str(e)}", final=True)
+        if not job:
+            spool.release(task_id)
     
     finally:
         # Сбрасываем состояние обработки
-        if user_id in user_states:
-            user_states[user_id]['processing'] = False
+        release_user_slot(user_id)
+        if not job and inflight_key:
+            drop_inflight(inflight_key, task_id)
         
         # Примечание: Временные файлы будут очищены воркером после обработки
 
@@ -785,29 +1376,40 @@ async def url_handler(message: Message) -> None:
     user_id = message.from_user.id
     url = message.text.strip()
     
-    # Проверяем, не обрабатывается ли уже файл от этого пользователя
-    if user_id in user_states and user_states[user_id].get('processing'):
+    # Проверяем, не обрабатывается ли уже файл от этого пользователя,
+    # и устанавливаем состояние обработки
+    if not acquire_user_slot(user_id):
         await message.answer("⏳ Пожалуйста, подождите. Ваш предыдущий файл еще обрабатывается.")
         return
     
-    # Устанавливаем состояние обработки
-    user_states[user_id] = {'processing': True}
-    
     # Отправляем сообщение о начале обработки
     status_message = await message.answer("🔗 Анализирую ссылку...")
     
+    # Генерируем уникальный ID задачи: под ним учитываются все ее файлы
+    task_id = str(uuid.uuid4())
+    job = None
+    inflight_key = None
+    
     try:
         # Преобразуем ссылку облачного хранилища в прямую ссылку
-        await status_message.edit_text("🔗 Обрабатываю ссылку...")
+        outbound.edit_text(status_message, "🔗 Обрабатываю ссылку...")
         direct_url = await convert_cloud_url_to_direct(url)
         
+        # Размер заранее неизвестен, поэтому файл всегда идет на основной том
+        temp_dir = await wait_for_spool(status_message)
+        if temp_dir is None:
+            outbound.edit_text(status_message, "❌ Хранилище временно заполнено. Попробуйте позже.", final=True)
+            return
+        
         # Скачиваем файл по прямой ссылке
-        await status_message.edit_text("📥 Скачиваю файл...")
-        tmp_path, file_name = await download_file_from_url(direct_url)
+        outbound.edit_text(status_message, "📥 Скачиваю файл...")
+        with metrics.download_seconds.time(source='url'):
+            tmp_path, file_name = await download_file_from_url(direct_url, temp_dir=temp_dir)
         
         if not tmp_path:
-            await status_message.edit_text(f"❌ {file_name}")
+            outbound.edit_text(status_message, f"❌ {file_name}", final=True)
             return
+        spool.register(task_id, tmp_path)
         
         # Отбрасываем последние символы подчеркивания из имени файла
         clean_file_name = file_name.rstrip('_')
@@ -815,64 +1417,124 @@ async def url_handler(message: Message) -> None:
         # Проверяем расширение файла
         allowed_extensions = ['.mp4', '.avi', '.mov', '.mkv', '.wmv', '.webm', '.mp3', '.wav', '.m4a', '.ogg', '.flac', '.zip']
         if not any(clean_file_name.lower().endswith(ext) for ext in allowed_extensions):
-            await status_message.edit_text(
+            outbound.edit_text(
+                status_message,
                 "❌ Неподдерживаемый формат файла.\n\n"
                 "Поддерживаемые форматы:\n"
                 "• Видео: MP4, AVI, MOV, MKV, WMV, WEBM\n"
                 "• Аудио: MP3, WAV, M4A, OGG, FLAC\n"
-                "• Архивы: ZIP (с медиа-файлами внутри)"
+                "• Архивы: ZIP (с медиа-файлами внутри)",
+                final=True
             )
             # Удаляем временный файл
-            os.unlink(tmp_path)
+            spool.release(task_id)
+            return
+        
+        # По ссылкам один файл приходит с разных адресов: сравниваем содержимое
+        loop = asyncio.get_running_loop()
+        inflight_key = f"sha256:{await loop.run_in_executor(None, file_sha256, tmp_path)}"
+        existing_task_id = claim_inflight(inflight_key, task_id, user_id)
+        if existing_task_id:
+            spool.release(task_id)
+            await attach_to_inflight(existing_task_id, user_id, status_message)
             return
         
         # Проверяем, является ли файл ZIP архивом
         final_file_path = tmp_path
+        title = file_name
         if clean_file_name.lower().endswith('.zip'):
-            await status_message.edit_text("📦 Распаковываю архив...")
+            outbound.edit_text(status_message, "📦 Распаковываю архив...")
             extract_dir = tmp_path + '_extracted'
+            spool.register(task_id, extract_dir)
             result = extract_zip_and_find_media(tmp_path, extract_dir)
             
             if result[0] is None:
-                await status_message.edit_text(f"❌ {result[1]}")
-                # Примечание: Временные файлы остаются для возможной отладки
+                outbound.edit_text(status_message, f"❌ {result[1]}", final=True)
+                spool.release(task_id)
                 return
             
             # Получаем путь к медиа-файлу
             media_file_path, media_file_name = result[0]
             final_file_path = media_file_path
+            title = media_file_name
             
-            await status_message.edit_text(f"📦 {result[1]}")
+            outbound.edit_text(status_message, f"📦 {result[1]}")
             await asyncio.sleep(1)  # Показываем сообщение пользователю
         
-        # Генерируем уникальный ID задачи
-        task_id = str(uuid.uuid4())
-        
         # Добавляем задачу в очередь
-        await status_message.edit_text("📋 Добавляю в очередь обработки...")
-        job = await add_video_task(user_id, final_file_path, task_id)
+        outbound.edit_text(status_message, "📋 Добавляю в очередь обработки...")
+        job = await add_video_task(user_id, final_file_path, task_id, inflight_key)
         
         if job:
-            await status_message.edit_text("⏳ Задача добавлена в очередь. Ожидание обработки...")
+            outbound.edit_text(status_message, "⏳ Задача добавлена в очередь. Ожидание обработки...")
             
             # Запускаем мониторинг задачи
-            asyncio.create_task(monitor_task(task_id, user_id, status_message))
+            asyncio.create_task(monitor_task(task_id, user_id, status_message, title))
         else:
-            await status_message.edit_text("❌ Ошибка добавления задачи в очередь")
-            # Примечание: Временные файлы остаются для возможной отладки
+            outbound.edit_text(status_message, "❌ Ошибка добавления задачи в очередь", final=True)
+            spool.release(task_id)
             
     except Exception as e:
         logger.error(f"Ошибка обработки URL: {e}")
-        await status_message.edit_text(f"❌ Произошла ошибка: {str(e)}")
+        outbound.edit_text(status_message, f"❌ Произошла ошибка: {str(e)}", final=True)
+        if not job:
+            spool.release(task_id)
     
     finally:
         # Сбрасываем состояние обработки
-        if user_id in user_states:
-            user_states[user_id]['processing'] = False
+        release_user_slot(user_id)
+        if not job and inflight_key:
+            drop_inflight(inflight_key, task_id)
         
         # Примечание: Временные файлы будут очищены воркером после обработки
 
 
+@dp.callback_query(F.data.startswith('export:'))
+async def export_handler(callback: CallbackQuery) -> None:
+    """
+    Обработчик кнопок выгрузки расшифровки
+    """
+    try:
+        _, task_id, fmt = callback.data.split(':', 2)
+    except ValueError:
+        await callback.answer("Некорректный запрос")
+        return
+    
+    if fmt not in EXPORT_FORMATS:
+        await callback.answer("Неизвестный формат")
+        return
+    
+    # После перезапуска бота восстанавливаем путь к записи из Redis
+    if export_cache.get_record(task_id) is None:
+        task_status = get_task_status(task_id)
+        if task_status and task_status['result']:
+            record_file = json.loads(task_status['result']).get('record_file')
+            if record_file and os.path.exists(record_file):
+                export_cache.register_record(task_id, record_file)
+    
+    try:
+        loop = asyncio.get_running_loop()
+        export_path = await loop.run_in_executor(None, export_cache.render, task_id, fmt)
+        # Запись нужна, пока к ней обращаются: продлеваем ее и на общем томе
+        spool.touch(task_id, EXPORT_TTL)
+    except Exception as e:
+        logger.error(f"Ошибка экспорта задачи {task_id} в {fmt}: {e}")
+        await callback.answer("❌ Ошибка при создании файла")
+        return
+    
+    if export_path is None:
+        await callback.answer("⌛ Результат устарел. Отправьте файл заново.", show_alert=True)
+        return
+    
+    await callback.answer()
+    await outbound.send_document(
+        bot,
+        callback.message.chat.id,
+        document=types.FSInputFile(export_path, filename=f"transcript_{task_id[:8]}{EXPORT_FORMATS[fmt][0]}"),
+        caption=f"📄 Расшифровка с таймкодами ({EXPORT_FORMATS[fmt][2]})"
+    )
+
+
 @dp.message()
 async def echo_handler(message: Message) -> None:
     """
@@ -913,6 +1575,54 @@ async def send_startup_notification() -> None:
             logger.error(f"Ошибка при отправке уведомления администратору: {e}")
 
 
+async def start_metrics_server():
+    """Запускает HTTP эндпоинт /metrics"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics.metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', metrics.METRICS_PORT).start()
+    logger.info(f"Эндпоинт метрик запущен на порту {metrics.METRICS_PORT}")
+    return runner
+
+
+async def health_handler(request):
+    return web.Response(text="ok")
+
+
+async def run_webhook():
+    """
+    Принимает апдейты через вебхук. Реплик может быть несколько: общее
+    состояние (очередь, статусы задач, состояния пользователей) лежит в Redis.
+    """
+    if not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL не задан для режима webhook. Завершение работы.")
+        return
+    
+    app = web.Application()
+    app.router.add_get('/health', health_handler)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    
+    # Повторная установка тем же адресом безопасна, поэтому ее выполняет
+    # каждая реплика при старте
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"Вебхук запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main() -> None:
     """
     Основная функция для запуска бота
@@ -924,14 +1634,28 @@ async def main() -> None:
         logger.error("Не удалось подключиться к Redis. Завершение работы.")
         return
     
-    # Удаляем старые апдейты
-    await bot.delete_webhook(drop_pending_updates=True)
+    try:
+        await start_metrics_server()
+    except Exception as e:
+        logger.error(f"Не удалось запустить эндпоинт метрик: {e}")
+    
+    # Запускаем очередь исходящих сообщений
+    outbound.start()
     
     # Отправляем уведомление о запуске
     await send_startup_notification()
     
-    # Запускаем polling
-    await dp.start_polling(bot)
+    # Запускаем очистку устаревших экспортов
+    asyncio.create_task(export_eviction_loop())
+    
+    if BOT_MODE == 'webhook':
+        await run_webhook()
+    else:
+        # Удаляем старые апдейты
+        await bot.delete_webhook(drop_pending_updates=True)
+        
+        # Запускаем polling
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
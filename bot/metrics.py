@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Порт HTTP эндпоинта /metrics бота
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+
+# Ключи метрик воркера в Redis (см. worker/metrics.py)
+WORKER_HOURLY_KEY_PREFIX = 'metrics:worker:hour:'
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    inner = ",".join(f'{key}="{value}"' for key, value in labels)
+    return f"{name}{{{inner}}}"
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values = {}  # labels -> [счетчики бакетов..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        row = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[idx] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, row in sorted(self.values.items()):
+            for idx, bound in enumerate(self.buckets):
+                lines.append(f"{_series(self.name + '_bucket', labels + (('le', bound),))} {row[idx]}")
+            lines.append(f"{_series(self.name + '_bucket', labels + (('le', '+Inf'),))} {row[-1]}")
+            lines.append(f"{_series(self.name + '_sum', labels)} {row[-2]}")
+            lines.append(f"{_series(self.name + '_count', labels)} {row[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{_series(self.name, labels)} {value}" for labels, value in sorted(self.values.items()))
+        return lines
+
+
+download_seconds = Histogram('bot_download_seconds', 'Время скачивания входного файла')
+telegram_api_seconds = Histogram('telegram_api_seconds', 'Задержка запросов к Telegram Bot API')
+telegram_api_errors = Counter('telegram_api_errors_total', 'Ошибки запросов к Telegram Bot API')
+redis_latency_seconds = Histogram('redis_latency_seconds', 'Задержка операций Redis')
+tasks_enqueued = Counter('bot_tasks_enqueued_total', 'Задачи, поставленные в очередь')
+
+REGISTRY = [download_seconds, telegram_api_seconds, telegram_api_errors, redis_latency_seconds, tasks_enqueued]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        if metric.values:
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class TelegramLatencyMiddleware(BaseRequestMiddleware):
+    """Замеряет задержку каждого запроса бота к Telegram API"""
+
+    async def __call__(self, make_request, bot, method):
+        method_name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            telegram_api_errors.inc(method=method_name, error=type(e).__name__)
+            raise
+        finally:
+            telegram_api_seconds.observe(time.perf_counter() - started, method=method_name)
+
+
+async def metrics_handler(request):
+    from aiohttp import web
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
@@ -0,0 +1,164 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду на чат
+GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 25))
+CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+
+# Меньшее значение - выше приоритет
+PRIORITY_FINAL = 0
+PRIORITY_PROGRESS = 1
+
+
+def _log_failure(future):
+    # Промежуточные правки никто не ждет: ошибки логируются здесь
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Ошибка отправки в Telegram: {future.exception()}")
+
+
+class _Outgoing:
+    __slots__ = ('factory', 'chat_id', 'priority', 'seq', 'key', 'future')
+
+    def __init__(self, factory, chat_id, priority, seq, key, future):
+        self.factory = factory
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.future = future
+
+
+class OutboundScheduler:
+    """
+    Единая очередь исходящих запросов к Telegram.
+
+    Соблюдает общий и поканальный лимиты, склеивает еще не отправленные
+    правки одного и того же сообщения (уходит только последний текст),
+    выдерживает retry_after при 429 и отправляет финальные результаты
+    раньше промежуточных статусов.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE):
+        self.global_interval = 1.0 / global_rate
+        self.chat_interval = 1.0 / chat_rate
+        self._pending = {}  # key -> _Outgoing
+        self._seq = itertools.count()
+        self._chat_ready_at = {}
+        self._global_ready_at = 0.0
+        self._in_flight_chats = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, factory, chat_id, priority=PRIORITY_PROGRESS, key=None):
+        """
+        Ставит запрос в очередь. factory - функция без аргументов,
+        возвращающая корутину запроса. Запрос с тем же key, еще не ушедший
+        в Telegram, заменяется новым. Возвращает future с результатом.
+        """
+        if key is None:
+            key = ('call', next(self._seq))
+        existing = self._pending.get(key)
+        if existing is not None:
+            existing.factory = factory
+            existing.priority = min(existing.priority, priority)
+            self._wakeup.set()
+            return existing.future
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+        self._pending[key] = _Outgoing(factory, chat_id, priority, next(self._seq), key, future)
+        self._wakeup.set()
+        return future
+
+    def edit_text(self, message, text, final=False, **kwargs):
+        """Правка сообщения; незавершенные правки того же сообщения склеиваются"""
+        return self.submit(
+            lambda: message.edit_text(text, **kwargs),
+            message.chat.id,
+            PRIORITY_FINAL if final else PRIORITY_PROGRESS,
+            key=('edit', message.chat.id, message.message_id),
+        )
+
+    def send_document(self, bot, chat_id, document, **kwargs):
+        return self.submit(lambda: bot.send_document(chat_id=chat_id, document=document, **kwargs), chat_id, PRIORITY_FINAL)
+
+    def send_message(self, bot, chat_id, text, final=True, **kwargs):
+        return self.submit(
+            lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs),
+            chat_id,
+            PRIORITY_FINAL if final else PRIORITY_PROGRESS,
+        )
+
+    def _next_ready(self, now):
+        """Лучший по приоритету запрос, чей чат и глобальный лимит свободны"""
+        best = None
+        wait = None
+        for item in self._pending.values():
+            if item.chat_id in self._in_flight_chats:
+                continue
+            ready_at = max(self._chat_ready_at.get(item.chat_id, 0.0), self._global_ready_at)
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            if best is None or (item.priority, item.seq) < (best.priority, best.seq):
+                best = item
+        return best, wait
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            item, wait = self._next_ready(now)
+            if item is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            del self._pending[item.key]
+            self._in_flight_chats.add(item.chat_id)
+            self._chat_ready_at[item.chat_id] = now + self.chat_interval
+            self._global_ready_at = now + self.global_interval
+            asyncio.create_task(self._send(item))
+
+    async def _send(self, item):
+        try:
+            result = await item.factory()
+        except TelegramRetryAfter as e:
+            logger.warning(f"Лимит Telegram для чата {item.chat_id}: повтор через {e.retry_after} с")
+            self._chat_ready_at[item.chat_id] = time.monotonic() + e.retry_after
+            # Пока запрос ждал, его могла заменить более свежая правка
+            newer = self._pending.get(item.key)
+            if newer is None:
+                self._pending[item.key] = item
+            elif newer.future is not item.future:
+                item.future.set_result(None)
+            return
+        except TelegramBadRequest as e:
+            # Правка тем же текстом - не ошибка
+            if 'message is not modified' in str(e):
+                item.future.set_result(None)
+            else:
+                item.future.set_exception(e)
+            return
+        except Exception as e:
+            item.future.set_exception(e)
+            return
+        finally:
+            self._in_flight_chats.discard(item.chat_id)
+            self._wakeup.set()
+
+        if not item.future.done():
+            item.future.set_result(result)
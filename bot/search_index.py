@@ -0,0 +1,183 @@
+import os
+import re
+import sqlite3
+import logging
+from datetime import datetime
+
+from exports import read_record
+
+logger = logging.getLogger(__name__)
+
+# Папка с индексами пользователей (том, переживающий перезапуски бота)
+SEARCH_INDEX_DIR = os.getenv('SEARCH_INDEX_DIR', '/data/search')
+
+# Сколько фрагментов возвращает поиск
+SEARCH_RESULTS_LIMIT = int(os.getenv('SEARCH_RESULTS_LIMIT', 10))
+
+# Длина фрагмента вокруг найденных слов (в словах)
+SNIPPET_WORDS = 16
+
+# Слова длиннее этого ищутся без последних букв: окончание в запросе
+# ("туманы") не должно мешать найти другую форму слова ("тумане")
+STEM_MIN_LENGTH = 5
+STEM_CUT = 2
+
+# Маркеры найденных слов во фрагменте; заменяются на HTML после экранирования
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Сегменты хранятся в обычной таблице с индексом по расшифровке, FTS5 -
+# внешний индекс над ней: повторная индексация задачи удаляет только ее
+# строки, а не просматривает весь индекс пользователя
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transcripts (
+    id INTEGER PRIMARY KEY,
+    task_id TEXT UNIQUE NOT NULL,
+    title TEXT,
+    created_at TEXT,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS segment_rows (
+    id INTEGER PRIMARY KEY,
+    transcript_id INTEGER NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS segment_rows_transcript ON segment_rows (transcript_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS segments USING fts5(
+    text,
+    content = 'segment_rows',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def normalize(text):
+    # unicode61 не сводит ё к е: без этого "еж" не находит "ёж"
+    return text.replace('ё', 'е').replace('Ё', 'Е')
+
+
+def build_query(query):
+    """
+    Запрос FTS5 из пользовательского текста: все слова обязательны,
+    каждое ищется как префикс (разные окончания одного слова).
+    """
+    terms = []
+    for word in _WORD_RE.findall(normalize(query)):
+        if len(word) >= STEM_MIN_LENGTH and not word.isdigit():
+            word = word[:max(len(word) - STEM_CUT, STEM_MIN_LENGTH - 1)]
+        terms.append(f'"{word}"*')
+    return " ".join(terms)
+
+
+class SearchIndex:
+    """
+    Полнотекстовый индекс расшифровок пользователя (SQLite FTS5, файл
+    на пользователя). Сегменты с таймкодами добавляются по завершении
+    задачи и остаются после того, как запись воркера удалена.
+    Методы блокирующие - вызывать из executor.
+    """
+
+    def __init__(self, root=SEARCH_INDEX_DIR):
+        self.root = root
+
+    def _path(self, user_id):
+        return os.path.join(self.root, f"{int(user_id)}.sqlite3")
+
+    def _connect(self, user_id):
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(self._path(user_id), timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def add_transcript(self, user_id, task_id, record_path, title=None):
+        """
+        Индексирует запись расшифровки. Повторная индексация той же задачи
+        (уточненная расшифровка) заменяет прежние сегменты.
+        Возвращает число сегментов.
+        """
+        header, segments = read_record(record_path)
+        conn = self._connect(user_id)
+        try:
+            with conn:
+                row = conn.execute('SELECT id FROM transcripts WHERE task_id = ?', (task_id,)).fetchone()
+                if row:
+                    transcript_id = row[0]
+                    # Внешний индекс FTS5 удаляет строку по ее прежнему тексту
+                    conn.execute(
+                        "INSERT INTO segments (segments, rowid, text) "
+                        "SELECT 'delete', id, text FROM segment_rows WHERE transcript_id = ?",
+                        (transcript_id,)
+                    )
+                    conn.execute('DELETE FROM segment_rows WHERE transcript_id = ?', (transcript_id,))
+                else:
+                    transcript_id = conn.execute(
+                        'INSERT INTO transcripts (task_id, title, created_at) VALUES (?, ?, ?)',
+                        (task_id, title, datetime.now().isoformat(timespec='seconds'))
+                    ).lastrowid
+                count = 0
+                duration = 0.0
+                for seg in segments:
+                    text = seg['text'].strip()
+                    if not text:
+                        continue
+                    conn.execute(
+                        'INSERT INTO segment_rows (transcript_id, start_time, end_time, text) VALUES (?, ?, ?, ?)',
+                        (transcript_id, seg['start'], seg['end'], normalize(text))
+                    )
+                    count += 1
+                    duration = seg['end']
+                conn.execute(
+                    'INSERT INTO segments (rowid, text) SELECT id, text FROM segment_rows WHERE transcript_id = ?',
+                    (transcript_id,)
+                )
+                conn.execute(
+                    'UPDATE transcripts SET duration = ?, title = COALESCE(?, title) WHERE id = ?',
+                    (duration, title, transcript_id)
+                )
+            return count
+        finally:
+            conn.close()
+
+    def search(self, user_id, query, limit=SEARCH_RESULTS_LIMIT):
+        """Фрагменты с таймкодами, лучшие совпадения первыми"""
+        match = build_query(query)
+        if not match or not os.path.exists(self._path(user_id)):
+            return []
+        conn = self._connect(user_id)
+        try:
+            rows = conn.execute(
+                f"""
+                SELECT t.task_id, t.title, t.created_at, r.start_time, r.end_time,
+                       snippet(segments, 0, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_WORDS})
+                FROM segments
+                JOIN segment_rows r ON r.id = segments.rowid
+                JOIN transcripts t ON t.id = r.transcript_id
+                WHERE segments MATCH ?
+                ORDER BY bm25(segments)
+                LIMIT ?
+                """,
+                (match, limit)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {'task_id': task_id, 'title': title, 'created_at': created_at, 'start': start, 'end': end, 'snippet': snippet}
+            for task_id, title, created_at, start, end, snippet in rows
+        ]
+
+    def stats(self, user_id):
+        """(число расшифровок, суммарная длительность в секундах)"""
+        if not os.path.exists(self._path(user_id)):
+            return 0, 0.0
+        conn = self._connect(user_id)
+        try:
+            count, seconds = conn.execute('SELECT COUNT(*), COALESCE(SUM(duration), 0) FROM transcripts').fetchone()
+            return count, seconds
+        finally:
+            conn.close()
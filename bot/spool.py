@@ -0,0 +1,197 @@
+import os
+import time
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Основной том для файлов задач (общий для бота и воркера)
+SPOOL_DIR = os.getenv('SPOOL_DIR', '/tmp/shared')
+
+# Быстрый уровень в памяти (tmpfs) для небольших файлов; пусто - отключен
+SPOOL_FAST_DIR = os.getenv('SPOOL_FAST_DIR', '')
+SPOOL_FAST_MAX_MB = int(os.getenv('SPOOL_FAST_MAX_MB', 20))
+SPOOL_FAST_QUOTA_MB = int(os.getenv('SPOOL_FAST_QUOTA_MB', 256))
+
+# Квота основного тома и минимальный запас свободного места
+SPOOL_QUOTA_MB = int(os.getenv('SPOOL_QUOTA_MB', 5120))
+SPOOL_MIN_FREE_MB = int(os.getenv('SPOOL_MIN_FREE_MB', 512))
+
+# Сколько бот ждет освобождения места перед отказом (секунды)
+SPOOL_ADMISSION_WAIT = int(os.getenv('SPOOL_ADMISSION_WAIT', 120))
+
+# Файлы без владельца старше этого возраста удаляются сборщиком
+SPOOL_ORPHAN_AGE = int(os.getenv('SPOOL_ORPHAN_AGE', 3600))
+
+# Сколько живет список файлов задачи, пока она в очереди или в работе
+SPOOL_TASK_TTL = int(os.getenv('SPOOL_TASK_TTL', 6 * 3600))
+
+# Раскладка ключей в Redis (совпадает с worker/spool.py):
+# spool:task:{task_id} - множество путей, принадлежащих задаче
+SPOOL_TASK_KEY_PREFIX = 'spool:task:'
+SPOOL_GC_LOCK_KEY = 'spool:gc:lock'
+
+MB = 1024 * 1024
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _is_covered(path, registered):
+    """
+    Путь принадлежит задаче, если он зарегистрирован, лежит внутри
+    зарегистрированной папки или получен из зарегистрированного файла
+    заменой расширения (mp3 воркера, запись _segments.jsonl, экспорты).
+    """
+    for owned in registered:
+        if path == owned or owned.startswith(path + os.sep) or path.startswith(owned + os.sep):
+            return True
+        base = os.path.splitext(owned)[0]
+        if path.startswith(base) and path[len(base):len(base) + 1] in ('.', '_'):
+            return True
+    return False
+
+
+class SpoolManager:
+    """
+    Учет файлов задач на общем томе: выбор уровня хранения, квота
+    с ожиданием места при приеме новых файлов, удаление файлов задачи
+    и сборка файлов, которые не принадлежат ни одной живой задаче.
+    """
+
+    def __init__(self, conn, root=SPOOL_DIR, fast_dir=SPOOL_FAST_DIR):
+        self.conn = conn
+        # Без общего тома (локальный запуск) файлы идут в /tmp без учета
+        # квоты, а сборщик ничего не удаляет
+        self.root = root if os.path.isdir(root) else None
+        self.fast_dir = fast_dir if fast_dir and os.path.isdir(fast_dir) else None
+
+    def tiers(self):
+        return [directory for directory in (self.fast_dir, self.root) if directory]
+
+    def usage(self, directory):
+        total = 0
+        for entry in os.scandir(directory):
+            try:
+                total += _size(entry.path)
+            except OSError:
+                pass
+        return total
+
+    def admit(self, expected_size=0):
+        """
+        Возвращает папку для нового файла или None, если места нет.
+        Небольшие файлы попадают в tmpfs, пока там есть место.
+        """
+        if self.root is None:
+            return '/tmp'
+        try:
+            if self.fast_dir and 0 < expected_size <= SPOOL_FAST_MAX_MB * MB:
+                if self.usage(self.fast_dir) + expected_size <= SPOOL_FAST_QUOTA_MB * MB:
+                    return self.fast_dir
+
+            free = shutil.disk_usage(self.root).free
+            used = self.usage(self.root)
+            if free - expected_size < SPOOL_MIN_FREE_MB * MB or used + expected_size > SPOOL_QUOTA_MB * MB:
+                logger.warning(
+                    f"Нет места для файла {expected_size / MB:.1f} МБ: занято {used / MB:.0f} МБ, "
+                    f"свободно {free / MB:.0f} МБ"
+                )
+                return None
+            return self.root
+        except Exception as e:
+            logger.error(f"Ошибка проверки места в {self.root}: {e}")
+            return self.root
+
+    def register(self, task_id, *paths, ttl=SPOOL_TASK_TTL):
+        """Добавляет пути к файлам задачи"""
+        try:
+            key = SPOOL_TASK_KEY_PREFIX + task_id
+            pipe = self.conn.pipeline(transaction=True)
+            pipe.sadd(key, *paths)
+            pipe.expire(key, ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Ошибка регистрации файлов задачи {task_id}: {e}")
+
+    def touch(self, task_id, ttl):
+        """Продлевает жизнь оставшихся файлов задачи (например, записи расшифровки)"""
+        try:
+            self.conn.expire(SPOOL_TASK_KEY_PREFIX + task_id, ttl)
+        except Exception as e:
+            logger.error(f"Ошибка продления файлов задачи {task_id}: {e}")
+
+    def release(self, task_id):
+        """Удаляет все файлы задачи (например, если ее не удалось поставить в очередь)"""
+        key = SPOOL_TASK_KEY_PREFIX + task_id
+        try:
+            paths = self.conn.smembers(key)
+            self.conn.delete(key)
+        except Exception as e:
+            logger.error(f"Ошибка чтения файлов задачи {task_id}: {e}")
+            return
+        for path in paths:
+            try:
+                _remove(path)
+            except Exception as e:
+                logger.error(f"Ошибка удаления {path}: {e}")
+        logger.info(f"Файлы задачи {task_id} удалены: {len(paths)}")
+
+    def registered_paths(self):
+        paths = set()
+        for key in self.conn.scan_iter(match=SPOOL_TASK_KEY_PREFIX + '*', count=500):
+            paths.update(self.conn.smembers(key))
+        return paths
+
+    def collect_garbage(self, orphan_age=SPOOL_ORPHAN_AGE):
+        """
+        Удаляет файлы и папки верхнего уровня, не принадлежащие живым задачам.
+        Свежие файлы не трогаются: бот мог создать файл и еще не успеть
+        его зарегистрировать. Блокирующая функция - вызывать из executor.
+        """
+        # Сборщик может работать в нескольких репликах бота одновременно
+        if not self.conn.set(SPOOL_GC_LOCK_KEY, '1', nx=True, ex=60):
+            return 0
+
+        registered = self.registered_paths()
+        cutoff = time.time() - orphan_age
+        removed = 0
+        freed = 0
+        tiers = self.tiers()
+        for directory in tiers:
+            for entry in os.scandir(directory):
+                if entry.path in tiers:
+                    continue
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                        continue
+                    if _is_covered(entry.path, registered):
+                        continue
+                    size = _size(entry.path)
+                    _remove(entry.path)
+                    removed += 1
+                    freed += size
+                except FileNotFoundError:
+                    continue
+                except Exception as e:
+                    logger.error(f"Ошибка удаления файла без владельца {entry.path}: {e}")
+        if removed:
+            logger.info(f"Удалено файлов без владельца: {removed} ({freed / MB:.1f} МБ)")
+        return removed
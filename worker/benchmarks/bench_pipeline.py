@@ -0,0 +1,245 @@
+"""
+Сквозной бенчмарк конвейера decrypt_process на синтетических медиафайлах.
+
+Генерирует через ffmpeg речеподобный сигнал (модулированный розовый шум)
+и тишину разной длительности в нескольких контейнерах, затем замеряет
+этапы convert_to_mp3, transcribe_with_whisper, summarize_text и весь
+decrypt_process. Каждый замер выполняется в отдельном процессе, чтобы
+пиковое потребление памяти относилось только к этому этапу.
+
+Запуск из папки worker:
+    python benchmarks/bench_pipeline.py --durations 10 60 300 --output run.jsonl
+    python benchmarks/bench_pipeline.py --compare before.jsonl after.jsonl
+
+Результат - JSON Lines: строка с описанием окружения и по строке на замер.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+
+WORKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORKER_DIR)
+
+STAGES = ['convert', 'transcribe', 'summarize', 'pipeline']
+KINDS = ['speech', 'silence']
+CONTAINERS = ['wav', 'mp3', 'ogg', 'mp4']
+
+# Розовый шум с амплитудной модуляцией ~4 Гц (темп слогов) в полосе голоса
+_SOURCES = {
+    'speech': 'anoisesrc=color=pink:sample_rate=16000:amplitude=0.5,'
+              'tremolo=f=4:d=0.9,bandpass=f=800:width_type=h:width=2000',
+    'silence': 'anullsrc=r=16000:cl=mono',
+}
+
+_CODECS = {
+    'wav': ['-acodec', 'pcm_s16le'],
+    'mp3': ['-acodec', 'libmp3lame', '-ab', '128k'],
+    'ogg': ['-acodec', 'libopus', '-ab', '48k'],
+    'mp4': ['-acodec', 'aac', '-ab', '128k', '-vcodec', 'libx264', '-preset', 'ultrafast'],
+}
+
+
+def generate_media(workdir, kind, container, duration):
+    """Создает синтетический файл и возвращает путь к нему"""
+    path = os.path.join(workdir, f"{kind}_{int(duration)}s_{container}.{container}")
+    if os.path.exists(path):
+        return path
+
+    cmd = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-t', str(duration), '-i', _SOURCES[kind]]
+    if container == 'mp4':
+        cmd += ['-f', 'lavfi', '-t', str(duration), '-i', 'color=c=black:s=320x240:r=10']
+    cmd += _CODECS[container] + ['-y', path]
+    subprocess.run(cmd, check=True, capture_output=True)
+    return path
+
+
+def _prepare_mp3(path):
+    mp3_path = os.path.splitext(path)[0] + "_bench.mp3"
+    if not os.path.exists(mp3_path):
+        subprocess.run(
+            ['ffmpeg', '-v', 'error', '-i', path, '-map', '0:a', '-acodec', 'libmp3lame',
+             '-ab', '64k', '-ac', '1', '-ar', '16000', '-y', mp3_path],
+            check=True, capture_output=True,
+        )
+    return mp3_path
+
+
+def _run_stage(stage, path, duration):
+    """Выполняет один этап в текущем процессе"""
+    import decryptor
+
+    def set_status(msg):
+        pass
+
+    if stage == 'convert':
+        mp3_path = asyncio.run(decryptor.convert_to_mp3(path))
+        if mp3_path is None:
+            raise RuntimeError("convert_to_mp3 вернул None")
+        if mp3_path != path:
+            os.unlink(mp3_path)
+    elif stage == 'transcribe':
+        if asyncio.run(decryptor.transcribe_with_whisper(path, set_status=set_status)) is None:
+            raise RuntimeError("transcribe_with_whisper вернул None")
+    elif stage == 'summarize':
+        from benchmarks.bench_summarizer import make_segments
+        segments = make_segments(duration / 3600)
+        text = "".join(seg['text'] for seg in segments)
+        asyncio.run(decryptor.summarize_text(text, segments))
+    elif stage == 'pipeline':
+        result = asyncio.run(decryptor.decrypt_process(path, set_status))
+        if result is None:
+            raise RuntimeError("decrypt_process вернул None")
+        if os.path.exists(result['record_file']):
+            os.unlink(result['record_file'])
+
+
+def _measure(stage, path, duration, queue):
+    """Точка входа дочернего процесса: замеряет этап и отправляет метрики"""
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    error = None
+    try:
+        _run_stage(stage, path, duration)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = (
+        (self_after.ru_utime - self_before.ru_utime) + (self_after.ru_stime - self_before.ru_stime)
+        + (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+    )
+    queue.put({
+        'wall_seconds': round(wall, 4),
+        'cpu_seconds': round(cpu, 4),
+        'cpu_utilization': round(cpu / wall, 3) if wall > 0 else None,
+        'real_time_factor': round(wall / duration, 4) if duration > 0 else None,
+        # ru_maxrss в Linux указывается в килобайтах
+        'peak_rss_mb': round(self_after.ru_maxrss / 1024, 1),
+        'children_peak_rss_mb': round(children_after.ru_maxrss / 1024, 1),
+        'error': error,
+    })
+
+
+def measure(stage, path, duration):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(stage, path, duration, queue))
+    process.start()
+    try:
+        return queue.get()
+    finally:
+        process.join()
+
+
+def cpu_plan_info():
+    # Распределение потоков, с которым шли замеры (квота cgroup, потоки torch/ffmpeg)
+    try:
+        from resources import CpuPlan
+        return CpuPlan().as_dict()
+    except Exception:
+        return None
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=WORKER_DIR, capture_output=True, text=True,
+        ).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        'type': 'environment',
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cpu_plan': cpu_plan_info(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def _key(row):
+    return (row['stage'], row['kind'], row['container'], row['duration'])
+
+
+def compare(baseline_path, current_path):
+    """Печатает изменение времени и памяти между двумя прогонами"""
+    def load(path):
+        with open(path, encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return {_key(row): row for row in rows if row.get('type') == 'measurement'}
+
+    baseline, current = load(baseline_path), load(current_path)
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key], current[key]
+        if before['error'] or after['error']:
+            continue
+        print(json.dumps({
+            'stage': key[0], 'kind': key[1], 'container': key[2], 'duration': key[3],
+            'wall_ratio': round(after['wall_seconds'] / before['wall_seconds'], 3),
+            'peak_rss_delta_mb': round(after['peak_rss_mb'] - before['peak_rss_mb'], 1),
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS)
+    parser.add_argument('--containers', nargs='+', choices=CONTAINERS, default=CONTAINERS)
+    parser.add_argument('--durations', type=float, nargs='+', default=[10, 60, 300])
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--workdir', default=None, help="папка для синтетических файлов (по умолчанию временная)")
+    parser.add_argument('--output', default=None, help="файл JSON Lines (по умолчанию stdout)")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.makedirs(workdir, exist_ok=True)
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+
+    def emit(row):
+        out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out.flush()
+
+    emit(environment())
+    for kind in args.kinds:
+        for container in args.containers:
+            for duration in args.durations:
+                media_path = generate_media(workdir, kind, container, duration)
+                for stage in args.stages:
+                    # Транскрибация в конвейере всегда получает mp3 16 кГц
+                    path = _prepare_mp3(media_path) if stage == 'transcribe' else media_path
+                    for run in range(args.repeat):
+                        row = {
+                            'type': 'measurement',
+                            'stage': stage,
+                            'kind': kind,
+                            'container': container,
+                            'duration': duration,
+                            'input_mb': round(os.path.getsize(path) / (1024 * 1024), 2),
+                            'run': run,
+                        }
+                        row.update(measure(stage, path, duration))
+                        emit(row)
+
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Задержка распознавания коротких клипов: model.transcribe против
+короткого пути transcribe_short_clip (одна мел-спектрограмма и один decode).
+
+Синтетические клипы 5-30 секунд генерируются через ffmpeg так же, как
+в bench_pipeline. Модель загружается один раз, декодированное аудио
+подается обоим путям, так что в замер попадает только распознавание.
+
+Запуск из папки worker:
+    python benchmarks/bench_short_clips.py --durations 5 10 20 30 --repeat 5
+    python benchmarks/bench_short_clips.py --model base --language ru --output short.jsonl
+
+Результат - JSON Lines: строка с описанием окружения и по строке на клип.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+WORKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORKER_DIR)
+
+from benchmarks.bench_pipeline import generate_media, environment, KINDS  # noqa: E402
+
+# Параметры обычного пути для небольших файлов (как в _transcribe_small_file)
+TRANSCRIBE_OPTIONS = {
+    'word_timestamps': True,
+    'verbose': False,
+    'no_speech_threshold': 0.6,
+    'logprob_threshold': -1.0,
+}
+
+
+def _timed(func, repeat):
+    """Медиана и минимум времени вызова; первый прогон - прогрев"""
+    func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return round(statistics.median(times), 4), round(min(times), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--durations', type=float, nargs='+', default=[5, 10, 20, 30])
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS)
+    parser.add_argument('--model', default=os.getenv('WHISPER_MODEL', 'tiny'))
+    parser.add_argument('--language', default=None, help="язык клипов (по умолчанию определяется)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workdir', default=None, help="папка для синтетических файлов (по умолчанию временная)")
+    parser.add_argument('--output', default=None, help="файл JSON Lines (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    import whisper
+    import decryptor
+    from resources import configure_torch
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_short_')
+    os.makedirs(workdir, exist_ok=True)
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+
+    def emit(row):
+        out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out.flush()
+
+    configure_torch()
+    model = whisper.load_model(args.model, device="cpu")
+    emit(dict(environment(), model=args.model, repeat=args.repeat))
+
+    for kind in args.kinds:
+        for duration in args.durations:
+            path = generate_media(workdir, kind, 'mp3', duration)
+            audio = decryptor.load_audio_segment(path)
+
+            def generic():
+                model.transcribe(audio, language=args.language, **TRANSCRIBE_OPTIONS)
+
+            def short():
+                # None означает откат на обычный путь - его время тоже учитывается
+                if decryptor.transcribe_short_clip(model, audio, args.language) is None:
+                    generic()
+
+            fallback = decryptor.transcribe_short_clip(model, audio, args.language) is None
+            generic_median, generic_min = _timed(generic, args.repeat)
+            short_median, short_min = _timed(short, args.repeat)
+            emit({
+                'type': 'measurement',
+                'kind': kind,
+                'duration': duration,
+                'transcribe_seconds': generic_median,
+                'transcribe_min_seconds': generic_min,
+                'short_clip_seconds': short_median,
+                'short_clip_min_seconds': short_min,
+                'short_clip_fallback': fallback,
+                'speedup': round(generic_median / short_median, 2) if short_median > 0 else None,
+            })
+
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
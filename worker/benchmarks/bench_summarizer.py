@@ -0,0 +1,83 @@
+"""
+Бенчмарк саммаризатора на синтетических расшифровках растущей длины.
+
+Запуск из папки worker:
+    python benchmarks/bench_summarizer.py [--hours 1 2 4 8] [--repeat 3]
+
+Печатает по одной JSON-строке на размер входа.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from summarizer import summarize  # noqa: E402
+
+# ~150 слов в минуту, сегмент Whisper в среднем ~4 секунды
+WORDS_PER_SECOND = 2.5
+SEGMENT_SECONDS = 4.0
+
+
+def _word(index):
+    # Псевдослова из букв: токенизатор саммаризатора не учитывает цифры
+    letters = "абвгдежзиклмнопрстуфхцчшэюя"
+    word = ""
+    index += len(letters) ** 2
+    while index:
+        index, rest = divmod(index, len(letters))
+        word += letters[rest]
+    return word
+
+
+def make_segments(hours, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [_word(i) for i in range(20000)]
+    # Распределение Ципфа, как в естественной речи
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    words_per_segment = int(WORDS_PER_SECOND * SEGMENT_SECONDS)
+
+    segments = []
+    start = 0.0
+    total = int(hours * 3600 / SEGMENT_SECONDS)
+    words = rng.choices(vocabulary, weights=weights, k=total * words_per_segment)
+    for idx in range(total):
+        chunk = words[idx * words_per_segment:(idx + 1) * words_per_segment]
+        segments.append({
+            'start': start,
+            'end': start + SEGMENT_SECONDS,
+            'text': " " + " ".join(chunk) + ".",
+        })
+        start += SEGMENT_SECONDS
+    return segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=float, nargs='+', default=[0.25, 0.5, 1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for hours in args.hours:
+        segments = make_segments(hours)
+        text = "".join(seg['text'] for seg in segments)
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            summarize(text, segments)
+            timings.append(time.perf_counter() - started)
+        print(json.dumps({
+            'benchmark': 'summarizer',
+            'hours': hours,
+            'segments': len(segments),
+            'chars': len(text),
+            'best_seconds': round(min(timings), 4),
+            'mean_seconds': round(sum(timings) / len(timings), 4),
+        }), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Защищенный режим декодирования (0 - поведение Whisper по умолчанию)
+WHISPER_GUARD = os.getenv('WHISPER_GUARD', '1').lower() in ('1', 'true', 'yes')
+
+# Сколько повторных декодирований с повышенной температурой допускается
+# на одно 30-секундное окно (Whisper по умолчанию делает до пяти)
+WHISPER_MAX_FALLBACKS = int(os.getenv('WHISPER_MAX_FALLBACKS', 2))
+
+# Общий запас повторных декодирований на задачу: после него окна
+# декодируются только жадно
+WHISPER_FALLBACK_BUDGET = int(os.getenv('WHISPER_FALLBACK_BUDGET', 20))
+
+# Шаг температуры, как в Whisper
+TEMPERATURE_STEP = 0.2
+
+# Зацикливание: n-грамма из 1-4 слов повторяется подряд столько раз.
+# Короткие повторы бывают и в живой речи ("нет, нет, нет, нет"), поэтому
+# для одного-двух слов порог выше
+LOOP_NGRAM_MAX = 4
+LOOP_MIN_REPEATS = {1: 8, 2: 6, 3: 4, 4: 4}
+
+# Столько одинаковых сегментов подряд считается зацикливанием между окнами
+LOOP_MIN_SEGMENT_RUN = 3
+
+# Whisper считает окно неудачным при таком сжатии текста
+COMPRESSION_RATIO_THRESHOLD = 2.4
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _words(text):
+    return _WORD_RE.findall(text.lower())
+
+
+def find_repetition_loop(text, max_ngram=LOOP_NGRAM_MAX, min_repeats=LOOP_MIN_REPEATS):
+    """
+    Первая серия повторов n-граммы не короче порога для ее длины:
+    (начало, конец) в символах текста для части, которую нужно вырезать
+    (все повторы, кроме первого), или None
+    """
+    matches = list(_WORD_RE.finditer(text))
+    words = [match.group().lower() for match in matches]
+    for n in range(1, max_ngram + 1):
+        needed = min_repeats[n]
+        for start in range(len(words) - n * needed + 1):
+            ngram = words[start:start + n]
+            pos = start + n
+            while words[pos:pos + n] == ngram:
+                pos += n
+            if (pos - start) // n >= needed:
+                return matches[start + n - 1].end(), matches[pos - 1].end()
+    return None
+
+
+def has_repetition_loop(text, max_ngram=LOOP_NGRAM_MAX, min_repeats=LOOP_MIN_REPEATS):
+    """Есть ли в тексте n-грамма, повторенная подряд не меньше порога раз"""
+    return find_repetition_loop(text, max_ngram, min_repeats) is not None
+
+
+def trim_repetition_loops(text):
+    """Оставляет от каждой серии повторов одно вхождение"""
+    while True:
+        span = find_repetition_loop(text)
+        if span is None:
+            return text
+        text = text[:span[0]] + text[span[1]:]
+
+
+class DecodingGuard:
+    """
+    Ограничение стоимости декодирования на музыке, шуме и тишине.
+
+    Whisper при неудачном окне (сильное сжатие текста или низкая
+    уверенность) повторяет декодирование с ростом температуры. Охранник
+    сокращает список температур до max_fallbacks на окно, а после исчерпания
+    общего запаса задачи отдает Whisper уже готовый жадный результат вместо
+    нового прохода. Из сегментов с зацикленным текстом вырезаются повторы,
+    остальной текст сегмента сохраняется.
+    """
+
+    def __init__(self, enabled=WHISPER_GUARD, max_fallbacks=WHISPER_MAX_FALLBACKS, budget=WHISPER_FALLBACK_BUDGET):
+        self.enabled = enabled
+        self.max_fallbacks = max_fallbacks
+        self.budget = budget
+        self.windows = 0
+        self.fallbacks = 0
+        self.skipped_fallbacks = 0
+        self.suppressed_segments = 0
+        self.trimmed_segments = 0
+        self.silent_chunks = 0
+        self._last = None
+
+    def transcribe_options(self):
+        """Аргументы model.transcribe для защищенного режима"""
+        if not self.enabled:
+            return {}
+        temperatures = tuple(round(TEMPERATURE_STEP * idx, 1) for idx in range(self.max_fallbacks + 1))
+        return {
+            'temperature': temperatures,
+            'compression_ratio_threshold': COMPRESSION_RATIO_THRESHOLD,
+        }
+
+    def install(self, model):
+        """
+        Оборачивает model.decode, которым transcribe декодирует окна.
+        Модель может переживать задачу (пакетный режим): обертка прошлой
+        задачи заменяется, а не наслаивается.
+        """
+        if not self.enabled:
+            return model
+        original = model.__dict__.get('_unguarded_decode', model.decode)
+        model._unguarded_decode = original
+
+        def decode(mel, options=None, **kwargs):
+            temperature = getattr(options, 'temperature', 0.0) or 0.0
+            if temperature == 0.0 or self._last is None:
+                self.windows += 1
+            elif self.fallbacks >= self.budget:
+                # Запас задачи исчерпан: Whisper проверит тот же результат
+                # и перейдет к следующей температуре без декодирования
+                self.skipped_fallbacks += 1
+                return self._last
+            else:
+                self.fallbacks += 1
+            self._last = original(mel, options, **kwargs)
+            return self._last
+
+        model.decode = decode
+        return model
+
+    def is_looping(self, segment):
+        """
+        Whisper исчерпал температуры, а текст по-прежнему сжимается как
+        повтор, и вырезать отдельную серию не получилось
+        """
+        ratio = segment.get('compression_ratio') or 0
+        last_temperature = self.transcribe_options().get('temperature', (0.0,))[-1]
+        return ratio > COMPRESSION_RATIO_THRESHOLD and (segment.get('temperature') or 0) >= last_temperature
+
+    def filter_segments(self, segments):
+        """
+        Вырезает повторы внутри сегментов, убирает неисправимо зацикленные
+        сегменты и серии одинаковых сегментов подряд
+        """
+        if not self.enabled:
+            return segments
+        kept = []
+        run_text = None
+        run_length = 0
+        for seg in segments:
+            trimmed = trim_repetition_loops(seg.get('text', ''))
+            was_trimmed = trimmed != seg.get('text', '')
+            if was_trimmed:
+                # compression_ratio сегмента относится к тексту до обрезки
+                seg = dict(seg, text=trimmed)
+                self.trimmed_segments += 1
+            text = " ".join(_words(seg.get('text', '')))
+            if text and text == run_text:
+                run_length += 1
+            else:
+                run_text, run_length = text, 1
+            if (not was_trimmed and self.is_looping(seg)) or run_length >= LOOP_MIN_SEGMENT_RUN:
+                self.suppressed_segments += 1
+                continue
+            kept.append(seg)
+        return kept
+
+    def stats(self):
+        return {
+            'windows': self.windows,
+            'fallbacks': self.fallbacks,
+            'skipped_fallbacks': self.skipped_fallbacks,
+            'suppressed_segments': self.suppressed_segments,
+            'trimmed_segments': self.trimmed_segments,
+            'silent_chunks': self.silent_chunks,
+        }
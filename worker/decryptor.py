@@ -2,6 +2,12 @@ import os
 import sys
 import asyncio
 import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager, ExitStack
+from resources import cpu_plan, configure_torch
+from decoding_guard import DecodingGuard
+from segment_store import SegmentStore
 try:
     from pydub import AudioSegment
 except ImportError:
@@ -18,8 +24,106 @@ def format_time(seconds):
     h = int(seconds) // 3600
     return f"{h:02}:{m:02}:{s:02}:{ms:03}"
 
-async def decrypt_process(file_path, set_status):
+# Наблюдатели за этапами обработки (метрики, профилирование): функции,
+# принимающие имя этапа и возвращающие контекстный менеджер
+_stage_observers = []
+
+def add_stage_observer(observer):
+    _stage_observers.append(observer)
+
+def remove_stage_observer(observer):
+    if observer in _stage_observers:
+        _stage_observers.remove(observer)
+
+@contextmanager
+def track_stage(name):
+    """Оборачивает этап обработки контекстами всех наблюдателей"""
+    with ExitStack() as stack:
+        for observer in list(_stage_observers):
+            stack.enter_context(observer(name))
+        yield
+
+class JobCancelled(Exception):
+    """Обработка остановлена по запросу (проверяется на границах частей)"""
+
+# Запущенные ffmpeg/ffprobe: при отмене задачи их убивают, не дожидаясь
+# конца текущей части
+_active_processes = set()
+_processes_lock = threading.Lock()
+_processes_killed = threading.Event()
+
+def _reset_processes_after_fork():
+    # Процесс задачи RQ форкается из основного, где в это время может идти
+    # ffmpeg подготовки (prefetch): отмена задачи не должна его убивать,
+    # а блокировка могла быть захвачена потоком подготовки в момент форка
+    global _active_processes, _processes_lock, _processes_killed
+    _active_processes = set()
+    _processes_lock = threading.Lock()
+    _processes_killed = threading.Event()
+
+os.register_at_fork(after_in_child=_reset_processes_after_fork)
+
+def run_process(cmd, timeout=None, text=False):
+    """
+    Аналог subprocess.run(capture_output=True), который можно прервать
+    через kill_active_processes. Прерванный запуск бросает JobCancelled.
+    """
+    if _processes_killed.is_set():
+        raise JobCancelled()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=text)
+    with _processes_lock:
+        _active_processes.add(process)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    finally:
+        with _processes_lock:
+            _active_processes.discard(process)
+    if _processes_killed.is_set():
+        raise JobCancelled()
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def kill_active_processes():
+    """Убивает все запущенные внешние процессы; новые больше не запускаются"""
+    _processes_killed.set()
+    with _processes_lock:
+        processes = list(_active_processes)
+    for process in processes:
+        try:
+            process.kill()
+        except Exception:
+            pass
+
+def write_segment_record(record_path, summary, segments, language=None):
+    """
+    Записывает каноническую запись результата: первая строка - заголовок
+    с саммари, далее по одному сегменту на строку (JSON Lines).
+    Из неё бот по запросу рендерит экспорты в SRT/VTT/JSON/TXT.
+    Файл заменяется целиком: уточненная расшифровка перезаписывает
+    черновик, который бот в это время может читать.
+    """
+    import json
+
+    tmp_path = record_path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        header = {'version': 1, 'summary': summary, 'language': language}
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for seg in segments:
+            line = {'start': seg['start'], 'end': seg['end'], 'text': seg['text']}
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, record_path)
+
+async def decrypt_process(file_path, set_status, language=None, language_hint=None, model_name=None, choose_model=None, should_cancel=None):
+    """
+    Полный конвейер: анализ, конвертация, транскрибация, саммари, запись.
+    should_cancel - функция без аргументов; если она вернет True между
+    частями файла, обработка прерывается исключением JobCancelled.
+    """
     import gc
+    from summarizer import MapReduceSummarizer
     
     if AudioSegment is None:
         set_status("Ошибка: библиотека pydub не установлена")
@@ -30,66 +134,106 @@ async def decrypt_process(file_path, set_status):
         return None
 
     mp3_path = None
+    mp3_preexisting = False
+    # Ограничение повторных декодирований и зацикливаний на всю задачу
+    guard = DecodingGuard()
+    # Части расшифровки саммаризируются параллельно с транскрибацией следующих
+    summarizer = MapReduceSummarizer()
     try:
-        # 1. Конвертация в mp3
-        set_status("Конвертация в mp3...")
-        mp3_path = await convert_to_mp3(file_path)
+        # 1. Анализ потоков: кодек, частота, каналы, длительность
+        media_info = await probe_media(file_path)
+        if media_info is not None and not media_info['has_audio']:
+            set_status("Ошибка: в файле нет аудиодорожки")
+            return None
+        
+        # Модель выбирается по длительности файла, если не задана явно
+        if model_name is None and choose_model is not None:
+            model_name = choose_model((media_info or {}).get('duration'))
+        model_name = model_name or WHISPER_MODEL
+        
+        # 2. Конвертация в mp3 - только если вход нельзя сразу декодировать
+        # во вход модели (видео, неизвестный кодек или длительность)
+        if media_info is not None and not needs_transcode(media_info):
+            mp3_path = file_path
+        else:
+            # Уже лежавший рядом mp3 (подготовка заранее или файл
+            # пользователя) задача не удаляет: его учитывает spool
+            existing_mp3 = os.path.splitext(file_path)[0] + ".mp3"
+            mp3_preexisting = os.path.isfile(existing_mp3)
+            set_status("Конвертация в mp3...")
+            with track_stage('convert'):
+                mp3_path = await convert_to_mp3(file_path)
         
         if mp3_path is None:
             set_status("Ошибка конвертации в MP3")
             return None
+        
+        if should_cancel and should_cancel():
+            raise JobCancelled()
 
-        # 2. Транскрибация с таймкодами
+        # 3. Транскрибация с таймкодами
         set_status("Транскрибация аудио (whisper)...")
         try:
-            result = await transcribe_with_whisper(mp3_path, set_status=set_status)
+            with track_stage('transcribe'):
+                result = await transcribe_with_whisper(
+                    mp3_path, set_status=set_status, on_chunk=summarizer.add_chunk,
+                    language=language, language_hint=language_hint, media_info=media_info,
+                    model_name=model_name, should_cancel=should_cancel, guard=guard
+                )
             if result is None:
                 set_status("Ошибка транскрибации: результат отсутствует.")
                 return None
-            transcript, segments = result
+            segments, language = result
+            # Полный текст - в записи расшифровки; в результат задачи
+            # (и в Redis) попадает только начало
+            transcript = segments.text(TRANSCRIPT_PREVIEW_CHARS)
             
             # Очищаем память после транскрибации
             del result
             gc.collect()
             
+        except JobCancelled:
+            raise
         except Exception as e:
             set_status(f"Ошибка транскрибации: {e}")
             return None
 
-        # 3. Саммаризация текста
+        # 4. Саммаризация текста
         set_status("Саммаризация текста...")
         try:
-            summary = await summarize_text(transcript)
+            with track_stage('summarize'):
+                summary = await summarize_text(transcript, segments, summarizer=summarizer)
         except Exception as e:
             set_status(f"Ошибка саммаризации: {e}")
             return None
 
-        # 4. Сохраняем результаты
+        # 5. Сохраняем результаты
         set_status("Сохранение результатов...")
         try:
-            out_path = os.path.splitext(file_path)[0] + "_summary.txt"
-            with open(out_path, "w", encoding="utf-8") as f:
-                f.write("Summary:\n" + summary + "\n\n")
-                f.write("Transcript:\n" + transcript + "\n\n")
-                f.write("Segments:\n")
-                for seg in segments:
-                    start = format_time(seg['start'])
-                    end = format_time(seg['end'])
-                    f.write(f"[{start} - {end}] {seg['text']}\n")
+            record_path = os.path.splitext(file_path)[0] + "_segments.jsonl"
+            with track_stage('save'):
+                write_segment_record(record_path, summary, segments, language)
             
             return {
                 'summary': summary,
                 'transcript': transcript,
-                'segments': segments,
-                'output_file': out_path
+                'transcript_truncated': len(transcript.encode('utf-8')) < segments.text_size,
+                'segments_count': len(segments),
+                'duration': segments.duration,
+                'language': language,
+                'model': model_name,
+                'decoding': guard.stats(),
+                'record_file': record_path
             }
         except Exception as e:
             set_status(f"Ошибка сохранения файла: {e}")
             return None
             
     finally:
+        summarizer.close()
+        
         # Удаляем промежуточный MP3 файл для экономии места
-        if mp3_path and os.path.exists(mp3_path) and mp3_path != file_path:
+        if mp3_path and os.path.exists(mp3_path) and mp3_path != file_path and not mp3_preexisting:
             try:
                 os.unlink(mp3_path)
             except Exception as e:
@@ -98,7 +242,97 @@ async def decrypt_process(file_path, set_status):
         # Принудительная очистка памяти
         gc.collect()
 
-async def convert_to_mp3(file_path):
+# Сколько символов расшифровки попадает в результат задачи
+TRANSCRIPT_PREVIEW_CHARS = 4000
+
+# Аудиокодеки, которые ffmpeg декодирует сразу во вход модели
+# (16 кГц моно PCM) без промежуточного файла
+DIRECT_AUDIO_CODECS = ('mp3', 'opus', 'vorbis', 'flac', 'aac', 'alac')
+
+# Частота дискретизации входа Whisper
+SAMPLE_RATE = 16000
+
+# Файлы длиннее этого обрабатываются частями для экономии памяти (секунды)
+LARGE_FILE_SECONDS = 600
+
+def _probe(file_path):
+    import json
+
+    cmd = [
+        'ffprobe', '-v', 'quiet', '-print_format', 'json',
+        '-show_streams', '-show_format', file_path
+    ]
+    with track_stage('ffprobe'):
+        result = run_process(cmd, timeout=60, text=True)
+    if result.returncode != 0:
+        return None
+    data = json.loads(result.stdout or '{}')
+    streams = data.get('streams', [])
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    # Обложки альбомов в mp3/m4a числятся видеопотоком с attached_pic
+    has_video = any(
+        stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic')
+        for stream in streams
+    )
+
+    duration = (audio or {}).get('duration') or data.get('format', {}).get('duration')
+    return {
+        'has_audio': audio is not None,
+        'has_video': has_video,
+        'codec': (audio or {}).get('codec_name'),
+        'sample_rate': int((audio or {}).get('sample_rate') or 0) or None,
+        'channels': (audio or {}).get('channels'),
+        'duration': float(duration) if duration else None,
+        'format': data.get('format', {}).get('format_name'),
+    }
+
+async def probe_media(file_path):
+    """
+    Один раз анализирует потоки файла через ffprobe. Результат передается
+    дальше по конвейеру и заменяет отдельные вызовы ffprobe в этапах.
+    Возвращает None, если файл не удалось проанализировать.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(None, _probe, file_path)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"ffprobe failed: {e}")
+        return None
+
+def needs_transcode(media_info):
+    """Нужна ли конвертация в mp3 перед транскрибацией"""
+    if media_info['has_video'] or not media_info['duration']:
+        return True
+    codec = media_info['codec'] or ''
+    return not (codec in DIRECT_AUDIO_CODECS or codec.startswith('pcm_'))
+
+def load_audio_segment(file_path, start=0, duration=None):
+    """
+    Декодирует фрагмент файла сразу во вход модели (float32, 16 кГц, моно)
+    одним вызовом ffmpeg, без временных файлов.
+    """
+    import numpy as np
+
+    cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-threads', str(cpu_plan().ffmpeg_threads), '-ss', str(start)]
+    if duration:
+        cmd += ['-t', str(duration)]
+    cmd += [
+        '-i', file_path, '-map', '0:a:0',
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-'
+    ]
+    result = run_process(cmd)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg error: {result.stderr.decode(errors='ignore')}")
+    return np.frombuffer(result.stdout, np.int16).flatten().astype(np.float32) / 32768.0
+
+async def convert_to_mp3(file_path, fallback=True):
+    """
+    Конвертирует файл в mp3 рядом с исходником. fallback=False отключает
+    запасной путь через pydub: он декодирует файл целиком в память
+    (недопустимо в долгоживущем основном процессе воркера).
+    """
     # Сохраняем mp3 рядом с исходным файлом
     base_dir = os.path.dirname(file_path)
     base_name = os.path.splitext(os.path.basename(file_path))[0]
@@ -107,35 +341,53 @@ async def convert_to_mp3(file_path):
     if os.path.isfile(mp3_path):
         return mp3_path
 
+    # Файл пишется под временным именем и переименовывается целиком:
+    # готовый mp3 рядом со входом означает законченную конвертацию
+    # (ее мог заранее сделать prefetch воркера). Имя уникально для писателя:
+    # prefetch и задача могут конвертировать один файл одновременно
+    part_path = f"{mp3_path}.{os.getpid()}.{threading.get_ident()}.part"
+
     loop = asyncio.get_event_loop()
     def _convert():
-        import subprocess
-        
         # Используем ffmpeg напрямую для эффективной обработки больших файлов
         ffmpeg_cmd = [
-            'ffmpeg', '-i', file_path,
+            'ffmpeg',
+            '-threads', str(cpu_plan().ffmpeg_threads),  # Потоки декодера по плану CPU
+            '-i', file_path,
             '-acodec', 'libmp3lame',  # MP3 кодек
             '-ab', '64k',             # Низкий битрейт для экономии памяти
             '-ac', '1',               # Моно звук (экономия памяти)
             '-ar', '16000',           # 16кГц (оптимально для речи)
             '-map', '0:a',            # Только аудио дорожка
+            '-f', 'mp3',              # Формат не угадать по расширению .part
             '-y',                     # Перезаписать файл
-            mp3_path
+            part_path
         ]
         
         try:
             # Выполняем конвертацию через ffmpeg (более эффективно по памяти)
-            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=1800)
+            with track_stage('ffmpeg_convert'):
+                result = run_process(ffmpeg_cmd, timeout=1800, text=True)
             
-            if result.returncode == 0 and os.path.exists(mp3_path):
+            if result.returncode == 0 and os.path.exists(part_path):
+                os.replace(part_path, mp3_path)
                 return mp3_path
             else:
                 print(f"ffmpeg error: {result.stderr}")
                 
+        except JobCancelled:
+            raise
         except subprocess.TimeoutExpired:
             print("ffmpeg timeout - файл слишком большой, используем альтернативный метод")
         except Exception as e:
             print(f"ffmpeg failed: {e}")
+        finally:
+            # Недописанный файл после ошибки, таймаута или отмены
+            if os.path.exists(part_path):
+                os.unlink(part_path)
+            
+        if not fallback:
+            return None
             
         # Fallback: используем pydub с оптимизациями
         try:
@@ -147,31 +399,172 @@ async def convert_to_mp3(file_path):
             audio = audio.set_frame_rate(16000) # 16кГц
             
             # Экспортируем с низким битрейтом
-            audio.export(mp3_path, format="mp3", bitrate="64k")
+            audio.export(part_path, format="mp3", bitrate="64k")
+            os.replace(part_path, mp3_path)
             
             return mp3_path
             
         except Exception as e:
             print(f"pydub conversion error: {e}")
+            if os.path.exists(part_path):
+                os.unlink(part_path)
             return None
             
     return await loop.run_in_executor(None, _convert)
 
-async def transcribe_with_whisper(mp3_path, set_status=None):
+# Модель Whisper по умолчанию (если воркер не выбрал другую)
+WHISPER_MODEL = os.getenv('WHISPER_MODEL', 'tiny')
+
+# Загруженные модели процесса. Воркер загружает модель на каждую задачу
+# (процесс задачи живет одну задачу), пакетный режим держит ее между файлами
+_loaded_models = {}
+_keep_models = False
+
+def keep_loaded_models():
+    """Не выгружать модели между вызовами decrypt_process (пакетный режим)"""
+    global _keep_models
+    _keep_models = True
+
+def load_model(model_name):
+    model = _loaded_models.get(model_name)
+    if model is not None:
+        return model
+    configure_torch()
+    with track_stage('load_model'):
+        model = whisper.load_model(model_name, device="cpu")  # Принудительно CPU для экономии памяти
+    if _keep_models:
+        _loaded_models[model_name] = model
+    return model
+
+# Фиксированный язык распознавания для всех задач (например, "ru")
+WHISPER_LANGUAGE = os.getenv('WHISPER_LANGUAGE') or None
+
+# Минимальная вероятность, при которой подсказка (язык прошлых файлов
+# пользователя) предпочитается самому вероятному языку
+LANGUAGE_HINT_MIN_PROB = 0.2
+
+def _has_speech(window, frame=400, level=0.01, min_ratio=0.2):
+    """Грубая проверка по энергии: есть ли в окне что-то кроме тишины"""
+    import numpy as np
+
+    frames = len(window) // frame
+    if frames == 0:
+        return False
+    rms = np.sqrt(np.mean(np.square(window[:frames * frame].reshape(frames, frame)), axis=1))
+    return np.mean(rms > level) >= min_ratio
+
+def _language_from_mel(model, mel, hint=None):
+    with track_stage('detect_language'):
+        _, probs = model.detect_language(mel)
+    if hint and probs.get(hint, 0) >= LANGUAGE_HINT_MIN_PROB:
+        return hint
+    return max(probs, key=probs.get)
+
+def detect_language(model, audio, hint=None):
+    """
+    Определяет язык по первому 30-секундному окну, содержащему речь.
+    Возвращает None, если речи в аудио не найдено.
+    """
+    window_size = whisper.audio.N_SAMPLES
+    for offset in range(0, max(len(audio), 1), window_size):
+        window = audio[offset:offset + window_size]
+        if not _has_speech(window):
+            continue
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(window), n_mels=model.dims.n_mels).to(model.device)
+        return _language_from_mel(model, mel, hint)
+    return None
+
+# Клипы не длиннее одного окна Whisper (большинство голосовых)
+# распознаются одним вызовом decode без цикла скользящего окна
+SHORT_CLIP_SECONDS = 30
+
+# Шаг таймкодов в токенах Whisper (секунды)
+TIMESTAMP_PRECISION = 0.02
+
+# При таких показателях жадного результата короткий путь уступает
+# model.transcribe с повторами при повышенной температуре
+SHORT_CLIP_COMPRESSION_RATIO = 2.4
+SHORT_CLIP_MIN_LOGPROB = -1.0
+SHORT_CLIP_NO_SPEECH = 0.6
+
+def _segments_from_tokens(tokenizer, tokens, duration):
+    """Сегменты по парам токенов-таймкодов результата decode"""
+    segments = []
+    start = None
+    text_tokens = []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            time = (token - tokenizer.timestamp_begin) * TIMESTAMP_PRECISION
+            if text_tokens:
+                segments.append({'start': start or 0.0, 'end': min(time, duration), 'text': tokenizer.decode(text_tokens)})
+                text_tokens = []
+            start = time
+        elif token < tokenizer.eot:
+            text_tokens.append(token)
+    if text_tokens:
+        segments.append({'start': start or 0.0, 'end': duration, 'text': tokenizer.decode(text_tokens)})
+    return [seg for seg in segments if seg['text'].strip()]
+
+def transcribe_short_clip(model, audio, language=None, language_hint=None):
+    """
+    Короткий клип: одна мел-спектрограмма и один жадный decode вместо
+    цикла model.transcribe. Возвращает (текст, сегменты, язык) или None,
+    если результат ненадежен и клип нужно распознать обычным путем.
+    """
+    from whisper.tokenizer import get_tokenizer
+
+    duration = len(audio) / SAMPLE_RATE
+    # Тишина: распознавать нечего
+    if not _has_speech(audio):
+        return "", [], language
+
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=model.dims.n_mels).to(model.device)
+    if language is None:
+        language = _language_from_mel(model, mel, language_hint)
+
+    options = whisper.DecodingOptions(language=language, task='transcribe', temperature=0.0, fp16=False)
+    with track_stage('transcribe_chunk'):
+        result = model.decode(mel, options)
+
+    if result.no_speech_prob > SHORT_CLIP_NO_SPEECH and result.avg_logprob < SHORT_CLIP_MIN_LOGPROB:
+        return "", [], language
+    if result.compression_ratio > SHORT_CLIP_COMPRESSION_RATIO or result.avg_logprob < SHORT_CLIP_MIN_LOGPROB:
+        return None
+
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages, language=language, task='transcribe')
+    segments = _segments_from_tokens(tokenizer, result.tokens, duration)
+    for seg in segments:
+        seg['temperature'] = result.temperature
+        seg['compression_ratio'] = result.compression_ratio
+    return "".join(seg['text'] for seg in segments), segments, language
+
+async def transcribe_with_whisper(mp3_path, set_status=None, on_chunk=None, language=None, language_hint=None, media_info=None, model_name=None, should_cancel=None, guard=None):
+    """
+    Транскрибирует файл. on_chunk вызывается с сегментами каждой готовой
+    части (таймкоды уже абсолютные), пока следующая часть еще распознается.
+    Язык определяется один раз и закрепляется для всех частей; language
+    задает его явно, language_hint - предпочтительный язык при сомнениях.
+    media_info - результат probe_media (если нет, файл анализируется здесь).
+    should_cancel проверяется перед каждой частью большого файла.
+    guard - DecodingGuard задачи (по умолчанию создается новый).
+    Возвращает (SegmentStore, язык).
+    """
+    language = language or WHISPER_LANGUAGE
+    model_name = model_name or WHISPER_MODEL
+    guard = guard or DecodingGuard()
     loop = asyncio.get_event_loop()
     def _transcribe():
-        import gc
-        import torch
+        info = media_info or _probe(mp3_path) or {}
+        duration = info.get('duration')
         
-        # Проверяем размер файла
-        file_size = os.path.getsize(mp3_path) / (1024 * 1024)  # МБ
-        
-        if file_size > 5:  # Файлы больше 5 МБ обрабатываем частями для экономии памяти
-            return _transcribe_large_file(mp3_path, set_status)
+        # Длинные файлы (или файлы неизвестной длительности)
+        # обрабатываем частями для экономии памяти
+        if duration is None or duration > LARGE_FILE_SECONDS:
+            return _transcribe_large_file(mp3_path, set_status, on_chunk, language, duration)
         else:
-            return _transcribe_small_file(mp3_path, set_status)
+            return _transcribe_small_file(mp3_path, set_status, on_chunk, language, short=duration <= SHORT_CLIP_SECONDS)
     
-    def _transcribe_small_file(mp3_path, set_status):
+    def _transcribe_small_file(mp3_path, set_status, on_chunk, language, short=False):
         import gc
         import torch
         import os
@@ -186,40 +579,51 @@ async def transcribe_with_whisper(mp3_path, set_status=None):
             set_status(f"Загружаю модель для файла {file_size:.1f}МБ...")
         
         # Загружаем модель с минимальными настройками
-        model = whisper.load_model("tiny", device="cpu")  # Принудительно CPU
+        model = load_model(model_name)
+        guard.install(model)
         
         if set_status:
             set_status("Начинаю транскрибацию...")
         
+        audio = load_audio_segment(mp3_path)
+        
+        # Короткий клип - одним вызовом decode
+        if short and len(audio) <= whisper.audio.N_SAMPLES:
+            result = transcribe_short_clip(model, audio, language, language_hint)
+            if result is not None:
+                _, segments, language = result
+                segments = guard.filter_segments(segments)
+                if on_chunk:
+                    on_chunk(segments)
+                return SegmentStore(segments), language
+        
+        if language is None:
+            language = detect_language(model, audio, language_hint)
+        
         # Транскрибируем с минимальными настройками для экономии памяти
-        result = model.transcribe(
-            mp3_path, 
-            word_timestamps=True, 
-            verbose=False,
-            no_speech_threshold=0.6,  # Более строгий порог тишины
-            logprob_threshold=-1.0    # Упрощаем обработку
-        )
+        with track_stage('transcribe_chunk'):
+            result = model.transcribe(
+                audio, 
+                language=language,
+                word_timestamps=True, 
+                verbose=False,
+                no_speech_threshold=0.6,  # Более строгий порог тишины
+                logprob_threshold=-1.0,   # Упрощаем обработку
+                **guard.transcribe_options()
+            )
         
-        transcript = result["text"]
-        segments = result["segments"]
+        segments = guard.filter_segments(result["segments"])
+        language = language or result.get("language")
         
         # Очищаем результат из памяти
-        del result
-        gc.collect()
+        del result, audio
         
-        processed_text = ""
-        processed_segments = []
-        total = len(segments)
+        if set_status:
+            set_status(f"Обработка: сегментов {len(segments)}")
         
-        for idx, seg in enumerate(segments):
-            processed_text += seg["text"]
-            processed_segments.append(seg)
-            if set_status and idx % 10 == 0:  # Обновляем статус реже
-                set_status(f"Обработка: сегмент {idx+1} из {total}")
-            
-            # Периодическая очистка памяти
-            if idx % 50 == 0:
-                gc.collect()
+        if on_chunk:
+            on_chunk(segments)
+        store = SegmentStore(segments)
         
         # Финальная очистка памяти
         del model, segments
@@ -227,88 +631,92 @@ async def transcribe_with_whisper(mp3_path, set_status=None):
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             
-        return processed_text, processed_segments
+        return store, language
     
-    def _transcribe_large_file(mp3_path, set_status):
+    def _transcribe_large_file(mp3_path, set_status, on_chunk, language, total_duration):
         """Обработка больших файлов по частям для экономии памяти"""
         import gc
         import torch
-        import subprocess
-        import tempfile
         
         if set_status:
             set_status("Большой файл - обрабатываю по частям...")
         
-        # Получаем длительность файла
-        duration_cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', mp3_path]
-        try:
-            duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
-            import json
-            duration_info = json.loads(duration_result.stdout)
-            total_duration = float(duration_info['format']['duration'])
-        except:
+        # Длительность известна из probe_media
+        if total_duration is None:
             total_duration = 3600  # По умолчанию 1 час
         
         # Обрабатываем файл частями по 5 минут для экономии памяти
         chunk_duration = 300  # 5 минут
         chunks_count = int(total_duration / chunk_duration) + 1
         
-        all_text = ""
-        all_segments = []
-        time_offset = 0
+        # Сегменты копятся в компактном виде: без токенов и слов Whisper
+        store = SegmentStore()
         
-        model = whisper.load_model("tiny", device="cpu")  # Принудительно CPU для экономии памяти
+        model = load_model(model_name)
+        guard.install(model)
         
         for chunk_idx in range(chunks_count):
+            if should_cancel and should_cancel():
+                raise JobCancelled()
+            
             if set_status:
                 set_status(f"Обрабатываю часть {chunk_idx + 1} из {chunks_count}...")
             
             start_time = chunk_idx * chunk_duration
             
-            # Создаем временный файл для части
-            with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as temp_file:
-                temp_chunk_path = temp_file.name
+            # Часть декодируется из исходного файла сразу во вход модели:
+            # без извлечения во временный файл и повторного декодирования
+            with track_stage('ffmpeg_chunk'):
+                audio = load_audio_segment(mp3_path, start_time, chunk_duration)
             
-            try:
-                # Извлекаем часть файла
-                chunk_cmd = [
-                    'ffmpeg', '-i', mp3_path,
-                    '-ss', str(start_time),
-                    '-t', str(chunk_duration),
-                    '-acodec', 'copy',
-                    '-y', temp_chunk_path
-                ]
-                
-                subprocess.run(chunk_cmd, capture_output=True)
-                
-                # Проверяем, что файл создался
-                if not os.path.exists(temp_chunk_path) or os.path.getsize(temp_chunk_path) < 1024:
-                    break
-                
-                # Транскрибируем часть
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                
-                result = model.transcribe(temp_chunk_path, word_timestamps=True, verbose=False)
-                
-                # Добавляем результат с корректировкой времени
-                chunk_text = result["text"]
-                all_text += chunk_text
-                
-                for seg in result["segments"]:
-                    seg['start'] += start_time
-                    seg['end'] += start_time
-                    all_segments.append(seg)
-                
-                # Очищаем память
-                gc.collect()
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                
-            finally:
-                # Удаляем временный файл
-                if os.path.exists(temp_chunk_path):
-                    os.unlink(temp_chunk_path)
+            # Файл закончился раньше расчетной длительности
+            if audio.size < SAMPLE_RATE // 10:
+                break
+            
+            # Часть без речи (тишина) не декодируется вовсе
+            if guard.enabled and not any(
+                _has_speech(audio[offset:offset + whisper.audio.N_SAMPLES])
+                for offset in range(0, audio.size, whisper.audio.N_SAMPLES)
+            ):
+                guard.silent_chunks += 1
+                del audio
+                continue
+            
+            # Транскрибируем часть
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            
+            # Язык определяется один раз на первой части с речью и далее
+            # закрепляется: Whisper не тратит проход на детекцию в каждой
+            # части, а язык не "прыгает" между частями
+            if language is None:
+                language = detect_language(model, audio, language_hint)
+            
+            with track_stage('transcribe_chunk'):
+                result = model.transcribe(
+                    audio, language=language, word_timestamps=True, verbose=False,
+                    **guard.transcribe_options()
+                )
+            del audio
+            
+            # Добавляем результат с корректировкой времени
+            chunk_segments = guard.filter_segments(result["segments"])
+            del result
+            
+            for seg in chunk_segments:
+                seg['start'] += start_time
+                seg['end'] += start_time
+            store.extend(chunk_segments)
+            
+            # Саммари части строится в фоне, пока распознается следующая
+            if on_chunk:
+                on_chunk(chunk_segments)
+            del chunk_segments
+            
+            # Очищаем память
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
         
         # Очищаем модель
         del model
@@ -316,28 +724,250 @@ async def transcribe_with_whisper(mp3_path, set_status=None):
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         
-        return all_text, all_segments
+        return store, language
     
     return await loop.run_in_executor(None, _transcribe)
 
-async def summarize_text(text):
-    # Простейшая заглушка для саммаризации
-    # Здесь можно подключить любую модель/библиотеку для саммаризации
-    return text[:500] + ("..." if len(text) > 500 else "")
+async def summarize_text(text, segments=None, summarizer=None):
+    """
+    Экстрактивное саммари: ключевые предложения с таймкодами.
+    Если передан summarizer, уже получивший части расшифровки во время
+    транскрибации, остается только финальная свертка.
+    """
+    from summarizer import summarize
 
-if __name__ == "__main__":
-    import sys
+    loop = asyncio.get_event_loop()
+    if summarizer is not None:
+        return await loop.run_in_executor(None, summarizer.reduce)
+    return await loop.run_in_executor(None, summarize, text, segments)
+
+# Расширения файлов, которые пакетный режим берет из папок
+MEDIA_EXTENSIONS = (
+    '.mp3', '.wav', '.m4a', '.ogg', '.oga', '.opus', '.flac', '.aac', '.wma',
+    '.mp4', '.avi', '.mov', '.mkv', '.wmv', '.webm',
+)
+
+BATCH_SUMMARY_FILE = 'batch_summary.json'
+
+def collect_batch_inputs(paths, list_file=None):
+    """
+    Файлы для пакетной обработки: пары (путь, относительное имя). Папки
+    обходятся рекурсивно, имя файла внутри папки берется относительно нее.
+    Повторно указанные файлы отбрасываются, а совпадающие имена разных
+    файлов (одинаковые файлы из разных папок, a.mp3 и a.mp4 в одной папке,
+    видео рядом с mp3 того же имени) получают короткий хэш пути, чтобы их
+    результаты и промежуточный mp3 не совпадали ни в папке результатов,
+    ни рядом с исходниками.
+    """
+    import hashlib
+
+    if list_file:
+        with open(list_file, encoding='utf-8') as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip()]
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(MEDIA_EXTENSIONS):
+                        full_path = os.path.join(root, name)
+                        inputs.append((full_path, os.path.relpath(full_path, path)))
+        elif os.path.isfile(path):
+            inputs.append((path, os.path.basename(path)))
+        else:
+            print(f"Пропускаю {path}: файл не найден")
+
+    unique = {}
+    for full_path, name in inputs:
+        unique.setdefault(os.path.realpath(full_path), (full_path, name))
+    inputs = list(unique.values())
+
+    # Результаты именуются по имени без расширения: a.mp3 и a.mp4 тоже
+    # совпадают. Считаются имена и в папке результатов, и рядом с исходником
+    stems = {}
+    for full_path, name in inputs:
+        for key in (os.path.splitext(name)[0], os.path.splitext(os.path.abspath(full_path))[0]):
+            stems[key] = stems.get(key, 0) + 1
+    resolved = []
+    for full_path, name in inputs:
+        stem, ext = os.path.splitext(name)
+        source_stem = os.path.splitext(os.path.abspath(full_path))[0]
+        # Конвертация видео a.mp4 записала бы a.mp3 поверх чужого файла
+        foreign_mp3 = ext.lower() != '.mp3' and os.path.exists(source_stem + '.mp3')
+        if stems[stem] > 1 or stems[source_stem] > 1 or foreign_mp3:
+            digest = hashlib.sha1(os.path.realpath(full_path).encode('utf-8')).hexdigest()[:8]
+            name = f"{stem}.{digest}{ext}"
+        resolved.append((full_path, name))
+    return resolved
+
+def _batch_outputs(file_path, name, output_dir):
+    """
+    Пути результата файла: (рабочий вход, файл результата). Рабочий вход,
+    отличный от исходника, - ссылка на него: mp3 и запись расшифровки
+    именуются по ней.
+    """
+    if output_dir is None:
+        # Без папки результатов все пишется рядом с исходником, как раньше;
+        # имя с хэшем (совпадение имен) - через ссылку в той же папке
+        name = os.path.basename(name)
+        base = os.path.join(os.path.dirname(file_path), os.path.splitext(name)[0])
+        work_path = file_path if name == os.path.basename(file_path) else base + os.path.splitext(name)[1]
+        return work_path, base + "_result.json"
+    base = os.path.join(output_dir, os.path.splitext(name)[0])
+    return base + os.path.splitext(name)[1], base + "_result.json"
+
+def _batch_init(model_name):
+    # Процесс пула держит модель между файлами и загружает ее заранее
+    keep_loaded_models()
+    if whisper is not None:
+        load_model(model_name)
+
+def _batch_process(file_path, name, output_dir, model_name, language, verbose):
+    """Обрабатывает один файл пакета в процессе пула; возвращает строку отчета"""
+    import json
+    import time
 
-    async def main():
-        if len(sys.argv) < 2:
-            print("Usage: python decryptor.py <path_to_file>")
-            return
-        file_path = sys.argv[1]
-        def set_status(msg):
-            print(msg)
-        await decrypt_process(file_path, set_status)
+    work_path, result_path = _batch_outputs(file_path, name, output_dir)
+    linked = work_path != file_path
+    if linked:
+        # Ссылка на исходник (в папке результатов или под именем с хэшем):
+        # mp3 и запись расшифровки создаются рядом с ней под ее именем
+        os.makedirs(os.path.dirname(work_path), exist_ok=True)
+        if os.path.lexists(work_path):
+            os.unlink(work_path)
+        os.symlink(os.path.abspath(file_path), work_path)
 
-    asyncio.run(main())
+    errors = []
+    def set_status(msg):
+        if msg.startswith("Ошибка"):
+            errors.append(msg)
+        if verbose:
+            print(f"{name}: {msg}")
+
+    started = time.perf_counter()
+    try:
+        result = asyncio.run(decrypt_process(work_path, set_status, language=language, model_name=model_name))
+    except Exception as e:
+        result = None
+        errors.append(f"Ошибка: {e}")
+    finally:
+        if linked and os.path.lexists(work_path):
+            os.unlink(work_path)
+    seconds = time.perf_counter() - started
+
+    row = {'file': file_path, 'status': 'completed' if result else 'failed', 'seconds': round(seconds, 2)}
+    if result:
+        row.update(audio_seconds=result['duration'], model=result['model'], result_file=result_path)
+        with open(result_path + ".part", "w", encoding="utf-8") as f:
+            json.dump(dict(result, source=file_path, seconds=round(seconds, 2)), f, ensure_ascii=False, indent=2)
+        os.replace(result_path + ".part", result_path)
+    else:
+        row['error'] = errors[-1] if errors else "Ошибка обработки"
+    return row
+
+def run_batch(paths, list_file=None, output_dir=None, model_name=None, language=None,
+              jobs=1, cpus=None, force=False, verbose=False):
+    """
+    Пакетная обработка папок и списков файлов вне бота. Файлы делятся между
+    jobs процессами в пределах cpus ядер; каждый процесс загружает модель
+    один раз. Файлы с готовым результатом пропускаются (повторный запуск
+    продолжает прерванный пакет). Возвращает сводку по пакету.
+    """
+    import json
+    import time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+    from resources import effective_cpus
+
+    model_name = model_name or WHISPER_MODEL
+    cpus = cpus or effective_cpus()
+    jobs = max(1, min(jobs, int(cpus)))
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    pending = []
+    skipped = 0
+    for file_path, name in collect_batch_inputs(paths, list_file):
+        _, result_path = _batch_outputs(file_path, name, output_dir)
+        if not force and os.path.exists(result_path):
+            skipped += 1
+            continue
+        pending.append((file_path, name))
+    print(f"Файлов к обработке: {len(pending)}, уже готово: {skipped}, процессов: {jobs}, ядер: {cpus:g}")
+
+    # План CPU читается процессами пула из окружения при импорте resources
+    os.environ['WORKER_CPUS'] = str(cpus)
+    os.environ['WORKER_PARALLEL_JOBS'] = str(jobs)
+
+    rows = []
+    started = time.perf_counter()
+    try:
+        if pending:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_batch_init, initargs=(model_name,)) as pool:
+                futures = {
+                    pool.submit(_batch_process, file_path, name, output_dir, model_name, language, verbose): file_path
+                    for file_path, name in pending
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        # Например, BrokenProcessPool: процесс пула упал
+                        row = {'file': futures[future], 'status': 'failed', 'seconds': 0, 'error': f"Ошибка: {e!r}"}
+                    rows.append(row)
+                    print(f"[{done}/{len(pending)}] {row['status']}: {row['file']} ({row['seconds']} с)")
+    finally:
+        # Сводка пишется и при прерванном пакете: готовые результаты в ней есть
+        summary = _batch_summary(rows, pending, skipped, model_name, jobs, cpus, time.perf_counter() - started)
+        if output_dir:
+            with open(os.path.join(output_dir, BATCH_SUMMARY_FILE), "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+def _batch_summary(rows, pending, skipped, model_name, jobs, cpus, wall):
+    audio_seconds = sum(row.get('audio_seconds', 0) for row in rows)
+    summary = {
+        'files': len(pending) + skipped,
+        'completed': sum(1 for row in rows if row['status'] == 'completed'),
+        'failed': sum(1 for row in rows if row['status'] == 'failed'),
+        'skipped': skipped,
+        'model': model_name,
+        'jobs': jobs,
+        'cpus': cpus,
+        'wall_seconds': round(wall, 2),
+        'audio_seconds': round(audio_seconds, 2),
+        # Секунды аудио на секунду времени и на ядро
+        'throughput': round(audio_seconds / wall, 3) if wall > 0 else None,
+        'throughput_per_core': round(audio_seconds / (wall * cpus), 3) if wall > 0 else None,
+        'results': rows,
+    }
+    return summary
+
+if __name__ == "__main__":
+    import json
+    import argparse
 
+    parser = argparse.ArgumentParser(
+        description="Расшифровка файлов и папок вне бота: python decryptor.py <файлы или папки> [опции]"
+    )
+    parser.add_argument('paths', nargs='*', help="файлы и папки (папки обходятся рекурсивно)")
+    parser.add_argument('--list', dest='list_file', default=None, help="файл со списком путей, по одному в строке")
+    parser.add_argument('--output-dir', default=None, help="папка результатов (по умолчанию рядом с исходниками)")
+    parser.add_argument('--model', default=None, help=f"модель Whisper (по умолчанию {WHISPER_MODEL})")
+    parser.add_argument('--language', default=WHISPER_LANGUAGE, help="язык распознавания (по умолчанию определяется)")
+    parser.add_argument('--jobs', type=int, default=1, help="сколько файлов обрабатывать параллельно")
+    parser.add_argument('--cpus', type=float, default=None, help="ядра на весь пакет (по умолчанию квота контейнера)")
+    parser.add_argument('--force', action='store_true', help="обработать заново файлы с готовым результатом")
+    parser.add_argument('--verbose', action='store_true', help="печатать статусы обработки каждого файла")
+    args = parser.parse_args()
 
+    if not args.paths and not args.list_file:
+        parser.print_usage()
+        sys.exit(1)
 
+    summary = run_batch(
+        args.paths, list_file=args.list_file, output_dir=args.output_dir, model_name=args.model,
+        language=args.language, jobs=args.jobs, cpus=args.cpus, force=args.force, verbose=args.verbose
+    )
+    print(json.dumps({key: value for key, value in summary.items() if key != 'results'}, ensure_ascii=False, indent=2))
@@ -0,0 +1,159 @@
+import os
+import re
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Порт HTTP эндпоинта /metrics воркера
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9101))
+
+# RQ выполняет каждую задачу в отдельном форкнутом процессе, поэтому метрики
+# копятся не в памяти, а в общем хэше Redis: его читают и эндпоинт воркера,
+# и команда /status бота
+METRICS_KEY = 'metrics:worker'
+
+# Почасовые счетчики пропускной способности для /status
+HOURLY_KEY_PREFIX = 'metrics:worker:hour:'
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Имя -> (тип, описание)
+METRICS = {
+    'video_queue_wait_seconds': ('histogram', 'Время ожидания задачи в очереди'),
+    'video_stage_seconds': ('histogram', 'Длительность этапов обработки'),
+    'video_processing_seconds_total': ('counter', 'Суммарное время обработки задач'),
+    'video_audio_seconds_total': ('counter', 'Секунды обработанного аудио'),
+    'video_core_seconds_total': ('counter', 'Время обработки задач, умноженное на выделенные ядра'),
+    'video_audio_per_core_second': ('histogram', 'Секунды аудио на секунду одного ядра по задачам'),
+    'video_jobs_total': ('counter', 'Обработанные задачи по статусу'),
+    'video_refine_total': ('counter', 'Уточняющие проходы по статусу'),
+    'redis_latency_seconds': ('histogram', 'Задержка операций Redis'),
+}
+
+
+def hourly_key(timestamp=None):
+    return HOURLY_KEY_PREFIX + time.strftime('%Y%m%d%H', time.gmtime(timestamp))
+
+
+_LE_RE = re.compile(r'le="([^"]+)",?')
+
+
+def _sort_key(field):
+    # Бакеты гистограммы должны идти по возрастанию границы
+    match = _LE_RE.search(field)
+    if not match:
+        return (field, 0.0)
+    return (_LE_RE.sub('', field), float(match.group(1)))
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    inner = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{inner}}}"
+
+
+class RedisMetrics:
+    """Счетчики и гистограммы в формате Prometheus, хранящиеся в Redis"""
+
+    def __init__(self, conn, key=METRICS_KEY):
+        self.conn = conn
+        self.key = key
+
+    def inc(self, name, value=1, **labels):
+        try:
+            self.conn.hincrbyfloat(self.key, _series(name, labels), value)
+        except Exception as e:
+            logger.debug(f"Не удалось записать метрику {name}: {e}")
+
+    def observe(self, name, value, **labels):
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            for bound in BUCKETS:
+                if value <= bound:
+                    pipe.hincrbyfloat(self.key, _series(name + '_bucket', dict(labels, le=bound)), 1)
+            pipe.hincrbyfloat(self.key, _series(name + '_bucket', dict(labels, le='+Inf')), 1)
+            pipe.hincrbyfloat(self.key, _series(name + '_sum', labels), value)
+            pipe.hincrbyfloat(self.key, _series(name + '_count', labels), 1)
+            pipe.execute()
+        except Exception as e:
+            logger.debug(f"Не удалось записать метрику {name}: {e}")
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def record_job(self, status, processing_seconds, audio_seconds=0, cores=None):
+        """
+        Учитывает завершенную задачу в общих и почасовых счетчиках.
+        cores - ядра, выделенные задаче: по ним считается пропускная
+        способность на ядро (video_audio_seconds_total / video_core_seconds_total).
+        """
+        self.inc('video_jobs_total', status=status)
+        self.inc('video_processing_seconds_total', processing_seconds)
+        if audio_seconds:
+            self.inc('video_audio_seconds_total', audio_seconds)
+        if cores:
+            self.inc('video_core_seconds_total', processing_seconds * cores)
+            if audio_seconds and processing_seconds > 0:
+                self.observe('video_audio_per_core_second', audio_seconds / (processing_seconds * cores))
+        try:
+            key = hourly_key()
+            pipe = self.conn.pipeline(transaction=False)
+            pipe.hincrbyfloat(key, f'jobs_{status}', 1)
+            pipe.hincrbyfloat(key, 'processing_seconds', processing_seconds)
+            pipe.hincrbyfloat(key, 'audio_seconds', audio_seconds)
+            pipe.expire(key, 2 * 3600)
+            pipe.execute()
+        except Exception as e:
+            logger.debug(f"Не удалось обновить почасовые метрики: {e}")
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus"""
+        values = self.conn.hgetall(self.key)
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            series = sorted((field for field in values if field.split('{')[0] in (
+                name, name + '_bucket', name + '_sum', name + '_count')), key=_sort_key)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(f"{field} {values[field]}" for field in series)
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(metrics, port=METRICS_PORT):
+    """Запускает HTTP эндпоинт /metrics в фоновом потоке"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = metrics.render().encode('utf-8')
+            except Exception as e:
+                self.send_error(503, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Эндпоинт метрик запущен на порту {port}")
+    return server
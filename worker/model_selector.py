@@ -0,0 +1,89 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Доступные модели Whisper от самой быстрой к самой точной
+WHISPER_MODELS = [name.strip() for name in os.getenv('WHISPER_MODELS', 'tiny,base').split(',') if name.strip()]
+
+# Целевое время от постановки в очередь до результата (секунды)
+JOB_SLA_SECONDS = float(os.getenv('JOB_SLA_SECONDS', 600))
+
+# Коэффициенты реального времени (секунды обработки на секунду аудио) на CPU,
+# пока на этом хосте не накоплены собственные замеры
+DEFAULT_RTF = {
+    'tiny': 0.15,
+    'base': 0.3,
+    'small': 0.9,
+    'medium': 2.5,
+    'large': 5.0,
+}
+
+# Вес нового замера в скользящем среднем
+RTF_ALPHA = 0.3
+
+# Короткие замеры искажены загрузкой модели и не учитываются
+RTF_MIN_AUDIO_SECONDS = 10
+
+# Хэш Redis: model -> RTF, а также средняя длительность аудио в задаче
+RTF_KEY = 'models:rtf'
+AVG_AUDIO_FIELD = '_avg_audio_seconds'
+
+
+class ModelSelector:
+    """
+    Выбор модели под задачу: самая точная из моделей, которая успевает
+    к сроку с учетом времени в очереди и задач, ожидающих за текущей.
+    """
+
+    def __init__(self, conn, models=WHISPER_MODELS, sla=JOB_SLA_SECONDS):
+        self.conn = conn
+        self.models = models
+        self.sla = sla
+
+    def _stats(self):
+        try:
+            return {field: float(value) for field, value in self.conn.hgetall(RTF_KEY).items()}
+        except Exception as e:
+            logger.error(f"Ошибка чтения замеров моделей: {e}")
+            return {}
+
+    def rtf(self, model_name, stats=None):
+        stats = self._stats() if stats is None else stats
+        return stats.get(model_name, DEFAULT_RTF.get(model_name, 1.0))
+
+    def choose(self, duration, waited=0, queue_depth=0, workers=1):
+        """
+        duration - длительность аудио задачи, waited - сколько она уже ждала,
+        queue_depth - задачи в очереди за ней, workers - число воркеров.
+        """
+        fastest = self.models[0]
+        if not duration or len(self.models) == 1:
+            return fastest
+
+        stats = self._stats()
+        # Очередь за задачей разбирается самой быстрой моделью: ее время
+        # делится между воркерами и вычитается из запаса по сроку
+        avg_audio = stats.get(AVG_AUDIO_FIELD, duration)
+        backlog = queue_depth * avg_audio * self.rtf(fastest, stats) / max(workers, 1)
+        budget = self.sla - waited - backlog
+
+        for model_name in reversed(self.models):
+            if duration * self.rtf(model_name, stats) <= budget:
+                return model_name
+        return fastest
+
+    def record(self, model_name, audio_seconds, processing_seconds):
+        """Обновляет скользящие средние по итогам задачи"""
+        if not model_name or audio_seconds < RTF_MIN_AUDIO_SECONDS:
+            return
+        try:
+            stats = self._stats()
+            measured = processing_seconds / audio_seconds
+            rtf = stats.get(model_name)
+            rtf = measured if rtf is None else (1 - RTF_ALPHA) * rtf + RTF_ALPHA * measured
+            avg_audio = stats.get(AVG_AUDIO_FIELD)
+            avg_audio = audio_seconds if avg_audio is None else (1 - RTF_ALPHA) * avg_audio + RTF_ALPHA * audio_seconds
+            self.conn.hset(RTF_KEY, mapping={model_name: rtf, AVG_AUDIO_FIELD: avg_audio})
+        except Exception as e:
+            logger.error(f"Ошибка сохранения замера модели {model_name}: {e}")
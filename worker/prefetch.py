@@ -0,0 +1,156 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+
+from decryptor import probe_media, needs_transcode, convert_to_mp3
+from resources import memory_headroom
+from spool import register_task_file
+
+logger = logging.getLogger(__name__)
+
+# Сколько задач из начала очереди готовится заранее (0 - выключено)
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', 1))
+
+# Подготовка не начинается, если до лимита памяти меньше этого запаса
+PREFETCH_MIN_FREE_MB = int(os.getenv('PREFETCH_MIN_FREE_MB', 300))
+
+# Интервал проверки очереди (секунды)
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', 2.0))
+
+# Сколько задача ждет начатую для нее подготовку (секунды)
+PREFETCH_WAIT = int(os.getenv('PREFETCH_WAIT', 600))
+
+# Приоритет (nice) ffmpeg подготовки: распознавание текущей задачи важнее
+PREFETCH_NICE = 10
+
+# prefetch:{task_id} - задачу готовит один из воркеров
+PREFETCH_KEY_PREFIX = 'prefetch:'
+PREFETCH_LOCK_TTL = 1800
+
+CANCEL_KEY_PREFIX = 'cancel:'
+
+MB = 1024 * 1024
+
+
+def wait_for_prefetch(conn, task_id, should_cancel=None, timeout=PREFETCH_WAIT):
+    """
+    Ждет окончания подготовки файла задачи, если она уже идет: вторая
+    конвертация того же файла только отняла бы ядра у распознавания.
+    """
+    key = PREFETCH_KEY_PREFIX + task_id
+    deadline = time.monotonic() + timeout
+    try:
+        while conn.exists(key) and time.monotonic() < deadline:
+            if should_cancel and should_cancel():
+                return
+            time.sleep(0.5)
+    except Exception as e:
+        logger.error(f"Ошибка ожидания подготовки задачи {task_id}: {e}")
+
+
+class Prefetcher:
+    """
+    Подготовка следующих задач очереди, пока воркер занят текущей.
+
+    Работает потоком основного процесса RQ (задачи выполняются в форкнутых
+    процессах) и конвертирует входные файлы первых задач очереди в mp3
+    рядом с исходником. convert_to_mp3 в задаче находит готовый файл
+    и пропускает конвертацию, так что модель сразу получает аудио.
+    Файлы, которые декодируются напрямую, не готовятся.
+    """
+
+    def __init__(self, conn, conn_rq, worker, queue_name, depth=PREFETCH_DEPTH, interval=PREFETCH_INTERVAL):
+        self.conn = conn
+        self.queue = Queue(queue_name, connection=conn_rq)
+        self.conn_rq = conn_rq
+        self.worker = worker
+        self.depth = depth
+        self.interval = interval
+        # Задачи, которые уже подготовлены или не нуждаются в подготовке
+        self._seen = set()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+
+    def start(self):
+        if self.depth > 0:
+            self._thread.start()
+            logger.info(f"Подготовка задач включена: глубина {self.depth}")
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        # Потоки Linux имеют собственный nice; ffmpeg наследует его
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREFETCH_NICE)
+        except Exception as e:
+            logger.debug(f"Не удалось понизить приоритет подготовки: {e}")
+        while not self._stopped.wait(self.interval):
+            try:
+                # Свободный воркер сам возьмет задачу: готовить ее незачем
+                if self.worker.get_state() != 'busy':
+                    continue
+                self.prefetch_next()
+            except Exception as e:
+                logger.error(f"Ошибка подготовки задач: {e}")
+
+    def _has_memory(self):
+        headroom = memory_headroom()
+        return headroom is None or headroom >= PREFETCH_MIN_FREE_MB * MB
+
+    def prefetch_next(self):
+        """Готовит первую неподготовленную задачу из начала очереди"""
+        for job_id in self.queue.get_job_ids(0, self.depth):
+            if not self._has_memory():
+                return
+            try:
+                job = Job.fetch(job_id, connection=self.conn_rq)
+            except NoSuchJobError:
+                continue
+            task_data = job.args[0] if job.args else None
+            if not isinstance(task_data, dict) or job_id in self._seen:
+                continue
+            if len(self._seen) > 1000:
+                self._seen.clear()
+            self._seen.add(job_id)
+            if self.prefetch(task_data, job):
+                return
+
+    def prefetch(self, task_data, job=None):
+        """Конвертирует файл задачи; True, если конвертация выполнялась"""
+        task_id = task_data['task_id']
+        file_path = task_data['file_path']
+        mp3_path = os.path.splitext(file_path)[0] + ".mp3"
+        if not os.path.isfile(file_path) or os.path.isfile(mp3_path):
+            return False
+        if self.conn.exists(CANCEL_KEY_PREFIX + task_id):
+            return False
+        if not self.conn.set(PREFETCH_KEY_PREFIX + task_id, '1', nx=True, ex=PREFETCH_LOCK_TTL):
+            self._seen.discard(task_id)
+            return False
+        try:
+            # Задачу могли взять между чтением очереди и блокировкой:
+            # тогда воркер задачи уже не ждет подготовку и конвертирует сам
+            if job is not None and job.get_status(refresh=True) != JobStatus.QUEUED:
+                return False
+            media_info = asyncio.run(probe_media(file_path))
+            if media_info is None or not media_info['has_audio'] or not needs_transcode(media_info):
+                return False
+            started = time.perf_counter()
+            # Без запасного пути через pydub: он держал бы весь файл в памяти
+            # основного процесса воркера
+            if asyncio.run(convert_to_mp3(file_path, fallback=False)) is not None:
+                register_task_file(self.conn, task_id, mp3_path)
+                logger.info(f"Задача {task_id}: файл подготовлен заранее за {time.perf_counter() - started:.1f} с")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка подготовки задачи {task_id}: {e}")
+            return False
+        finally:
+            self.conn.delete(PREFETCH_KEY_PREFIX + task_id)
@@ -0,0 +1,177 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import logging
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+from decryptor import add_stage_observer, remove_stage_observer
+
+logger = logging.getLogger(__name__)
+
+# Профилировать все задачи (иначе только с флагом profile в task_data)
+PROFILE_JOBS = os.getenv('PROFILE_JOBS', '').lower() in ('1', 'true', 'yes')
+
+# Сколько хранить отчеты в Redis
+PROFILE_TTL = int(os.getenv('PROFILE_TTL', 7 * 24 * 3600))
+
+PROFILE_KEY_PREFIX = 'profile:'
+PROFILE_RECENT_KEY = 'profiles:recent'
+PROFILE_RECENT_LIMIT = 20
+
+# Сколько самых тяжелых функций попадает в отчет
+PROFILE_TOP_FUNCTIONS = 25
+
+
+def profiling_requested(task_data):
+    return PROFILE_JOBS or bool(task_data.get('profile'))
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except Exception:
+        return None
+
+
+class JobProfiler:
+    """
+    Профилирование одной задачи: CPU профиль (cProfile), пик памяти Python
+    (tracemalloc) и RSS по этапам decrypt_process, время вызовов ffmpeg.
+    Этапы приходят через наблюдатель track_stage из decryptor.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.stages = {}
+        self._open = []
+        self._lock = threading.Lock()
+        self._main_profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._local = threading.local()
+        self._main_thread = None
+        self.started_at = None
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def __enter__(self):
+        self.started_at = datetime.now().isoformat()
+        self._main_thread = threading.get_ident()
+        tracemalloc.start()
+        add_stage_observer(self.stage)
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._main_profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._main_profile.disable()
+        self.wall = time.perf_counter() - self._wall_start
+        self.cpu = time.process_time() - self._cpu_start
+        remove_stage_observer(self.stage)
+        tracemalloc.stop()
+        return False
+
+    def _fold_peak(self):
+        # Пик tracemalloc общий на процесс: учитываем его во всех открытых
+        # этапах перед сбросом, чтобы вложенные этапы не теряли пик внешних
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in self._open:
+            entry['peak'] = max(entry['peak'], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name):
+        # cProfile работает только в том потоке, где включен, поэтому этапы
+        # в потоках executor (транскрибация) профилируются отдельно
+        thread_profile = None
+        if threading.get_ident() != self._main_thread and not getattr(self._local, 'active', False):
+            thread_profile = cProfile.Profile()
+            self._local.active = True
+            thread_profile.enable()
+
+        entry = {'peak': 0}
+        with self._lock:
+            self._fold_peak()
+            self._open.append(entry)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            children_cpu = (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+            with self._lock:
+                self._fold_peak()
+                self._open = [other for other in self._open if other is not entry]
+                stats = self.stages.setdefault(name, {
+                    'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                    'children_cpu_seconds': 0.0, 'tracemalloc_peak_mb': 0.0, 'rss_peak_mb': 0.0,
+                })
+                stats['calls'] += 1
+                stats['wall_seconds'] += wall
+                stats['cpu_seconds'] += cpu
+                stats['children_cpu_seconds'] += children_cpu
+                stats['tracemalloc_peak_mb'] = max(stats['tracemalloc_peak_mb'], entry['peak'] / (1024 * 1024))
+                # ru_maxrss - пик RSS процесса на момент окончания этапа (КБ)
+                stats['rss_peak_mb'] = max(stats['rss_peak_mb'], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+            if thread_profile is not None:
+                thread_profile.disable()
+                self._local.active = False
+                with self._lock:
+                    self._thread_profiles.append(thread_profile)
+
+    def _top_functions(self):
+        stats = pstats.Stats(self._main_profile, stream=io.StringIO())
+        for profile in self._thread_profiles:
+            stats.add(profile)
+        rows = []
+        for (filename, line, func), (cc, nc, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                'function': f"{os.path.basename(filename)}:{line}({func})",
+                'calls': nc,
+                'tottime': round(tottime, 3),
+                'cumtime': round(cumtime, 3),
+            })
+        rows.sort(key=lambda row: row['tottime'], reverse=True)
+        return rows[:PROFILE_TOP_FUNCTIONS]
+
+    def report(self):
+        stages = {
+            name: {key: round(value, 3) if isinstance(value, float) else value for key, value in stats.items()}
+            for name, stats in self.stages.items()
+        }
+        return {
+            'task_id': self.task_id,
+            'started_at': self.started_at,
+            'wall_seconds': round(self.wall, 3),
+            'cpu_seconds': round(self.cpu, 3),
+            'rss_peak_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'rss_current_mb': round(_rss_mb() or 0, 1),
+            'stages': {name: stats for name, stats in stages.items() if not name.startswith('ff')},
+            'ffmpeg': {name: stats for name, stats in stages.items() if name.startswith('ff')},
+            'top_functions': self._top_functions(),
+        }
+
+    def save(self, conn):
+        """Сохраняет компактный отчет в Redis по task_id"""
+        try:
+            report = self.report()
+            pipe = conn.pipeline()
+            pipe.set(PROFILE_KEY_PREFIX + self.task_id, json.dumps(report, ensure_ascii=False), ex=PROFILE_TTL)
+            pipe.lpush(PROFILE_RECENT_KEY, self.task_id)
+            pipe.ltrim(PROFILE_RECENT_KEY, 0, PROFILE_RECENT_LIMIT - 1)
+            pipe.execute()
+            logger.info(f"Отчет профилирования задачи {self.task_id} сохранен")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения отчета профилирования {self.task_id}: {e}")
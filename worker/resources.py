@@ -0,0 +1,222 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Число ядер для воркера; 0 - определить по квоте cgroup и маске процесса
+WORKER_CPUS = float(os.getenv('WORKER_CPUS', 0))
+
+# Сколько задач одновременно делят эти ядра (процессы воркера в контейнере);
+# 0 - по числу задач, занятых на хосте в момент старта задачи (supervisor.py)
+WORKER_PARALLEL_JOBS = int(os.getenv('WORKER_PARALLEL_JOBS', 1))
+
+# Потоки декодирования ffmpeg на задачу; 0 - по плану
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', 0))
+
+# Закрепление процесса за своей долей ядер; номер доли - WORKER_SLOT,
+# число долей - WORKER_PIN_SLOTS (0 - по WORKER_PARALLEL_JOBS; супервизор
+# передает WORKER_MAX_PROCESSES)
+CPU_PINNING = os.getenv('CPU_PINNING', '').lower() in ('1', 'true', 'yes')
+WORKER_SLOT = int(os.getenv('WORKER_SLOT', 0))
+WORKER_PIN_SLOTS = int(os.getenv('WORKER_PIN_SLOTS', 0))
+
+# Декодирование аудио почти не масштабируется дальше пары потоков
+FFMPEG_MAX_THREADS = 2
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+CGROUP_V2_MEMORY_MAX = '/sys/fs/cgroup/memory.max'
+CGROUP_V2_MEMORY_CURRENT = '/sys/fs/cgroup/memory.current'
+CGROUP_V1_MEMORY_LIMIT = '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+CGROUP_V1_MEMORY_USAGE = '/sys/fs/cgroup/memory/memory.usage_in_bytes'
+
+# Лимиты cgroup v1 выше этого значения означают отсутствие лимита
+CGROUP_V1_UNLIMITED = 1 << 60
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_quota():
+    """Квота CPU контейнера в ядрах или None, если квоты нет"""
+    cpu_max = _read(CGROUP_V2_CPU_MAX)
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+    quota, period = _read(CGROUP_V1_QUOTA), _read(CGROUP_V1_PERIOD)
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def memory_headroom():
+    """
+    Свободная память контейнера до лимита cgroup в байтах; без лимита -
+    MemAvailable системы. None, если узнать не удалось.
+    """
+    limit, usage = _read(CGROUP_V2_MEMORY_MAX), _read(CGROUP_V2_MEMORY_CURRENT)
+    if limit is None:
+        limit, usage = _read(CGROUP_V1_MEMORY_LIMIT), _read(CGROUP_V1_MEMORY_USAGE)
+        if limit and int(limit) >= CGROUP_V1_UNLIMITED:
+            limit = 'max'
+    if limit and limit != 'max' and usage:
+        return int(limit) - int(usage)
+    meminfo = _read('/proc/meminfo') or ''
+    for line in meminfo.splitlines():
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def available_cores():
+    """Ядра, на которых процессу разрешено выполняться"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def effective_cpus():
+    """
+    Сколько ядер реально доступно: явная настройка, иначе меньшее из квоты
+    cgroup и маски процесса. torch и ffmpeg сами видят все ядра хоста.
+    """
+    if WORKER_CPUS > 0:
+        return WORKER_CPUS
+    cores = len(available_cores())
+    quota = cgroup_cpu_quota()
+    return min(cores, quota) if quota else cores
+
+
+class CpuPlan:
+    """
+    Распределение ядер между параллельными задачами и внутри задачи.
+
+    Внутри задачи декодирование части и распознавание идут по очереди,
+    поэтому torch получает всю долю задачи, а ffmpeg - не больше пары
+    потоков. Межоператорный пул torch не нужен: модель выполняется
+    последовательно, а лишние потоки лишь конкурируют за ядра.
+    """
+
+    def __init__(self, cpus=None, parallel_jobs=WORKER_PARALLEL_JOBS, ffmpeg_threads=FFMPEG_THREADS):
+        self.cpus = cpus if cpus is not None else effective_cpus()
+        self.parallel_jobs = max(parallel_jobs, 1)
+        self.job_cpus = max(self.cpus / self.parallel_jobs, 1.0)
+        self.torch_threads = max(int(self.job_cpus), 1)
+        self.torch_interop_threads = 1
+        self.ffmpeg_threads = ffmpeg_threads or min(self.torch_threads, FFMPEG_MAX_THREADS)
+
+    def as_dict(self):
+        return {
+            'cpus': self.cpus,
+            'parallel_jobs': self.parallel_jobs,
+            'job_cpus': self.job_cpus,
+            'torch_threads': self.torch_threads,
+            'torch_interop_threads': self.torch_interop_threads,
+            'ffmpeg_threads': self.ffmpeg_threads,
+        }
+
+    def apply_environment(self):
+        """
+        Переменные для OpenMP/MKL: наследуются форкнутыми процессами задач
+        и действуют, даже если torch импортирован до configure_torch.
+        """
+        for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            os.environ.setdefault(name, str(self.torch_threads))
+
+    def pin_slots(self):
+        """На сколько долей делятся ядра при закреплении"""
+        return WORKER_PIN_SLOTS if WORKER_PIN_SLOTS > 0 else self.parallel_jobs
+
+    def pin(self, slot=WORKER_SLOT, slots=None):
+        """
+        Закрепляет процесс за своей долей ядер (наследуется процессами задач).
+        Возвращает ядра доли.
+        """
+        slots = slots or self.pin_slots()
+        cores = available_cores()
+        per_slot = max(len(cores) // slots, 1)
+        start = (slot % slots) * per_slot
+        selected = cores[start:start + per_slot] or cores
+        try:
+            os.sched_setaffinity(0, selected)
+            logger.info(f"Процесс закреплен за ядрами {selected}")
+        except Exception as e:
+            logger.error(f"Не удалось закрепить процесс за ядрами {selected}: {e}")
+        return selected
+
+
+_plan = None
+_torch_configured = False
+
+
+def cpu_plan():
+    """План, общий для процесса (вычисляется один раз)"""
+    global _plan
+    if _plan is None:
+        _plan = CpuPlan()
+    return _plan
+
+
+def elastic_plan():
+    """
+    Доля ядер задачи считается при ее старте, а не при запуске процесса.
+    Закрепленный процесс ядра ни с кем не делит: его доля постоянна.
+    """
+    return WORKER_PARALLEL_JOBS <= 0 and not CPU_PINNING
+
+
+def replan(parallel_jobs):
+    """
+    Пересчитывает план процесса задачи под число задач, делящих ядра
+    сейчас. Потоки torch переустанавливаются при следующем configure_torch,
+    ffmpeg берет потоки из нового плана.
+    """
+    global _plan, _torch_configured
+    _plan = CpuPlan(parallel_jobs=parallel_jobs)
+    _torch_configured = False
+    configure_torch()
+    return _plan
+
+
+def configure_torch():
+    """
+    Размер пулов потоков torch по плану. Межоператорный пул можно задать
+    только до первой параллельной операции, поэтому настройка однократная.
+    """
+    global _torch_configured
+    if _torch_configured:
+        return
+    _torch_configured = True
+    plan = cpu_plan()
+    try:
+        import torch
+        torch.set_num_threads(plan.torch_threads)
+        torch.set_num_interop_threads(plan.torch_interop_threads)
+    except Exception as e:
+        logger.debug(f"Не удалось настроить потоки torch: {e}")
+
+
+def setup_worker_resources():
+    """Вызывается при старте воркера до приема задач"""
+    global _plan
+    plan = cpu_plan()
+    if CPU_PINNING:
+        slots = plan.pin_slots()
+        selected = plan.pin(slots=slots)
+        # Задачи процесса получают всю его долю ядер (и квоты контейнера)
+        _plan = plan = CpuPlan(cpus=max(min(plan.cpus / slots, len(selected)), 1.0), parallel_jobs=1)
+    plan.apply_environment()
+    logger.info(
+        f"Ресурсы CPU: {plan.cpus:g} ядер, задач параллельно {plan.parallel_jobs}, "
+        f"потоков torch {plan.torch_threads}, потоков ffmpeg {plan.ffmpeg_threads}"
+    )
+    return plan
@@ -0,0 +1,76 @@
+from array import array
+
+
+class SegmentStore:
+    """
+    Компактное хранение сегментов длинной расшифровки.
+
+    Сегменты Whisper - словари с токенами и словами; на многочасовых файлах
+    их сотни тысяч. Здесь остаются только колонки start/end/score
+    в массивах и текст всех сегментов в одном буфере UTF-8 со смещениями.
+    Итерация отдает по одному небольшому словарю {'start', 'end', 'text'},
+    поэтому запись и саммаризатор работают с хранилищем как со списком.
+    """
+
+    __slots__ = ('starts', 'ends', 'scores', 'offsets', 'buffer')
+
+    def __init__(self, segments=None):
+        self.starts = array('d')
+        self.ends = array('d')
+        self.scores = array('f')
+        # offsets[i]:offsets[i + 1] - байты текста i-го сегмента в buffer
+        self.offsets = array('q', [0])
+        self.buffer = bytearray()
+        if segments:
+            self.extend(segments)
+
+    def append(self, start, end, text, score=0.0):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.scores.append(score)
+        self.buffer += text.encode('utf-8')
+        self.offsets.append(len(self.buffer))
+
+    def extend(self, segments):
+        """Добавляет сегменты Whisper; токены и слова не сохраняются"""
+        for seg in segments:
+            self.append(seg['start'], seg['end'], seg['text'], seg.get('avg_logprob') or 0.0)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return len(self.starts) > 0
+
+    def text_at(self, idx):
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].decode('utf-8')
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return {'start': self.starts[idx], 'end': self.ends[idx], 'text': self.text_at(idx)}
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    @property
+    def text_size(self):
+        """Размер текста в байтах UTF-8"""
+        return len(self.buffer)
+
+    @property
+    def duration(self):
+        return self.ends[-1] if self.ends else 0
+
+    def text(self, limit=None):
+        """
+        Полный текст одним декодированием буфера; с limit - только первые
+        limit символов (превью для результата задачи).
+        """
+        if limit is None:
+            return self.buffer.decode('utf-8')
+        # В UTF-8 символ занимает не больше 4 байт
+        return self.buffer[:limit * 4].decode('utf-8', errors='ignore')[:limit]
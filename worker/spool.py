@@ -0,0 +1,96 @@
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранится запись расшифровки после завершения задачи
+# (совпадает с EXPORT_TTL бота; бот продлевает срок при экспорте)
+SPOOL_RESULT_TTL = int(os.getenv('SPOOL_RESULT_TTL', 3600))
+
+# Раскладка ключей в Redis (совпадает с bot/spool.py):
+# spool:task:{task_id} - множество путей, принадлежащих задаче
+SPOOL_TASK_KEY_PREFIX = 'spool:task:'
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _contains(owned, path):
+    return path == owned or path.startswith(owned + os.sep)
+
+
+def _prune(directory, keep):
+    """Удаляет из папки все, кроме путей keep и папок на пути к ним"""
+    for entry in os.scandir(directory):
+        path = entry.path
+        if any(path == keep_path for keep_path in keep):
+            continue
+        if entry.is_dir(follow_symlinks=False) and any(_contains(path, keep_path) for keep_path in keep):
+            _prune(path, keep)
+            continue
+        _remove(path)
+
+
+def release_task_files(conn, task_id, keep=(), ttl=SPOOL_RESULT_TTL):
+    """
+    Удаляет файлы задачи после обработки, кроме путей из keep: они остаются
+    за задачей на ttl секунд, после чего их убирает сборщик бота. Из папки
+    задачи (распакованный архив) удаляется все, кроме путей keep, а сама
+    папка остается зарегистрированной, чтобы сборщик убрал ее целиком.
+    Возвращает число путей задачи; 0 означает, что задача не регистрировала файлы.
+    """
+    key = SPOOL_TASK_KEY_PREFIX + task_id
+    try:
+        paths = conn.smembers(key)
+    except Exception as e:
+        logger.error(f"Ошибка чтения файлов задачи {task_id}: {e}")
+        return 0
+
+    kept = []
+    for path in paths:
+        inner = [keep_path for keep_path in keep if _contains(path, keep_path)]
+        if inner:
+            kept.append(path)
+            if path not in inner and os.path.isdir(path) and not os.path.islink(path):
+                try:
+                    _prune(path, inner)
+                    logger.info(f"Папка {path} очищена, оставлено файлов: {len(inner)}")
+                except Exception as e:
+                    logger.error(f"Ошибка очистки папки {path}: {e}")
+            continue
+        try:
+            _remove(path)
+            logger.info(f"Временный файл {path} удален")
+        except Exception as e:
+            logger.error(f"Ошибка удаления файла {path}: {e}")
+
+    # Оставленные файлы регистрируются явно, даже если лежат рядом с входным
+    remaining = set(kept) | set(keep)
+    try:
+        pipe = conn.pipeline(transaction=True)
+        pipe.delete(key)
+        if remaining:
+            pipe.sadd(key, *remaining)
+            pipe.expire(key, ttl)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Ошибка обновления файлов задачи {task_id}: {e}")
+    return len(paths)
+
+
+def register_task_file(conn, task_id, path):
+    """
+    Добавляет файл к файлам задачи, пока задача их учитывает
+    (например, mp3, подготовленный заранее другим процессом).
+    """
+    key = SPOOL_TASK_KEY_PREFIX + task_id
+    try:
+        if conn.exists(key):
+            conn.sadd(key, path)
+    except Exception as e:
+        logger.error(f"Ошибка регистрации файла {path} задачи {task_id}: {e}")
@@ -0,0 +1,206 @@
+"""
+Экстрактивная саммаризация расшифровки.
+
+Предложения взвешиваются по TF-IDF: оценка предложения - косинусная
+близость к центроиду всего текста. Все шаги (токенизация, построение
+разреженной матрицы, оценка, отбор) линейны по длине расшифровки,
+поэтому многочасовые записи обрабатываются за доли секунды.
+"""
+import os
+import re
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+# Максимальное количество предложений в саммари
+SUMMARY_MAX_SENTENCES = int(os.getenv('SUMMARY_MAX_SENTENCES', 10))
+
+# Максимальная длина саммари в символах: вместе с началом расшифровки
+# оно уходит одним сообщением Telegram (лимит 4096 символов)
+SUMMARY_MAX_CHARS = int(os.getenv('SUMMARY_MAX_CHARS', 1500))
+
+# Сколько промежуточных предложений копится до очередной свертки
+REDUCE_POOL_LIMIT = SUMMARY_MAX_SENTENCES * 8
+
+# Порог косинусной близости, выше которого предложение считается повтором
+REDUNDANCY_THRESHOLD = 0.5
+
+_SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+')
+_TOKEN_RE = re.compile(r'[^\W\d_]{3,}')
+
+_STOPWORDS = frozenset("""
+    это как так что все она они оно его её ее них нас вас вам нам мне меня тебя
+    тебе был была было были быть будет есть нет для при про над под без или
+    если уже еще ещё вот там тут где когда чтобы тоже только даже очень может
+    можно нужно надо этот эта эти того тому том тех чем кто какой которые
+    который которая которое просто потому поэтому вообще значит ну вот
+    the and that this with for are was were you your have has had not but
+    they them their what which who will would there from been can could
+    about just like into than then also our out all any its it's
+""".split())
+
+
+def split_sentences(text, start=0.0):
+    """Разбивает текст на предложения, помечая их временем начала"""
+    return [(start, sentence.strip()) for sentence in _SENTENCE_RE.split(text) if sentence.strip()]
+
+
+def _tfidf_matrix(sentences):
+    """
+    Строит L2-нормированную разреженную TF-IDF матрицу (предложения x слова)
+    и возвращает её вместе с количеством значимых слов в каждом предложении.
+    """
+    vocabulary = {}
+    indptr = [0]
+    indices = []
+    for _, sentence in sentences:
+        for token in _TOKEN_RE.findall(sentence.lower()):
+            if token not in _STOPWORDS:
+                indices.append(vocabulary.setdefault(token, len(vocabulary)))
+        indptr.append(len(indices))
+
+    counts = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(sentences), len(vocabulary)),
+    )
+    counts.sum_duplicates()
+    lengths = np.diff(counts.indptr)
+
+    df = np.bincount(counts.indices, minlength=len(vocabulary))
+    idf = np.log((1.0 + len(sentences)) / (1.0 + df)) + 1.0
+    counts.data = np.log1p(counts.data) * idf[counts.indices].astype(np.float32)
+
+    norms = np.sqrt(np.asarray(counts.multiply(counts).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms) @ counts, lengths
+
+
+def select_sentences(sentences, max_sentences=SUMMARY_MAX_SENTENCES, target=None):
+    """
+    Выбирает ключевые предложения и возвращает их в хронологическом порядке.
+    sentences - список пар (время начала, текст). Если target не задан,
+    размер выборки растет как ~sqrt(n), но не больше max_sentences.
+    """
+    if len(sentences) <= 1:
+        return list(sentences)
+
+    matrix, lengths = _tfidf_matrix(sentences)
+    if matrix.shape[1] == 0:
+        return list(sentences[:1])
+
+    centroid = np.asarray(matrix.sum(axis=0)).ravel()
+    centroid /= np.linalg.norm(centroid) or 1.0
+    scores = matrix @ centroid
+    # Короткие реплики ("да", "ага, понятно") редко несут смысл
+    scores *= np.minimum(1.0, lengths / 6.0)
+
+    if target is None:
+        target = min(max_sentences, max(3, int(math.sqrt(len(sentences)))))
+
+    # Кандидаты берутся из всего ранжированного списка, пока не наберется
+    # target непохожих предложений: в повторяющейся расшифровке лучшие
+    # кандидаты могут оказаться почти одинаковыми. Близость к каждому
+    # выбранному предложению считается сразу для всех предложений, поэтому
+    # на отбор уходит не больше target умножений разреженной матрицы
+    redundant = np.zeros(len(sentences), dtype=bool)
+    selected = []
+    for idx in np.argsort(-scores, kind='stable'):
+        if scores[idx] <= 0:
+            break
+        if redundant[idx]:
+            continue
+        selected.append(idx)
+        if len(selected) >= target:
+            break
+        similarity = np.asarray((matrix @ matrix[idx].T).todense()).ravel()
+        redundant |= similarity > REDUNDANCY_THRESHOLD
+
+    return [sentences[idx] for idx in sorted(selected)]
+
+
+def sentences_from_segments(segments):
+    sentences = []
+    for seg in segments:
+        sentences.extend(split_sentences(seg['text'], seg['start']))
+    return sentences
+
+
+def format_clock(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02}:{(seconds // 60) % 60:02}:{seconds % 60:02}"
+
+
+def _format_summary(picked, timed, max_chars=SUMMARY_MAX_CHARS):
+    """
+    Склеивает предложения, пока саммари укладывается в max_chars;
+    слишком длинное первое предложение обрезается
+    """
+    separator = "\n" if timed else " "
+    summary = ""
+    for start, sentence in picked:
+        line = f"[{format_clock(start)}] {sentence}" if timed else sentence
+        candidate = summary + separator + line if summary else line
+        if len(candidate) > max_chars:
+            if not summary:
+                summary = line[:max_chars - 1] + "…"
+            break
+        summary = candidate
+    return summary
+
+
+def summarize(text, segments=None, max_sentences=SUMMARY_MAX_SENTENCES):
+    """
+    Строит саммари из ключевых предложений. Если переданы сегменты,
+    каждое предложение помечается таймкодом начала.
+    """
+    if segments:
+        return _format_summary(select_sentences(sentences_from_segments(segments), max_sentences), True)
+    return _format_summary(select_sentences(split_sentences(text or ""), max_sentences), False)
+
+
+class MapReduceSummarizer:
+    """
+    Иерархическая саммаризация, работающая параллельно с транскрибацией.
+
+    Каждая часть расшифровки сразу после распознавания сворачивается
+    в фоновом потоке до ключевых предложений (map). Накопленные предложения
+    периодически сворачиваются повторно, поэтому финальная свертка (reduce)
+    после последней части работает с ограниченным объемом данных
+    независимо от длины записи.
+    """
+
+    def __init__(self, max_sentences=SUMMARY_MAX_SENTENCES):
+        self.max_sentences = max_sentences
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summarizer')
+        self._futures = []
+        self._pool = []
+
+    def add_chunk(self, segments):
+        """Ставит часть расшифровки в очередь на саммаризацию и сразу возвращается"""
+        sentences = sentences_from_segments(segments)
+        self._futures.append(self._executor.submit(self._map, sentences))
+
+    def _map(self, sentences):
+        # Выполняется в единственном фоновом потоке, поэтому _pool без блокировок
+        self._pool.extend(select_sentences(sentences, self.max_sentences))
+        if len(self._pool) > REDUCE_POOL_LIMIT:
+            self._pool = select_sentences(self._pool, target=self.max_sentences * 2)
+
+    def reduce(self):
+        """Дожидается всех частей и строит итоговое саммари с таймкодами"""
+        try:
+            for future in self._futures:
+                future.result()
+            return _format_summary(select_sentences(self._pool, target=self.max_sentences), True)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Останавливает фоновый поток; несвернутые части отбрасываются.
+        Вызывается и при ошибке или отмене задачи, когда reduce не дошел:
+        процессы пакетного режима живут дольше задачи.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
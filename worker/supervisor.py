@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import uuid
+import signal
+import socket
+import logging
+import subprocess
+from datetime import datetime, timezone
+import redis
+from rq import Queue, Worker
+from metrics import RedisMetrics, start_metrics_server
+from resources import memory_headroom
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Настройки Redis
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+REDIS_DB = int(os.getenv('REDIS_DB', 0))
+
+# Очередь, по которой считается нагрузка (см. worker.py)
+VIDEO_QUEUE = 'video_processing'
+
+# Сколько процессов воркера держать в контейнере
+WORKER_MIN_PROCESSES = int(os.getenv('WORKER_MIN_PROCESSES', 1))
+WORKER_MAX_PROCESSES = int(os.getenv('WORKER_MAX_PROCESSES', 2))
+
+# Память, которую занимает один процесс воркера с моделью (МБ): новый
+# процесс запускается, только если столько свободно сверх запаса
+WORKER_PROCESS_MEMORY_MB = int(os.getenv('WORKER_PROCESS_MEMORY_MB', 500))
+WORKER_MEMORY_RESERVE_MB = int(os.getenv('WORKER_MEMORY_RESERVE_MB', 150))
+
+# Задача без свободного процесса ждет в очереди столько секунд, прежде
+# чем запускается еще один процесс
+SCALE_UP_WAIT = float(os.getenv('SCALE_UP_WAIT', 15))
+
+# Процесс сверх минимума останавливается после стольких секунд простоя
+SCALE_DOWN_IDLE = float(os.getenv('SCALE_DOWN_IDLE', 300))
+
+# Интервал проверки очереди и процессов (секунды)
+SUPERVISOR_INTERVAL = float(os.getenv('SUPERVISOR_INTERVAL', 5))
+
+# Процесс, не зарегистрировавшийся в RQ за это время, считается зависшим
+# при старте и перестает учитываться как свободный
+WORKER_START_TIMEOUT = 120
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+MB = 1024 * 1024
+
+
+class WorkerProcess:
+    """Процесс воркера под супервизором и его состояние в RQ"""
+
+    def __init__(self, slot, name, popen):
+        self.slot = slot
+        self.name = name
+        self.popen = popen
+        self.started_at = time.monotonic()
+        self.idle_since = None
+        self.state = 'starting'
+        self.retiring = False
+
+    @property
+    def pid(self):
+        return self.popen.pid
+
+    def alive(self):
+        return self.popen.poll() is None
+
+    def retire(self):
+        """
+        SIGTERM - теплая остановка RQ: текущая задача дорабатывает,
+        новые не берутся
+        """
+        if not self.retiring and self.alive():
+            self.retiring = True
+            self.popen.send_signal(signal.SIGTERM)
+
+
+class WorkerSupervisor:
+    """
+    Эластичный пул процессов воркера в одном контейнере.
+
+    Новый процесс запускается, когда задачам очереди не хватает свободных
+    процессов и самая старая ждет дольше scale_up_wait, при условии что
+    после запуска останется запас памяти. Процесс сверх минимума, простоявший
+    scale_down_idle секунд при пустой очереди, останавливается. За раз
+    запускается или останавливается не больше одного процесса: загрузка
+    модели сама по себе нагружает CPU и память.
+    """
+
+    def __init__(self, conn, min_processes=WORKER_MIN_PROCESSES, max_processes=WORKER_MAX_PROCESSES,
+                 process_memory_mb=WORKER_PROCESS_MEMORY_MB, reserve_mb=WORKER_MEMORY_RESERVE_MB,
+                 scale_up_wait=SCALE_UP_WAIT, scale_down_idle=SCALE_DOWN_IDLE):
+        self.conn = conn
+        self.queue = Queue(VIDEO_QUEUE, connection=conn)
+        self.max_processes = max(max_processes, 1)
+        self.min_processes = min(max(min_processes, 0), self.max_processes)
+        self.process_memory = process_memory_mb * MB
+        self.reserve = reserve_mb * MB
+        self.scale_up_wait = scale_up_wait
+        self.scale_down_idle = scale_down_idle
+        self.processes = []
+        self.stopping = False
+        self._host = socket.gethostname()
+
+    # --- процессы ---
+
+    def _free_slot(self):
+        used = {proc.slot for proc in self.processes}
+        return min(slot for slot in range(self.max_processes) if slot not in used)
+
+    def spawn(self, reason):
+        slot = self._free_slot()
+        name = f"{self._host}.{slot}.{uuid.uuid4().hex[:8]}"
+        env = dict(os.environ)
+        env.update({
+            'WORKER_NAME': name,
+            'WORKER_SLOT': str(slot),
+            # Доля ядер считается при старте задачи по занятым процессам
+            # (см. resources.replan): одиночная задача получает все ядра
+            'WORKER_PARALLEL_JOBS': '0',
+            # При CPU_PINNING ядра делятся на слоты по максимуму процессов
+            'WORKER_PIN_SLOTS': str(self.max_processes),
+            # Эндпоинт метрик обслуживает супервизор
+            'METRICS_PORT': '0',
+        })
+        popen = subprocess.Popen([sys.executable, WORKER_SCRIPT], env=env)
+        self.processes.append(WorkerProcess(slot, name, popen))
+        logger.info(f"Запущен процесс воркера {name} (pid {popen.pid}): {reason}")
+
+    def reap(self):
+        """Убирает завершившиеся процессы"""
+        for proc in list(self.processes):
+            code = proc.popen.poll()
+            if code is None:
+                continue
+            self.processes.remove(proc)
+            if proc.retiring:
+                logger.info(f"Процесс воркера {proc.name} остановлен")
+            else:
+                logger.error(f"Процесс воркера {proc.name} неожиданно завершился с кодом {code}")
+
+    def refresh_states(self):
+        """Состояние процессов по их регистрации в RQ"""
+        now = time.monotonic()
+        for proc in self.processes:
+            state = None
+            try:
+                worker = Worker.find_by_key(Worker.redis_worker_namespace_prefix + proc.name, connection=self.conn)
+                state = worker.get_state() if worker else None
+            except Exception as e:
+                logger.debug(f"Не удалось получить состояние {proc.name}: {e}")
+            if state is None:
+                # Еще загружается; зависший при старте не считается свободным
+                state = 'starting' if now - proc.started_at < WORKER_START_TIMEOUT else 'unknown'
+            proc.state = state
+            if state == 'idle':
+                proc.idle_since = proc.idle_since or now
+            else:
+                proc.idle_since = None
+
+    # --- нагрузка ---
+
+    def queue_load(self):
+        """(число задач в очереди, сколько секунд ждет самая старая)"""
+        depth = self.queue.count
+        if not depth:
+            return 0, 0.0
+        oldest_wait = 0.0
+        job_ids = self.queue.get_job_ids(0, 0)
+        if job_ids:
+            job = self.queue.fetch_job(job_ids[0])
+            if job and job.enqueued_at:
+                enqueued_at = job.enqueued_at.replace(tzinfo=timezone.utc)
+                oldest_wait = (datetime.now(timezone.utc) - enqueued_at).total_seconds()
+        return depth, oldest_wait
+
+    def decide(self, depth, oldest_wait, headroom):
+        """
+        Решение на один шаг: ('spawn', причина), ('retire', процесс)
+        или (None, None)
+        """
+        active = [proc for proc in self.processes if not proc.retiring]
+        # Останавливающийся процесс дорабатывает задачу и занимает свой слот
+        has_slot = len(self.processes) < self.max_processes
+        if len(active) < self.min_processes and has_slot:
+            return 'spawn', f"минимум {self.min_processes}"
+
+        # Свободными считаются и запускающиеся процессы: они скоро возьмут задачу
+        free = sum(1 for proc in active if proc.state in ('idle', 'starting'))
+        waiting = depth - free
+        memory_ok = headroom is None or headroom >= self.process_memory + self.reserve
+        if waiting > 0 and oldest_wait >= self.scale_up_wait and has_slot:
+            if memory_ok:
+                return 'spawn', f"в очереди {depth}, ждет {oldest_wait:.0f} с"
+            logger.info(f"Очередь {depth}, но свободной памяти {headroom // MB} МБ - процесс не запускается")
+
+        if len(active) > self.min_processes:
+            idle = [proc for proc in active if proc.state == 'idle' and proc.idle_since is not None]
+            if idle:
+                proc = min(idle, key=lambda proc: proc.idle_since)
+                # Нехватка памяти - повод освободить простаивающий процесс сразу
+                low_memory = headroom is not None and headroom < self.reserve
+                if low_memory or (depth == 0 and time.monotonic() - proc.idle_since >= self.scale_down_idle):
+                    return 'retire', proc
+        return None, None
+
+    def tick(self):
+        self.reap()
+        if self.stopping:
+            return
+        self.refresh_states()
+        try:
+            depth, oldest_wait = self.queue_load()
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди: {e}")
+            depth, oldest_wait = 0, 0.0
+        action, arg = self.decide(depth, oldest_wait, memory_headroom())
+        if action == 'spawn':
+            self.spawn(arg)
+        elif action == 'retire':
+            logger.info(f"Останавливаю простаивающий процесс {arg.name}")
+            arg.retire()
+
+    # --- остановка ---
+
+    def drain(self, signum=None, frame=None):
+        """
+        Первый сигнал - теплая остановка всех процессов (задачи дорабатывают),
+        повторный - передается процессам, и RQ прерывает текущие задачи
+        """
+        if self.stopping:
+            logger.warning("Повторный сигнал остановки: прерываю текущие задачи")
+            for proc in self.processes:
+                if proc.alive():
+                    proc.popen.send_signal(signal.SIGTERM)
+            return
+        self.stopping = True
+        busy = sum(1 for proc in self.processes if proc.state == 'busy')
+        logger.info(f"Остановка: ожидаю завершения задач ({busy} в работе)")
+        for proc in self.processes:
+            proc.retire()
+
+    def run(self, interval=SUPERVISOR_INTERVAL):
+        signal.signal(signal.SIGTERM, self.drain)
+        signal.signal(signal.SIGINT, self.drain)
+        logger.info(
+            f"Супервизор воркеров: процессов {self.min_processes}-{self.max_processes}, "
+            f"память на процесс {self.process_memory // MB} МБ, запас {self.reserve // MB} МБ"
+        )
+        while not (self.stopping and not self.processes):
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Ошибка супервизора: {e}")
+            time.sleep(1 if self.stopping else interval)
+        logger.info("Все процессы воркера остановлены")
+
+
+def main():
+    conn = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=False)
+    try:
+        conn.ping()
+    except Exception as e:
+        logger.error(f"Ошибка подключения к Redis: {e}")
+        sys.exit(1)
+
+    # Метрики общие для всех процессов (хэш в Redis), эндпоинт один
+    try:
+        start_metrics_server(RedisMetrics(redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)))
+    except Exception as e:
+        logger.error(f"Не удалось запустить эндпоинт метрик: {e}")
+
+    WorkerSupervisor(conn).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decoding_guard import DecodingGuard, has_repetition_loop, trim_repetition_loops  # noqa: E402
+
+
+def test_legitimate_repetition_is_not_a_loop():
+    text = "нет, нет, нет, нет, я не согласен"
+    assert not has_repetition_loop(text)
+    assert trim_repetition_loops(text) == text
+
+
+def test_legitimate_repetition_segment_is_kept():
+    guard = DecodingGuard(enabled=True)
+    segments = [{'start': 0.0, 'end': 3.0, 'text': " Нет, нет, нет, нет, я не согласен."}]
+    assert guard.filter_segments(segments) == segments
+    assert guard.stats()['suppressed_segments'] == 0
+    assert guard.stats()['trimmed_segments'] == 0
+
+
+def test_loop_is_trimmed_and_rest_of_segment_kept():
+    text = "Подписывайтесь на канал. " + "Спасибо за просмотр. " * 6 + "До встречи"
+    guard = DecodingGuard(enabled=True)
+    kept = guard.filter_segments([{'start': 0.0, 'end': 30.0, 'text': text, 'compression_ratio': 3.5, 'temperature': 0.4}])
+    assert len(kept) == 1
+    assert kept[0]['text'] == "Подписывайтесь на канал. Спасибо за просмотр. До встречи"
+    assert guard.stats()['trimmed_segments'] == 1
+
+
+def test_long_unigram_run_is_trimmed():
+    assert trim_repetition_loops("да " * 10 + "конечно") == "да конечно"
@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from summarizer import summarize, _format_summary  # noqa: E402
+
+TOPICS = [
+    "обсуждали сроки поставки оборудования",
+    "говорили про найм тестировщиков",
+    "решили перенести релиз мобильного приложения",
+    "выбрали подрядчика для дизайна",
+    "согласовали план обучения сотрудников",
+    "разобрали жалобы клиентов поддержки",
+    "наметили аудит безопасности серверов",
+    "посчитали расходы на рекламу",
+    "договорились о встрече с инвесторами",
+    "проверили отчеты бухгалтерии",
+]
+
+
+def test_repetitive_transcript_keeps_distinct_sentences():
+    # Лучшие по оценке предложения одинаковы: отбор не должен ограничиться ими
+    segments = [
+        {'start': idx * 5.0, 'end': idx * 5.0 + 5, 'text': "Бюджет проекта утвержден командой разработки."}
+        for idx in range(90)
+    ]
+    segments += [
+        {'start': (90 + idx) * 5.0, 'end': (90 + idx) * 5.0 + 5, 'text': f"Бюджет проекта: {topic}."}
+        for idx, topic in enumerate(TOPICS)
+    ]
+    lines = summarize("", segments).splitlines()
+    assert len(lines) >= 5
+    assert len(set(line.split('] ', 1)[1] for line in lines)) == len(lines)
+
+
+def test_summary_is_capped_in_characters():
+    picked = [(idx * 10.0, "Очень длинное предложение про проект " * 10) for idx in range(20)]
+    summary = _format_summary(picked, True, max_chars=1000)
+    assert 0 < len(summary) <= 1000
+    assert summary.count("\n") + 1 < len(picked)
+
+
+def test_long_single_sentence_is_truncated():
+    summary = _format_summary([(0.0, "слово " * 500)], False, max_chars=200)
+    assert len(summary) == 200
+    assert summary.endswith("…")
@@ -1,12 +1,21 @@
 import os
 import json
+import time
 import logging
 import asyncio
 import tempfile
+import threading
+import socket
 from datetime import datetime
 from rq import Worker, Queue, Connection
 import redis
-from decryptor import decrypt_process
+from decryptor import decrypt_process, add_stage_observer, JobCancelled, kill_active_processes
+from metrics import RedisMetrics, start_metrics_server, METRICS_PORT
+from profiling import JobProfiler, profiling_requested
+from spool import release_task_files, SPOOL_RESULT_TTL
+from model_selector import ModelSelector, WHISPER_MODELS
+from resources import setup_worker_resources, cpu_plan, elastic_plan, replan
+from prefetch import Prefetcher, wait_for_prefetch
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,9 +36,177 @@ redis_conn_rq = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decod
 # Подключение к Redis для данных (с decode_responses) 
 redis_conn = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
 
+# Сколько помнить язык последних файлов пользователя (подсказка для детекции)
+USER_LANGUAGE_TTL = int(os.getenv('USER_LANGUAGE_TTL', 30 * 24 * 3600))
+
+# Выбор модели Whisper под срок выполнения задачи
+model_selector = ModelSelector(redis_conn)
+
+# Очереди: основная и уточняющие проходы. RQ берет задачи из второй,
+# только когда первая пуста, поэтому уточнение занимает лишь простаивающие воркеры
+VIDEO_QUEUE = 'video_processing'
+REFINE_QUEUE = 'video_refine'
+
+# Двухпроходный режим: сразу черновик самой быстрой моделью, затем
+# уточнение самой точной из WHISPER_MODELS
+TWO_PASS = os.getenv('TWO_PASS', '').lower() in ('1', 'true', 'yes')
+
+# Уточнение отменяется, если в основной очереди больше задач, чем это число
+REFINE_MAX_QUEUE = int(os.getenv('REFINE_MAX_QUEUE', 0))
+
+# Сколько входной файл ждет уточняющего прохода в очереди
+REFINE_FILE_TTL = 6 * 3600
+
+# Метрики хранятся в Redis и переживают завершение процесса задачи
+metrics = RedisMetrics(redis_conn)
+add_stage_observer(lambda stage: metrics.timer('video_stage_seconds', stage=stage))
+
+# Минимальный интервал между промежуточными записями статуса (секунды)
+STATUS_MIN_INTERVAL = float(os.getenv('STATUS_MIN_INTERVAL', 2.0))
+
+# Сколько хранится ключ задачи в Redis
+TASK_TTL = 3600
+
+# Статусы, которые записываются сразу, без склейки
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Имя воркера в RQ (задает supervisor.py); по умолчанию RQ генерирует сам
+WORKER_NAME = os.getenv('WORKER_NAME') or None
+
+# Флаг отмены задачи (ставит бот командой /cancel)
+CANCEL_KEY_PREFIX = 'cancel:'
+CANCEL_POLL_INTERVAL = 1.0
+
+class StatusWriter:
+    """
+    Запись статуса задачи в Redis со склейкой частых обновлений.
+
+    Промежуточные обновления пишутся не чаще min_interval: более ранние
+    перекрываются последним, а отложенная запись гарантирует, что последнее
+    обновление не потеряется. Финальные статусы пишутся сразу. Хэш и TTL
+    уходят одной транзакцией (MULTI/EXEC) за один round trip.
+    """
+    
+    def __init__(self, task_id, min_interval=STATUS_MIN_INTERVAL):
+        self.task_id = task_id
+        self.task_key = f"task:{task_id}"
+        self.min_interval = min_interval
+        self._pending = {}
+        self._last_flush = 0.0
+        self._timer = None
+        # Статус обновляется и из потоков executor (транскрибация)
+        self._lock = threading.Lock()
+    
+    def update(self, fields, terminal=False):
+        with self._lock:
+            self._pending.update(fields)
+            wait = self._last_flush + self.min_interval - time.monotonic()
+            if terminal or wait <= 0:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+    
+    def close(self):
+        """Отменяет отложенную запись и сбрасывает оставшееся обновление"""
+        self.flush()
+    
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        fields, self._pending = self._pending, {}
+        self._last_flush = time.monotonic()
+        try:
+            with metrics.timer('redis_latency_seconds', op='set_status'):
+                pipe = redis_conn.pipeline(transaction=True)
+                pipe.hset(self.task_key, mapping=fields)
+                pipe.expire(self.task_key, TASK_TTL)
+                pipe.execute()
+            if 'message' in fields:
+                logger.info(f"Задача {self.task_id}: {fields['message']}")
+        except Exception as e:
+            logger.error(f"Ошибка обновления статуса задачи {self.task_id}: {e}")
+
+class CancelWatcher:
+    """
+    Следит за флагом отмены задачи в фоновом потоке. При отмене сразу
+    убивает запущенные ffmpeg, а транскрибация останавливается на границе
+    ближайшей части (вызов объекта возвращает True).
+    """
+    
+    def __init__(self, task_id, interval=CANCEL_POLL_INTERVAL):
+        self.key = CANCEL_KEY_PREFIX + task_id
+        self.interval = interval
+        self.cancelled = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='cancel-watcher', daemon=True)
+    
+    def start(self):
+        self._check()
+        self._thread.start()
+    
+    def stop(self):
+        self._stopped.set()
+    
+    def __call__(self):
+        return self.cancelled.is_set()
+    
+    def _check(self):
+        try:
+            if redis_conn.exists(self.key):
+                self.cancelled.set()
+                kill_active_processes()
+        except Exception as e:
+            logger.debug(f"Ошибка проверки отмены {self.key}: {e}")
+    
+    def _run(self):
+        while not self.cancelled.is_set() and not self._stopped.wait(self.interval):
+            self._check()
+
+def get_queue_load():
+    """Число задач в очереди и живых воркеров"""
+    try:
+        queue = Queue(VIDEO_QUEUE, connection=redis_conn_rq)
+        return len(queue), max(Worker.count(connection=redis_conn_rq), 1)
+    except Exception as e:
+        logger.error(f"Ошибка чтения состояния очереди: {e}")
+        return 0, 1
+
+# Удаление ключа, только если он все еще принадлежит задаче
+_DELETE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+def release_inflight(task_data):
+    """Снимает закрепление файла за задачей: следующая отправка обработается заново"""
+    key = task_data.get('inflight_key')
+    if not key:
+        return
+    try:
+        redis_conn.eval(_DELETE_IF_EQUAL, 1, key, task_data['task_id'])
+    except Exception as e:
+        logger.error(f"Ошибка снятия закрепления {key}: {e}")
+
 class VideoProcessor:
     def __init__(self):
         self.processing_count = 0
+        self.status_writers = {}
+        
+    def _status_writer(self, task_id):
+        if task_id not in self.status_writers:
+            self.status_writers[task_id] = StatusWriter(task_id)
+        return self.status_writers[task_id]
         
     async def process_video_task(self, task_data):
         """
@@ -41,7 +218,25 @@ class VideoProcessor:
         
         logger.info(f"Начинаю обработку задачи {task_id} для пользователя {user_id}")
         
+        started = time.perf_counter()
+        job_status = 'failed'
+        audio_seconds = 0
+        record_file = None
+        keep_files = []
+        queue_wait = 0
+        cancel_watcher = CancelWatcher(task_id)
+        if task_data.get('created_at'):
+            try:
+                queue_wait = (datetime.now() - datetime.fromisoformat(task_data['created_at'])).total_seconds()
+                metrics.observe('video_queue_wait_seconds', max(queue_wait, 0))
+            except ValueError:
+                pass
+        
         try:
+            cancel_watcher.start()
+            if cancel_watcher():
+                raise JobCancelled()
+            
             # Проверяем существование файла
             if os.path.exists(file_path):
                 file_size = os.path.getsize(file_path)
@@ -58,19 +253,54 @@ class VideoProcessor:
             # Функция для обновления статуса
             def update_status(status_text):
                 self.set_task_status(task_id, "processing", status_text)
-                logger.info(f"Задача {task_id}: {status_text}")
             
-            # Обрабатываем видео
-            result = await decrypt_process(file_path, update_status)
+            # Модель выбирается, когда длительность файла уже известна
+            def choose_model(duration):
+                queue_depth, workers = get_queue_load()
+                model_name = model_selector.choose(duration, waited=queue_wait, queue_depth=queue_depth, workers=workers)
+                logger.info(f"Задача {task_id}: модель {model_name} (длительность {duration}, очередь {queue_depth}, воркеров {workers})")
+                return model_name
+            
+            # Если файл задачи уже конвертирует подготовка, дожидаемся ее
+            wait_for_prefetch(redis_conn, task_id, should_cancel=cancel_watcher)
+            
+            # В двухпроходном режиме черновик всегда делает самая быстрая модель
+            two_pass = TWO_PASS and len(WHISPER_MODELS) > 1
+            
+            # Обрабатываем видео; язык прошлых файлов пользователя служит
+            # подсказкой при определении языка
+            result = await decrypt_process(
+                file_path, update_status,
+                language=task_data.get('language'),
+                language_hint=self.get_user_language(user_id),
+                model_name=WHISPER_MODELS[0] if two_pass else None,
+                choose_model=choose_model,
+                should_cancel=cancel_watcher
+            )
             
             if result:
+                # Входной файл остается для уточняющего прохода
+                if two_pass and self.enqueue_refine(task_data, result):
+                    result['refine_pending'] = True
+                    keep_files.append(file_path)
+                
                 # Сохраняем результат в Redis
                 self.set_task_result(task_id, result)
+                job_status = 'completed'
+                audio_seconds = result.get('duration', 0)
+                record_file = result.get('record_file')
+                model_selector.record(result.get('model'), audio_seconds, time.perf_counter() - started)
+                if result.get('language'):
+                    self.remember_user_language(user_id, result['language'])
                 logger.info(f"Задача {task_id} завершена успешно")
             else:
                 self.set_task_status(task_id, "failed", "Ошибка обработки видео")
                 logger.error(f"Задача {task_id} завершена с ошибкой")
                 
+        except JobCancelled:
+            job_status = 'cancelled'
+            self.set_task_status(task_id, "cancelled", "Задача отменена")
+            logger.info(f"Задача {task_id} отменена")
         except MemoryError as e:
             error_msg = f"Недостаточно памяти для обработки файла: {str(e)}"
             self.set_task_status(task_id, "failed", error_msg)
@@ -81,52 +311,193 @@ class VideoProcessor:
             logger.error(f"Задача {task_id}: {error_msg}")
         
         finally:
-            # Удаляем временный файл
-            try:
-                if os.path.exists(file_path):
-                    os.unlink(file_path)
-                    logger.info(f"Временный файл {file_path} удален")
-            except Exception as e:
-                logger.error(f"Ошибка удаления файла {file_path}: {e}")
+            cancel_watcher.stop()
+            writer = self.status_writers.pop(task_id, None)
+            if writer:
+                writer.close()
+            release_inflight(task_data)
+            
+            metrics.record_job(job_status, time.perf_counter() - started, audio_seconds, cores=cpu_plan().job_cpus)
+            
+            # Удаляем файлы задачи; запись расшифровки остается для экспортов.
+            # Задачи, не зарегистрировавшие файлы, убирают только входной файл
+            if record_file:
+                keep_files.append(record_file)
+            files_ttl = REFINE_FILE_TTL if file_path in keep_files else SPOOL_RESULT_TTL
+            released = release_task_files(redis_conn, task_id, keep=keep_files, ttl=files_ttl)
+            if not released and file_path not in keep_files:
+                try:
+                    if os.path.exists(file_path):
+                        os.unlink(file_path)
+                        logger.info(f"Временный файл {file_path} удален")
+                except Exception as e:
+                    logger.error(f"Ошибка удаления файла {file_path}: {e}")
+    
+    def enqueue_refine(self, task_data, draft):
+        """Ставит уточняющий проход самой точной моделью в низкоприоритетную очередь"""
+        refine_model = WHISPER_MODELS[-1]
+        if draft.get('model') == refine_model:
+            return False
+        try:
+            refine_data = dict(
+                task_data,
+                language=draft.get('language'),
+                model=refine_model,
+                record_file=draft.get('record_file'),
+            )
+            Queue(REFINE_QUEUE, connection=redis_conn_rq).enqueue(
+                'worker.refine_video_sync', refine_data, job_timeout=3600
+            )
+            logger.info(f"Задача {task_data['task_id']}: уточнение моделью {refine_model} поставлено в очередь")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка постановки уточнения задачи {task_data['task_id']}: {e}")
+            return False
+    
+    async def process_refine_task(self, task_data):
+        """
+        Уточняющий проход: повторная расшифровка файла более точной моделью.
+        Результат пишется в refined_result задачи, бот заменяет им черновик.
+        Отменяется, если основная очередь начала расти.
+        """
+        task_id = task_data['task_id']
+        file_path = task_data['file_path']
+        started = time.perf_counter()
+        refine_status = 'cancelled'
+        cancel_watcher = CancelWatcher(task_id)
+        
+        def queue_backed_up():
+            return get_queue_load()[0] > REFINE_MAX_QUEUE
+        
+        def should_cancel():
+            return cancel_watcher() or queue_backed_up()
+        
+        try:
+            cancel_watcher.start()
+            if should_cancel():
+                logger.info(f"Задача {task_id}: уточнение отменено")
+                return
+            
+            logger.info(f"Задача {task_id}: уточнение моделью {task_data['model']}")
+            result = await decrypt_process(
+                file_path, lambda msg: logger.info(f"Уточнение {task_id}: {msg}"),
+                language=task_data.get('language'),
+                model_name=task_data['model'],
+                should_cancel=should_cancel
+            )
+            if result:
+                refine_status = 'completed'
+                self._status_writer(task_id).update({
+                    'refine_status': 'completed',
+                    'refined_result': json.dumps(result, ensure_ascii=False),
+                }, terminal=True)
+                model_selector.record(result.get('model'), result.get('duration', 0), time.perf_counter() - started)
+                logger.info(f"Задача {task_id}: уточнение завершено")
+            else:
+                refine_status = 'failed'
+        except JobCancelled:
+            logger.info(f"Задача {task_id}: уточнение прервано")
+        except Exception as e:
+            refine_status = 'failed'
+            logger.error(f"Задача {task_id}: ошибка уточнения: {e}")
+        finally:
+            cancel_watcher.stop()
+            if refine_status != 'completed':
+                self._status_writer(task_id).update({'refine_status': refine_status}, terminal=True)
+            writer = self.status_writers.pop(task_id, None)
+            if writer:
+                writer.close()
+            metrics.inc('video_refine_total', status=refine_status)
+            
+            # Запись расшифровки (черновик или уточненная) остается для экспортов
+            record_file = task_data.get('record_file')
+            release_task_files(redis_conn, task_id, keep=[record_file] if record_file else [])
     
     def set_task_status(self, task_id, status, message=""):
         """
         Устанавливает статус задачи в Redis
         """
+        task_data = {
+            'status': status,
+            'message': message,
+            'updated_at': datetime.now().isoformat()
+        }
+        self._status_writer(task_id).update(task_data, terminal=status in TERMINAL_STATUSES)
+    
+    def get_user_language(self, user_id):
+        """Язык последних файлов пользователя или None"""
         try:
-            task_key = f"task:{task_id}"
-            task_data = {
-                'status': status,
-                'message': message,
-                'updated_at': datetime.now().isoformat()
-            }
-            redis_conn.hset(task_key, mapping=task_data)
-            redis_conn.expire(task_key, 3600)  # Храним 1 час
+            return redis_conn.get(f"user:{user_id}:language")
+        except Exception as e:
+            logger.error(f"Ошибка чтения языка пользователя {user_id}: {e}")
+            return None
+    
+    def remember_user_language(self, user_id, language):
+        try:
+            redis_conn.set(f"user:{user_id}:language", language, ex=USER_LANGUAGE_TTL)
         except Exception as e:
-            logger.error(f"Ошибка обновления статуса задачи {task_id}: {e}")
+            logger.error(f"Ошибка сохранения языка пользователя {user_id}: {e}")
     
     def set_task_result(self, task_id, result):
         """
         Сохраняет результат задачи в Redis
         """
         try:
-            task_key = f"task:{task_id}"
             result_data = {
                 'status': 'completed',
                 'result': json.dumps(result, ensure_ascii=False),
                 'completed_at': datetime.now().isoformat()
             }
-            redis_conn.hset(task_key, mapping=result_data)
-            redis_conn.expire(task_key, 3600)  # Храним 1 час
         except Exception as e:
             logger.error(f"Ошибка сохранения результата задачи {task_id}: {e}")
+            return
+        self._status_writer(task_id).update(result_data, terminal=True)
+
+def busy_workers_on_host():
+    """Занятые воркеры RQ этого хоста, включая текущий"""
+    hostname = socket.gethostname()
+    workers = Worker.all(connection=redis_conn_rq)
+    return sum(1 for worker in workers if worker.hostname == hostname and worker.get_state() == 'busy')
+
+def plan_job_resources():
+    """
+    Под супервизором число процессов меняется, поэтому доля ядер задачи
+    считается по задачам, уже идущим на хосте: одиночная задача получает
+    все ядра контейнера. Уже идущие задачи свой план не меняют (потоки
+    torch задаются при загрузке модели), поэтому пока первая задача
+    не закончится, задачи вместе занимают больше ядер, чем есть.
+    """
+    if not elastic_plan():
+        return
+    try:
+        plan = replan(max(busy_workers_on_host(), 1))
+        logger.info(f"Ядра задачи: {plan.job_cpus:g} из {plan.cpus:g} (задач на хосте {plan.parallel_jobs})")
+    except Exception as e:
+        logger.error(f"Не удалось пересчитать план CPU: {e}")
 
 def process_video_sync(task_data, timeout=None):
     """
     Синхронная обертка для async функции (для RQ)
     """
+    plan_job_resources()
     processor = VideoProcessor()
-    asyncio.run(processor.process_video_task(task_data))
+    
+    if not profiling_requested(task_data):
+        asyncio.run(processor.process_video_task(task_data))
+        return
+    
+    # Профилирование по запросу: отчет доступен администратору через /profile
+    with JobProfiler(task_data['task_id']) as profiler:
+        asyncio.run(processor.process_video_task(task_data))
+    profiler.save(redis_conn)
+
+def refine_video_sync(task_data, timeout=None):
+    """
+    Синхронная обертка уточняющего прохода (для RQ)
+    """
+    plan_job_resources()
+    processor = VideoProcessor()
+    asyncio.run(processor.process_refine_task(task_data))
 
 def main():
     """
@@ -142,11 +513,28 @@ def main():
         logger.error(f"Ошибка подключения к Redis: {e}")
         return
     
-    # Создаем очередь
-    queue = Queue('video_processing', connection=redis_conn_rq)
+    # Потоки torch/ffmpeg и закрепление за ядрами по квоте контейнера;
+    # процессы задач наследуют настройки при форке
+    setup_worker_resources()
+    
+    # Эндпоинт метрик обслуживается основным процессом воркера;
+    # под супервизором (METRICS_PORT=0) - самим супервизором
+    if METRICS_PORT:
+        try:
+            start_metrics_server(metrics)
+        except Exception as e:
+            logger.error(f"Не удалось запустить эндпоинт метрик: {e}")
+    
+    # Создаем очереди в порядке приоритета
+    queue = Queue(VIDEO_QUEUE, connection=redis_conn_rq)
+    refine_queue = Queue(REFINE_QUEUE, connection=redis_conn_rq)
+    
+    # Создаем воркер; супервизор задает имя, чтобы следить за его состоянием
+    worker = Worker([queue, refine_queue], connection=redis_conn_rq, name=WORKER_NAME)
     
-    # Создаем воркер
-    worker = Worker([queue], connection=redis_conn_rq)
+    # Пока процесс задачи занят распознаванием, основной процесс
+    # конвертирует входные файлы следующих задач очереди
+    Prefetcher(redis_conn, redis_conn_rq, worker, VIDEO_QUEUE).start()
     
     logger.info("Воркер готов к обработке задач...")
     